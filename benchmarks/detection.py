@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Speed/recall trade-off of detecting the faces in downscaled images
+
+The faces found at full resolution are the ground truth. A face is recalled if a box found at a reduced scale (mapped
+back to the full-resolution image) overlaps it with an IoU >= 0.5.
+
+Usage:
+    python -m benchmarks.detection --images data/tests/images/original/ --scales 1 0.5 0.25 --output results.json
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from dolly.processing import detect_faces
+from dolly.utils import images_in_path
+from benchmarks.search import DIRNAME, environment
+
+DEFAULT_SCALES = [1.0, 0.75, 0.5, 0.25]
+
+
+def iou(a, b):
+    """Intersection over union of two face locations (top, right, bottom, left)"""
+    inter_h = min(a[2], b[2]) - max(a[0], b[0])
+    inter_w = min(a[1], b[1]) - max(a[3], b[3])
+    if inter_h <= 0 or inter_w <= 0:
+        return 0.0
+    inter = inter_h * inter_w
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return inter / float(area_a + area_b - inter)
+
+
+def matched_faces(truth, found, min_iou=0.5):
+    """Number of faces of the ground truth matched by a found face (each one matched once)"""
+    found, hits = list(found), 0
+    for t in truth:
+        ious = [iou(t, f) for f in found]
+        if ious and max(ious) >= min_iou:
+            found.pop(int(np.argmax(ious)))
+            hits += 1
+    return hits
+
+
+def run(filenames, scales, model='hog', repeat=3):
+    """Detect the faces of each image at every scale (decoding included)
+
+    Returns:
+        dict: Machine-readable results ({'meta': {...}, 'results': {scale: metrics}})
+
+    """
+    report = {'meta': environment(), 'config': {'images': len(filenames), 'model': model, 'repeat': repeat},
+              'results': {}}
+    truth = {filename: detect_faces(filename, scale=1.0, model=model) for filename in filenames}
+
+    for scale in scales:
+        times, num_truth, num_found, num_hits = [], 0, 0, 0
+        for filename in filenames:
+            for _ in range(repeat):  # Best of `repeat`
+                start_t = time.perf_counter()
+                found = detect_faces(filename, scale=scale, model=model)
+                times.append(time.perf_counter() - start_t)
+            num_truth += len(truth[filename])
+            num_found += len(found)
+            num_hits += matched_faces(truth[filename], found)
+
+        stats = {'time_per_image': round(float(np.sum(times)) / (repeat * len(filenames)) * 1000.0, 3),
+                 'faces_found': num_found,
+                 'recall': round(num_hits / num_truth, 4) if num_truth else 1.0}
+        report['results'][str(scale)] = stats
+        print('\t- scale {}: {}'.format(scale, stats))
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Speed/recall of the face detection per scale factor')
+    parser.add_argument('--images', default=os.path.join(DIRNAME, 'data/tests/images/original/'),
+                        help='Folder with the images')
+    parser.add_argument('--scales', type=float, nargs='+', default=DEFAULT_SCALES, help='Scale factors')
+    parser.add_argument('--model', help="Model used for face detection ('hog' or 'cnn'", default='hog')
+    parser.add_argument('--repeat', type=int, default=3, help='Detections per image and scale')
+    parser.add_argument('--output', help='Save the results (JSON)')
+    args = parser.parse_args(args)
+
+    filenames = sorted(images_in_path(args.images))
+    report = run(filenames, args.scales, args.model, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Results saved: {}'.format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
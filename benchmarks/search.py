@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark of the search engines of `Finder` over synthetic datasets
+
+Usage:
+    python -m benchmarks.search --sizes 10000 100000 --engines hnsw exact db --output results.json
+    python -m benchmarks.search --sizes 10000 --compare old_results.json
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+from dolly.db import create_connection
+from dolly.findclones import Finder
+from dolly.index import INDEX_FOLDER, INDEX_FILENAME, META_FILENAME
+from benchmarks.synthetic import make_dataset, make_encodings, make_queries
+
+DIRNAME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_ENGINES = ['hnsw', 'exact', 'db']
+DB_MAX_QUERIES = 20  # The 'db' engine decodes the whole table for each query
+
+# Metrics compared between runs (True: higher is better)
+METRICS = {'build_time': False, 'load_time': False, 'memory_mb': False, 'latency_p50': False, 'latency_p95': False,
+           'latency_p99': False, 'batch_qps': True, 'recall': True}
+
+
+def rss_mb():
+    """Resident memory of the process in MB (Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def percentiles(latencies):
+    """p50/p95/p99 of a list of latencies (in seconds), in milliseconds"""
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000.0, [50, 95, 99])
+    return {'latency_p50': round(float(p50), 4), 'latency_p95': round(float(p95), 4),
+            'latency_p99': round(float(p99), 4)}
+
+
+def recall_at_k(results, truth):
+    """Fraction of the true top-k (face IDs) that was returned"""
+    hits = sum(len(set(r[0] for r in res) & set(t[0] for t in tr)) for res, tr in zip(results, truth))
+    total = sum(len(tr) for tr in truth)
+    return hits / total if total else 1.0
+
+
+def bench_engine(engine, data_path, queries, top_k, batch_size, index_params=None, **finder_kwargs):
+    """Build/load a Finder with an engine and measure it
+
+    Args:
+        **finder_kwargs: Args for `Finder` (e.g. compression)
+
+    Returns:
+        tuple: (metrics, results of the single queries)
+
+    """
+    conn = create_connection(os.path.join(data_path, 'db/msceleb.sqlite'))
+    mem_before = rss_mb()
+
+    # Build the index from scratch (the saved one is removed), then measure how long it takes to load it
+    stats = {}
+    if engine == 'hnsw':
+        for filename in (INDEX_FILENAME, META_FILENAME):
+            filename = os.path.join(data_path, INDEX_FOLDER, filename)
+            if os.path.isfile(filename):
+                os.remove(filename)
+        finder = Finder(conn, data_path=data_path, engine=engine, index_params=index_params)
+        stats['build_time'] = finder.index_meta['build_time']
+        del finder
+    elif finder_kwargs.get('compression'):
+        finder = Finder(conn, data_path=data_path, engine=engine, rebuild_index=True, **finder_kwargs)
+        stats['build_time'] = finder.compressed.meta['build_time']
+        del finder
+
+    start_t = time.perf_counter()
+    finder = Finder(conn, data_path=data_path, engine=engine, index_params=index_params, **finder_kwargs)
+    stats['load_time'] = round(time.perf_counter() - start_t, 4)
+    stats['memory_mb'] = round(rss_mb() - mem_before, 2)
+
+    # Latency (one face per query)
+    latencies, results = [], []
+    for q in queries:
+        start_t = time.perf_counter()
+        results.append(finder.findclones(q, top_k=top_k))
+        latencies.append(time.perf_counter() - start_t)
+    stats.update(percentiles(latencies))
+
+    # Throughput (batches of faces)
+    batch = queries[:batch_size]
+    start_t = time.perf_counter()
+    finder.findclones_many(batch, top_k=top_k)
+    stats['batch_qps'] = round(len(batch) / (time.perf_counter() - start_t), 2)
+    stats['num_queries'] = len(queries)
+
+    conn.close()
+    return stats, results
+
+
+def run(sizes, engines, num_queries, top_k, batch_size, data_root, index_params=None, compressions=(), rerank_size=100):
+    """Run the benchmark for every size and engine (and every compression of the exact engine, as 'exact+{kind}')
+
+    Returns:
+        dict: Machine-readable results ({'meta': {...}, 'results': {size: {engine: metrics}}})
+
+    """
+    report = {'meta': environment(), 'config': {'num_queries': num_queries, 'top_k': top_k, 'batch_size': batch_size,
+                                                'index_params': index_params or {}, 'compressions': list(compressions),
+                                                'rerank_size': rerank_size},
+              'results': {}}
+    for size in sizes:
+        data_path = os.path.join(data_root, 'synthetic-{}'.format(size))
+        print('Dataset: {} faces ({})...'.format(size, data_path))
+        make_dataset(data_path, size)
+        encodings, _ = make_encodings(size)
+        queries = make_queries(encodings, num_queries)
+        del encodings
+
+        size_results, truth = {}, None
+        for engine in sorted(engines, key=lambda e: e != 'exact'):  # The exact engine is the ground truth
+            n = min(num_queries, DB_MAX_QUERIES) if engine == 'db' else num_queries
+            stats, results = bench_engine(engine, data_path, queries[:n], top_k, batch_size, index_params)
+            if engine == 'exact':
+                truth = results
+            if truth is not None:
+                stats['recall'] = round(recall_at_k(results, truth[:n]), 4)
+            size_results[engine] = stats
+            print('\t- {}: {}'.format(engine, stats))
+
+        for compression in compressions:
+            name = 'exact+' + compression
+            stats, results = bench_engine('exact', data_path, queries, top_k, batch_size, compression=compression,
+                                          rerank_size=rerank_size)
+            if truth is not None:
+                stats['recall'] = round(recall_at_k(results, truth), 4)
+            size_results[name] = stats
+            print('\t- {}: {}'.format(name, stats))
+        report['results'][str(size)] = size_results
+    return report
+
+
+def environment():
+    """Information needed to compare runs (commit, versions, machine)"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIRNAME,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    try:
+        import nmslib
+        nmslib_version = getattr(nmslib, '__version__', None)
+    except ImportError:
+        nmslib_version = None
+
+    return {'commit': commit, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'nmslib': nmslib_version, 'machine': platform.machine(),
+            'cpu_count': os.cpu_count()}
+
+
+def compare(report, baseline, threshold=0.1):
+    """Print the relative change of each metric against a baseline report
+
+    Returns:
+        list: Regressions (size, engine, metric, baseline value, new value)
+
+    """
+    regressions = []
+    for size, engines in report['results'].items():
+        for engine, stats in engines.items():
+            old_stats = baseline.get('results', {}).get(size, {}).get(engine)
+            if not old_stats:
+                continue
+            for metric, higher_better in METRICS.items():
+                old, new = old_stats.get(metric), stats.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                worse = change < -threshold if higher_better else change > threshold
+                print('{}\t{}\t{}:\t{} => {} ({:+.1%}){}'.format(size, engine, metric, old, new, change,
+                                                                 '\t[REGRESSION]' if worse else ''))
+                if worse:
+                    regressions.append((size, engine, metric, old, new))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the search engines (synthetic datasets)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Number of faces of each dataset')
+    parser.add_argument('--engines', nargs='+', default=DEFAULT_ENGINES, choices=DEFAULT_ENGINES, help='Engines')
+    parser.add_argument('--queries', type=int, default=200, help='Number of queries')
+    parser.add_argument('--top_k', type=int, default=10, help='Top k')
+    parser.add_argument('--batch_size', type=int, default=100, help='Faces per batch (throughput)')
+    parser.add_argument('--compressions', nargs='+', default=[], choices=['float16', 'pq'],
+                        help='Also measure the exact engine over compressed encodings')
+    parser.add_argument('--rerank', type=int, default=100, help='Candidates reranked with the exact encodings')
+    parser.add_argument('--data', default=os.path.join(DIRNAME, 'data/benchmarks'), help='Folder for the datasets')
+    parser.add_argument('--output', help='Save the results (JSON)')
+    parser.add_argument('--compare', help='Compare the results with a previous run (JSON)')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change considered a regression')
+    args = parser.parse_args(args)
+
+    report = run(args.sizes, args.engines, args.queries, args.top_k, args.batch_size, args.data,
+                 compressions=args.compressions, rerank_size=args.rerank)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Results saved: {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+
+from dolly.db import create_connection
+from dolly.schema import migrate_schema
+from dolly.store import save_matrix
+
+DIMS = 128
+FACES_PER_ENTITY = 50
+CENTROID_STD = 0.055  # Distance between people ~0.9 (as face_recognition encodings)
+FACE_STD = 0.02  # Distance between faces of the same person ~0.3 (below the 0.6 tolerance)
+
+
+def make_encodings(num_faces, seed=0, faces_per_entity=FACES_PER_ENTITY):
+    """Generate clustered 128-d encodings that mimic face_recognition encodings
+
+    Returns:
+        tuple: (encodings (num_faces, 128) float32, entity of each face)
+
+    """
+    rng = np.random.RandomState(seed)
+    num_entities = max(1, num_faces // faces_per_entity)
+    centroids = rng.normal(0.0, CENTROID_STD, size=(num_entities, DIMS)).astype(np.float32)
+    entities = rng.randint(0, num_entities, size=num_faces)
+    encodings = centroids[entities] + rng.normal(0.0, FACE_STD, size=(num_faces, DIMS)).astype(np.float32)
+    return encodings.astype(np.float32), entities
+
+
+def make_queries(encodings, num_queries, seed=1):
+    """Generate probes close to random faces of the dataset (other photos of the same people)"""
+    rng = np.random.RandomState(seed)
+    rows = rng.randint(0, len(encodings), size=num_queries)
+    return (encodings[rows] + rng.normal(0.0, FACE_STD, size=(num_queries, DIMS))).astype(np.float64)
+
+
+def make_dataset(data_path, num_faces, seed=0, chunk_size=10000):
+    """Create a synthetic dataset (`db/`, `pickle/` and `npy/`) with the layout of the msceleb dataset
+
+    Args:
+        data_path (str): Dataset folder
+        num_faces (int): Number of faces
+        seed (int): Random seed
+        chunk_size (int): Rows per insert
+
+    Returns:
+        str: Path to the database
+
+    """
+    database = os.path.join(data_path, 'db/msceleb.sqlite')
+    if os.path.isfile(database):
+        return database  # Already generated
+    os.makedirs(os.path.dirname(database), exist_ok=True)
+
+    encodings, entities = make_encodings(num_faces, seed)
+    conn = create_connection(database + '.tmp')
+    migrate_schema(conn)  # Same schema as the msceleb dataset
+    with conn:
+        conn.executemany('INSERT INTO entities(freebase_mid, name_en) VALUES (?, ?);',
+                         [('m.{:07d}'.format(i), 'Person {}'.format(i)) for i in range(int(entities.max()) + 1)])
+        for start in range(0, num_faces, chunk_size):
+            conn.executemany('INSERT INTO faces(image_name, freebase_mid, face_encoding, image_search_rank, hard_face) '
+                             'VALUES (?, ?, ?, ?, 0);',
+                             [('img{}'.format(i), 'm.{:07d}'.format(entities[i]), encodings[i], i % 100)
+                              for i in range(start, min(start + chunk_size, num_faces))])
+    conn.close()
+
+    ids = np.arange(1, num_faces + 1, dtype=np.int32)
+    save_matrix(data_path, ids, encodings, layout='pickle')
+    save_matrix(data_path, ids, encodings, layout='npy')
+    os.replace(database + '.tmp', database)
+    return database
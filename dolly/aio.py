@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from dolly.db import ConnectionProvider
+from dolly.processing import analyze_face, analyze_faces, detect_faces
+from dolly.utils import image_loader
+
+__all__ = ['AsyncFinder']
+
+
+def _analyze_image(image, model='hog', scale=1.0):
+    # Runs in the workers. Filenames are loaded there, so the image is not sent between processes
+    return analyze_face(image_loader(image), model=model, scale=scale)
+
+
+def _analyze_image_faces(image, model='hog', scale=1.0):
+    return analyze_faces(image_loader(image), model=model, scale=scale)
+
+
+class AsyncFinder:
+    """Asyncio facade of a `Finder` and of the processing functions
+
+    The detection and the encoding of the faces (CPU-bound) run in a pool of processes, and the searches in a pool of
+    threads (numpy, nmslib and sqlite3 release the GIL), so the event loop is never blocked. The Finder must be
+    thread-safe: give it a `ConnectionProvider` (see `AsyncFinder.open`) so each thread uses its own connection.
+
+    Cancelling a call (e.g. `asyncio.wait_for`) cancels the job if it has not started yet. Jobs already running finish
+    in the background and their result is discarded.
+
+    Example:
+        async with AsyncFinder.open(database, data_path=BASE_DIR) as af:
+            res = await af.findclones_image('obama.jpg', top_k=3)
+
+    """
+
+    def __init__(self, finder, max_concurrency=None, threads=None, processes=None):
+        """
+        Args:
+            finder (Finder): Finder used to search (thread-safe)
+            max_concurrency (:obj:`int`, optional): Defaults to None (no limit). Maximum number of calls running at
+                once. The rest wait (in the event loop) for their turn
+            threads (:obj:`int`, optional): Defaults to None (see `ThreadPoolExecutor`). Threads used to search
+            processes (:obj:`int`, optional): Defaults to None (all the cores). Processes used to analyze images
+
+        """
+        self.finder = finder
+        self.max_concurrency = max_concurrency
+        self.threads = threads
+        self.processes = processes
+        self.__semaphore = None
+        self.__thread_pool = None
+        self.__process_pool = None
+        self.__owns_connections = False  # The ConnectionProvider was created by `open`
+
+    @classmethod
+    def open(cls, database, data_path=None, max_concurrency=None, threads=None, processes=None, **finder_kwargs):
+        """Create a Finder with one read-only connection per thread, and its facade
+
+        Args:
+            database (str): Path to the SQLite database
+            data_path (str): Dataset folder
+            max_concurrency (:obj:`int`, optional): Defaults to None. See `AsyncFinder`
+            threads (:obj:`int`, optional): Defaults to None. See `AsyncFinder`
+            processes (:obj:`int`, optional): Defaults to None. See `AsyncFinder`
+            **finder_kwargs: Args for `Finder` (engine, index_params,...)
+
+        Returns:
+            AsyncFinder
+
+        """
+        from dolly.findclones import Finder
+
+        finder = Finder(db_conn=ConnectionProvider(database, readonly=True), data_path=data_path, **finder_kwargs)
+        async_finder = cls(finder, max_concurrency=max_concurrency, threads=threads, processes=processes)
+        async_finder.__owns_connections = True
+        return async_finder
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        """Shut down the pools and close the connections opened by `open` (a Finder given to the constructor keeps its
+        connections)
+
+        The searches already running (e.g. after a cancellation) are waited for, since they use the connections.
+        """
+        if self.__thread_pool is not None:
+            self.__thread_pool.shutdown(wait=True)
+            self.__thread_pool = None
+        if self.__process_pool is not None:
+            self.__process_pool.shutdown(wait=False)
+            self.__process_pool = None
+        if self.__owns_connections:
+            self.finder.db_conn.close()
+            self.__owns_connections = False
+
+    @property
+    def thread_pool(self):
+        if self.__thread_pool is None:
+            self.__thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+        return self.__thread_pool
+
+    @property
+    def process_pool(self):
+        if self.__process_pool is None:
+            self.__process_pool = ProcessPoolExecutor(max_workers=self.processes)
+        return self.__process_pool
+
+    async def _run(self, executor, func, *args, **kwargs):
+        # Created here so it belongs to the running loop
+        if self.max_concurrency and self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        loop = asyncio.get_running_loop()
+        if self.__semaphore is None:
+            return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+        async with self.__semaphore:
+            return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    async def image_loader(self, filename):
+        """Load an image (decoded in a thread)"""
+        return await self._run(self.thread_pool, image_loader, filename)
+
+    async def detect_faces(self, image, scale=1.0, model='hog'):
+        """Find the faces of an image (filename or numpy ndarray) in the pool of processes. See `detect_faces`"""
+        return await self._run(self.process_pool, detect_faces, image, scale=scale, model=model)
+
+    async def analyze_face(self, image, model='hog', scale=1.0):
+        """Get the location, landmarks and encoding of the first face of an image (filename or numpy ndarray) in the
+        pool of processes. See `analyze_face`"""
+        return await self._run(self.process_pool, _analyze_image, image, model=model, scale=scale)
+
+    async def analyze_faces(self, image, model='hog', scale=1.0):
+        """Get the location, landmarks and encoding of all the faces of an image in the pool of processes"""
+        return await self._run(self.process_pool, _analyze_image_faces, image, model=model, scale=scale)
+
+    async def findclones(self, face_encoding, top_k=10, **kwargs):
+        """Find the clones of a face in the pool of threads. See `Finder.findclones`"""
+        return await self._run(self.thread_pool, self.finder.findclones, face_encoding, top_k=top_k, **kwargs)
+
+    async def findclones_many(self, encodings, top_k=10, **kwargs):
+        """Find the clones of several faces in the pool of threads. See `Finder.findclones_many`"""
+        kwargs.setdefault('num_threads', 1)  # The pool already runs several searches at once
+        return await self._run(self.thread_pool, self.finder.findclones_many, encodings, top_k=top_k, **kwargs)
+
+    async def find_within(self, face_encoding, max_distance, limit=None, first_match=False):
+        """Find all the faces within a distance of a face in the pool of threads. See `Finder.find_within`"""
+        return await self._run(self.thread_pool, self.finder.find_within, face_encoding, max_distance, limit=limit,
+                               first_match=first_match)
+
+    async def findclones_image(self, image, top_k=10, model='hog', scale=1.0, **kwargs):
+        """Find the clones of the first face of an image (filename or numpy ndarray)
+
+        Returns:
+            list: Results (empty if there is no face)
+
+        """
+        f_loc, f_lmarks, f_enc = await self.analyze_face(image, model=model, scale=scale)
+        if f_enc is None:
+            return []
+        return await self.findclones(f_enc, top_k=top_k, **kwargs)
@@ -4,29 +4,217 @@ import sys
 import argparse
 
 from dolly.processing import *
+from dolly.profiling import Profile
 
 
 def _replace_filename_with_image(**kwargs):
-    if kwargs.get('filename'):
+    # The server (if running) needs the file, and the downscaled detection decodes it at reduced scale
+    if kwargs.get('filename') and not kwargs.get('server') and kwargs.get('scale', 1) >= 1:
         kwargs['np_image'] = image_loader(kwargs['filename'])
         del kwargs['filename']
     return kwargs
 
 
-def _findclones_cli(np_image, top_k, in_memory, model, dataset='msceleb', version='v1', **kwargs):
+def _running_server(server):
+    # Forward to the server only if it is running
+    from dolly.server import server_is_running
+
+    if server and server_is_running(server):
+        return server
+    elif server:
+        print('Server not running at {}. Running locally...'.format(server))
+    return None
+
+
+def _dataset_path(dataset='msceleb', version='v1'):
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data/production/{}/{}/'.format(dataset, version))
+
+
+def _findclones_cli(top_k, in_memory, model, np_image=None, engine=None, dataset='msceleb', version='v1', server=None,
+                    filename=None, scale=1.0, unique=False, entity_index=False, compression=None, rerank=100, shards=0,
+                    ef_search=None, threads=0, within=None, first=False, **kwargs):
     from dolly.findclones import Finder
     from dolly.db import create_connection
 
-    BASE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
-                            'data/production/{}/{}/'.format(dataset, version))
+    # Forward to the server (top-k only)
+    server = _running_server(server) if within is None else None
+    if server:
+        from dolly.server import request_server, encode_image_file
+
+        payload = {'image': encode_image_file(filename), 'top_k': top_k, 'model': model, 'unique_entities': unique}
+        res = request_server(server, '/findclones', payload)['results'][0]
+        Finder.print_results([(r['face_id'], r['freebase_mid'], r['name'], r['distance']) for r in res])
+        return
+
+    BASE_DIR = _dataset_path(dataset, version)
     database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
 
-    f = Finder(db_conn=create_connection(database), in_memory=in_memory, data_path=BASE_DIR)
-    f_loc, f_lmarks, f_enc = analyze_face(np_image=np_image, model=model)
-    res = f.findclones(face_encoding=f_enc, top_k=top_k)
+    np_image = np_image if np_image is not None else image_loader(filename)
+    f = Finder(db_conn=create_connection(database), in_memory=in_memory, data_path=BASE_DIR, engine=engine,
+               entity_index=entity_index, compression=compression, rerank_size=rerank, num_shards=shards,
+               ef_search=ef_search, num_threads=threads)
+    f_loc, f_lmarks, f_enc = analyze_face(np_image=np_image, model=model, scale=scale)
+    if within is not None:  # All the faces within a distance (at most k)
+        res = f.find_within(face_encoding=f_enc, max_distance=within, limit=top_k, first_match=first)
+    else:
+        res = f.findclones(face_encoding=f_enc, top_k=top_k, unique_entities=unique)
     f.print_results(res)
 
 
+def _findfaces_cli(np_image=None, save_path=None, server=None, filename=None, scale=1.0, **kwargs):
+    # Forward the detection to the server (faces are cropped here)
+    server = _running_server(server)
+    if server:
+        from dolly.server import remote_face_locations
+
+        face_locations = remote_face_locations(server, filename)
+        np_image = image_loader(filename) if save_path else None
+        return findfaces(np_image, save_path, face_locations=face_locations)
+
+    # Detect in the image decoded at reduced scale (the full image is only decoded to crop the faces)
+    if np_image is None and scale < 1:
+        face_locations = detect_faces(filename, scale=scale)
+        return findfaces(image_loader(filename) if save_path else None, save_path, face_locations=face_locations)
+
+    np_image = np_image if np_image is not None else image_loader(filename)
+    return findfaces(np_image, save_path)
+
+
+def _findfacesdir_cli(server=None, **kwargs):
+    # Forward the detection of each image to the server (faces are cropped here)
+    return findfacesdir(server=_running_server(server), **kwargs)
+
+
+def _drawboxes_cli(np_image=None, save_path=None, server=None, filename=None, **kwargs):
+    # Forward the detection to the server (the boxes are drawn here)
+    server = _running_server(server)
+    if server:
+        from dolly.server import remote_face_locations
+
+        return draw_boxes(image_loader(filename), save_path, face_locations=remote_face_locations(server, filename))
+
+    np_image = np_image if np_image is not None else image_loader(filename)
+    return draw_boxes(np_image, save_path)
+
+
+def _drawlandmarks_cli(np_image=None, save_path=None, server=None, filename=None, **kwargs):
+    # Forward the landmarks to the server (they are drawn here)
+    server = _running_server(server)
+    if server:
+        from dolly.server import remote_face_landmarks
+
+        return draw_landmarks(image_loader(filename), save_path,
+                              face_landmarks_list=remote_face_landmarks(server, filename))
+
+    np_image = np_image if np_image is not None else image_loader(filename)
+    return draw_landmarks(np_image, save_path)
+
+
+def _annotate_cli(image_filename, save_path, model='hog', scale=1.0, **kwargs):
+    prefix_name = os.path.splitext(os.path.basename(image_filename))[0]
+    faces = annotate(image_loader(image_filename), save_path, prefix_name=prefix_name, model=model, scale=scale)
+    print('Faces annotated: {} (saved in {})'.format(len(faces), save_path))
+
+
+def _serve_cli(dataset='msceleb', version='v1', host='127.0.0.1', port=8765, engine=None, workers=None,
+               compression=None, rerank=100, shards=0, ef_search=None, threads=0, **kwargs):
+    from dolly.findclones import Finder
+    from dolly.db import ConnectionProvider
+    from dolly.server import serve
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+
+    # Everything is loaded once (each thread of the server opens its own read-only connection)
+    f = Finder(db_conn=ConnectionProvider(database), data_path=BASE_DIR, engine=engine,
+               compression=compression, rerank_size=rerank, num_shards=shards, ef_search=ef_search, num_threads=threads)
+    serve(f, host=host, port=port, workers=workers, info={'dataset': dataset, 'version': version})
+
+
+def _buildindex_cli(dataset='msceleb', version='v1', entities=False, shards=0, shard=None, M=None, ef_construction=None,
+                    threads=0, **kwargs):
+    from dolly.findclones import Finder
+    from dolly.db import create_connection
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+
+    # Shards: plan them (--shards N) and build one (--shard i) or all of them, each one in its own process
+    if shards or shard is not None:
+        from dolly.shards import plan_shards, read_shards_plan, build_shards
+
+        index_params = {k: v for k, v in (('M', M), ('efConstruction', ef_construction)) if v}
+        plan = plan_shards(BASE_DIR, shards, index_params) if shards else read_shards_plan(BASE_DIR)
+        if plan is None:
+            raise ValueError('There is no plan of shards (use --shards N)')
+        for meta in build_shards(BASE_DIR, shards=[shard] if shard is not None else None):
+            print('Shard {} built in {}s ({} faces)'.format(meta['shard'], meta['build_time'], meta['num_items']))
+        return
+
+    f = Finder(db_conn=create_connection(database), in_memory=True, data_path=BASE_DIR, rebuild_index=True,
+               entity_index=entities, M=M, ef_construction=ef_construction, num_threads=threads)
+    print('Index built in {}s ({} faces)'.format(f.index_meta['build_time'], f.index_meta['num_items']))
+    if f.entity_index is not None:
+        print('Entity index built in {}s ({} entities)'.format(f.entity_index.build_time, len(f.entity_index)))
+
+
+def _tuneindex_cli(dataset='msceleb', version='v1', recall=0.95, top_k=10, probes=200, shards=0, threads=0, rerank=100,
+                   **kwargs):
+    from dolly.findclones import Finder
+    from dolly.db import create_connection
+    from dolly.tuning import tune_ef_search
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+
+    f = Finder(db_conn=create_connection(database), data_path=BASE_DIR, engine='hnsw', num_shards=shards,
+               num_threads=threads, rerank_size=rerank)
+    tuning = tune_ef_search(f, recall=recall, top_k=top_k, num_probes=probes)
+    print('efSearch: {} (saved with the index)'.format(tuning['ef_search']))
+
+
+def _updateindex_cli(dataset='msceleb', version='v1', rebuild=False, rebuild_fraction=0.1, **kwargs):
+    from dolly.index import update_index
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+    summary = update_index(database, BASE_DIR, rebuild=rebuild, rebuild_fraction=rebuild_fraction)
+    print('Appended: {appended}; Updated: {updated}; Deleted: {deleted}; Rebuilt: {rebuilt}'.format(**summary))
+
+
+def _migrate_cli(dataset='msceleb', version='v1', dtype='float32', vacuum=False, wal=False, **kwargs):
+    from dolly.db import migrate_encodings, enable_wal
+    from dolly.schema import migrate_schema
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+    migrate_schema(database)
+    if wal and enable_wal(database):
+        print('- WAL mode enabled')
+    migrate_encodings(database, dtype=dtype, vacuum=vacuum)
+
+
+def _exportmatrix_cli(source='db', dataset='msceleb', version='v1', **kwargs):
+    from dolly.store import export_matrix, pickles_to_npy
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+    if source == 'db':
+        export_matrix(database, BASE_DIR)
+    else:
+        pickles_to_npy(BASE_DIR)
+
+
+def _ingest_cli(tsv_filename, dataset='msceleb', version='v1', workers=1, buffer=1000, min_encodings=1,
+                no_resume=False, **kwargs):
+    from dolly.ingest import ingest_faces
+
+    BASE_DIR = _dataset_path(dataset, version)
+    database = os.path.join(BASE_DIR, 'db/msceleb.sqlite')
+    ingest_faces(tsv_filename, database, faces_folder=os.path.join(BASE_DIR, 'images/'), workers=workers, buffer=buffer,
+                 min_num_encodings=min_encodings, resume=not no_resume)
+
+
 def main():
     try:
         arg1 = str(sys.argv[1])
@@ -37,43 +225,184 @@ def main():
         if arg1 == 'findfaces':
             parser.add_argument('-f', '--filename', help='filename of the image to process', required=True)
             parser.add_argument('-d', '--save_path', help='directory to save the faces found')
-            func = findfaces
+            parser.add_argument('--server', help='forward the request to a dolly server (if running)', nargs='?',
+                                const='http://127.0.0.1:8765')
+            parser.add_argument('--scale', help='scale of the image used to detect the faces (e.g. 0.5)', type=float,
+                                default=1.0)
+            func = _findfaces_cli
 
         elif arg1 == 'findfacesdir':
             parser.add_argument('-d', '--directory', help='directory to search for faces', required=True)
             parser.add_argument('-d2', '--save_path', help='directory to save the faces found', required=True)
             parser.add_argument('-m', '--max_faces', help='maximum number of faces to save', type=int, default=0)
-            func = findfacesdir
+            parser.add_argument('-j', '--workers', help='number of processes used to analyze the images', type=int,
+                                default=1)
+            parser.add_argument('--scale', help='scale of the image used to detect the faces (e.g. 0.5)', type=float,
+                                default=1.0)
+            parser.add_argument('--server', help='forward the request to a dolly server (if running)', nargs='?',
+                                const='http://127.0.0.1:8765')
+            func = _findfacesdir_cli
 
         elif arg1 == 'drawboxes':
             parser.add_argument('-f', '--filename', help='filename of the image to process', required=True)
             parser.add_argument('-s', '--save_path', help='directory to save the faces found', required=True)
-            func = draw_boxes
+            parser.add_argument('--server', help='forward the request to a dolly server (if running)', nargs='?',
+                                const='http://127.0.0.1:8765')
+            func = _drawboxes_cli
 
         elif arg1 == 'drawlandmarks':
             parser.add_argument('-f', '--filename', help='filename of the image to process', required=True)
             parser.add_argument('-s', '--save_path', help='directory to save the faces found', required=True)
-            func = draw_landmarks
+            parser.add_argument('--server', help='forward the request to a dolly server (if running)', nargs='?',
+                                const='http://127.0.0.1:8765')
+            func = _drawlandmarks_cli
+
+        elif arg1 == 'annotate':
+            parser.add_argument('-f', '--filename', dest='image_filename', help='filename of the image to process',
+                                required=True)
+            parser.add_argument('-d', '--save_path', help='directory to save the annotations', required=True)
+            parser.add_argument('--model', help="Model used for face detection ('hog' or 'cnn'", default='hog')
+            parser.add_argument('--scale', help='scale of the image used to detect the faces (e.g. 0.5)', type=float,
+                                default=1.0)
+            func = _annotate_cli
 
-        if arg1 == 'findclones':
+        elif arg1 == 'findclones':
             parser.add_argument('-f', '--filename', help='filename of the image to process', required=True)
             parser.add_argument('-k', dest='top_k', help="Get 'K' nearest faces", type=int, default=10)
             parser.add_argument('--in_memory', help='Process all in memory (faster) or in disk (slower)',
                                 type=bool, default=True)
             parser.add_argument('--model', help="Model used for face detection ('hog' or 'cnn'", default='hog')
-
+            parser.add_argument('--engine', help="Search engine: 'hnsw' (approximate), 'exact' (scan over the "
+                                                 "memory-mapped encodings) or 'db' (scan over the DB)",
+                                choices=['hnsw', 'exact', 'db'])
+            parser.add_argument('--compression', help="scan compressed encodings ('float16' or 'pq') with the exact "
+                                                      "engine", choices=['float16', 'pq'])
+            parser.add_argument('--rerank', help='candidates of the hnsw index or of the compressed scan reranked with '
+                                                 'the euclidean distance (0: none)', type=int, default=100)
+            parser.add_argument('--server', help='forward the request to a dolly server (if running)', nargs='?',
+                                const='http://127.0.0.1:8765')
+            parser.add_argument('--scale', help='scale of the image used to detect the faces (e.g. 0.5)', type=float,
+                                default=1.0)
+            parser.add_argument('--unique', help='return the top k distinct people', action='store_true')
+            parser.add_argument('--entity_index', help='search the faces of the closest people only (two stages)',
+                                action='store_true')
+            parser.add_argument('--within', help="find the faces within a distance instead (e.g. 0.6, the tolerance of "
+                                                 "face_recognition)", type=float)
+            parser.add_argument('--first', help='with --within, stop at the first face found', action='store_true')
+            parser.add_argument('--shards', help='search an index split in N shards (one process per shard)', type=int,
+                                default=0)
+            parser.add_argument('--ef_search', help='size of the candidate list of the HNSW queries (default: the '
+                                                    'value saved by tuneindex)', type=int)
+            parser.add_argument('--threads', help='threads used to search (default: all the cores)', type=int,
+                                default=0)
             func = _findclones_cli
 
+        elif arg1 == 'serve':
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('--host', help='address to bind', default='127.0.0.1')
+            parser.add_argument('--port', help='port to bind', type=int, default=8765)
+            parser.add_argument('--engine', help="Search engine ('hnsw', 'exact' or 'db')",
+                                choices=['hnsw', 'exact', 'db'])
+            parser.add_argument('--compression', help="scan compressed encodings ('float16' or 'pq') with the exact "
+                                                      "engine", choices=['float16', 'pq'])
+            parser.add_argument('--rerank', help='candidates of the hnsw index or of the compressed scan reranked with '
+                                                 'the euclidean distance (0: none)', type=int, default=100)
+            parser.add_argument('-j', '--workers', help='processes used to analyze images (default: all the cores)',
+                                type=int)
+            parser.add_argument('--shards', help='search an index split in N shards (one process per shard)', type=int,
+                                default=0)
+            parser.add_argument('--ef_search', help='size of the candidate list of the HNSW queries (default: the '
+                                                    'value saved by tuneindex)', type=int)
+            parser.add_argument('--threads', help='threads used to search (default: all the cores)', type=int,
+                                default=0)
+            func = _serve_cli
+
+        elif arg1 == 'buildindex':
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('--entities', help='Build the entity index too', action='store_true')
+            parser.add_argument('--shards', help='Split the index in N shards (and build them)', type=int, default=0)
+            parser.add_argument('--shard', help='Build only this shard of the plan (e.g. one per host)', type=int)
+            parser.add_argument('--M', help='HNSW: links per node (higher: better recall, more memory)', type=int)
+            parser.add_argument('--ef_construction', help='HNSW: size of the candidate list while building (higher: '
+                                                          'better index, slower build)', type=int)
+            parser.add_argument('--threads', help='Threads used to build the index (default: all the cores)',
+                                type=int, default=0)
+            func = _buildindex_cli
+
+        elif arg1 == 'tuneindex':
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('--recall', help='Target recall@k', type=float, default=0.95)
+            parser.add_argument('-k', dest='top_k', help='Neighbours of the recall@k', type=int, default=10)
+            parser.add_argument('--probes', help='Faces of the DB used as queries', type=int, default=200)
+            parser.add_argument('--shards', help='Tune the index split in N shards', type=int, default=0)
+            parser.add_argument('--rerank', help='Candidates reranked with the euclidean distance (as in findclones)',
+                                type=int, default=100)
+            parser.add_argument('--threads', help='Threads used to search (default: all the cores)', type=int,
+                                default=0)
+            func = _tuneindex_cli
+
+        elif arg1 == 'updateindex':
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('--rebuild', help='Force a full rebuild of the index', action='store_true')
+            parser.add_argument('--rebuild_fraction', help='fraction of deletes/updates that triggers a full rebuild',
+                                type=float, default=0.1)
+            func = _updateindex_cli
+
+        elif arg1 == 'migrate':
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('--dtype', help="Format of the encodings ('float32' or 'float16')", default='float32',
+                                choices=['float32', 'float16'])
+            parser.add_argument('--vacuum', help='Reclaim the space freed after the migration', action='store_true')
+            parser.add_argument('--wal', help='Switch the DB to WAL mode (readers never wait for a writer)',
+                                action='store_true')
+            func = _migrate_cli
+
+        elif arg1 == 'exportmatrix':
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('--source', help="Export the encodings from the DB or convert the pickles",
+                                choices=['db', 'pickle'], default='db')
+            func = _exportmatrix_cli
+
+        elif arg1 == 'ingest':
+            parser.add_argument('-t', '--tsv', dest='tsv_filename', help='MS-Celeb TSV file to load', required=True)
+            parser.add_argument('--dataset', help='Name of the dataset', default='msceleb')
+            parser.add_argument('--version', help='Version of the dataset', default='v1')
+            parser.add_argument('-j', '--workers', help='number of processes used to analyze the faces', type=int,
+                                default=os.cpu_count())
+            parser.add_argument('-b', '--buffer', help='faces per commit', type=int, default=1000)
+            parser.add_argument('--min_encodings', help='skip entities with this number of encodings', type=int,
+                                default=1)
+            parser.add_argument('--no_resume', help='ignore the last checkpoint of the file', action='store_true')
+            func = _ingest_cli
+
         else:
             raise SyntaxError
 
+        parser.add_argument('--profile', help='print the time spent in each stage', action='store_true')
+        args = vars(parser.parse_args())
+        profile = Profile() if args.pop('profile') else None
+
         # Call function
-        results = _replace_filename_with_image(**vars(parser.parse_args()))
-        func(**results)
+        if profile:
+            profile.start()
+        try:
+            results = _replace_filename_with_image(**args)
+            func(**results)
+        finally:
+            if profile:
+                profile.stop()
+                profile.print_report()
 
     except (SyntaxError, IndexError) as e:
         print('Unknown command')
-        print('Available commands: [findfaces, findfacesdir, draw_boxes, draw_landmarks]')
+        print('Available commands: [findfaces, findfacesdir, drawboxes, drawlandmarks, annotate, findclones, serve, '
+              'buildindex, tuneindex, updateindex, migrate, exportmatrix, ingest]')
 
 
 if __name__ == '__main__':
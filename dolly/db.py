@@ -3,20 +3,123 @@
 
 import sqlite3
 import csv
+import threading
+from urllib.request import pathname2url
 
 from dolly.utils import *
 
 
-def create_connection(db_file, db_type='sqlite3'):
+DEFAULT_CACHED_STATEMENTS = 256  # Prepared statements reused per connection
+DEFAULT_CACHE_SIZE = -64 * 1024  # Page cache per connection (negative: in KiB, i.e. 64MB)
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024  # Bytes of the DB file read through memory-mapped I/O
+
+
+def configure_connection(conn, cache_size=DEFAULT_CACHE_SIZE, mmap_size=DEFAULT_MMAP_SIZE):
+    """Tune a connection for reads: bigger page cache, memory-mapped I/O and temporary tables in memory
+
+    Args:
+        conn (sqlite3.Connection): Connection
+        cache_size (int): `PRAGMA cache_size` (pages, or KiB if negative)
+        mmap_size (int): `PRAGMA mmap_size` (bytes). Zero disables memory-mapped I/O
+
+    Returns:
+        sqlite3.Connection
+
+    """
+    conn.execute('PRAGMA cache_size={:d};'.format(int(cache_size)))
+    conn.execute('PRAGMA mmap_size={:d};'.format(int(mmap_size)))
+    conn.execute('PRAGMA temp_store=MEMORY;')
+    return conn
+
+
+def create_connection(db_file, db_type='sqlite3', cache_size=DEFAULT_CACHE_SIZE, mmap_size=DEFAULT_MMAP_SIZE,
+                      **kwargs):
     if db_type == 'sqlite3':
+        kwargs.setdefault('cached_statements', DEFAULT_CACHED_STATEMENTS)
         try:
-            return sqlite3.connect(db_file)
+            return configure_connection(sqlite3.connect(db_file, **kwargs), cache_size, mmap_size)
         except sqlite3.Error as e:
             print(e)
     else:
         raise NotImplementedError('Database unknown')
 
 
+def create_readonly_connection(db_file, **kwargs):
+    """Open a read-only connection (URI `mode=ro`). Writes fail instead of taking the write lock"""
+    uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_file)))
+    return create_connection(uri, uri=True, **kwargs)
+
+
+def enable_wal(db_file):
+    """Switch a database to WAL mode, so readers never block (nor are blocked by) a writer
+
+    The journal mode is stored in the DB file, so this is only done once, with a read-write connection (read-only
+    connections cannot change it). See `dolly migrate --wal`.
+
+    Args:
+        db_file (str): Path to the SQLite database
+
+    Returns:
+        bool: The database is in WAL mode
+
+    """
+    if not os.path.isfile(db_file):  # Do not create an empty DB
+        return False
+    try:
+        conn = sqlite3.connect(db_file)
+        try:
+            mode = conn.execute('PRAGMA journal_mode;').fetchone()[0]
+            if mode.lower() != 'wal':
+                mode = conn.execute('PRAGMA journal_mode=WAL;').fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error as e:  # e.g. read-only file or folder
+        print('WAL mode could not be enabled: {}'.format(e))
+        return False
+    return mode.lower() == 'wal'
+
+
+class ConnectionProvider:
+    """Open (lazily) one connection per thread, so a `Finder` can be used by several threads at once
+
+    Each connection is only used by the thread that opened it. They are opened without `check_same_thread`, so `close`
+    can close all of them from any thread. By default the connections are read-only (the DB file is never modified),
+    reuse their prepared statements and read the DB through memory-mapped I/O. Switch the DB to WAL mode once (see
+    `enable_wal`) so these readers never wait for a writer.
+    """
+
+    def __init__(self, db_file, readonly=True, cache_size=DEFAULT_CACHE_SIZE, mmap_size=DEFAULT_MMAP_SIZE,
+                 cached_statements=DEFAULT_CACHED_STATEMENTS, **kwargs):
+        self.db_file = db_file
+        self.readonly = readonly
+        self.kwargs = dict(kwargs, check_same_thread=False, cache_size=cache_size, mmap_size=mmap_size,
+                           cached_statements=cached_statements)
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__connections = []
+
+    def get(self):
+        """Connection of the current thread"""
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            if self.readonly:
+                conn = create_readonly_connection(self.db_file, **self.kwargs)
+            else:
+                conn = create_connection(self.db_file, **self.kwargs)
+            self.__local.conn = conn
+            with self.__lock:
+                self.__connections.append(conn)
+        return conn
+
+    def close(self):
+        """Close the connections of all the threads"""
+        with self.__lock:
+            connections, self.__connections = self.__connections, []
+        for conn in connections:
+            conn.close()
+        self.__local = threading.local()
+
+
 def load_into_db(filename, database, sql, parser, csvkargs, buffer=10000, **kwargs):
     data = []
 
@@ -46,10 +149,94 @@ def load_into_db(filename, database, sql, parser, csvkargs, buffer=10000, **kwar
                         print('Finished!')
 
 
-def adapt_array(arr):
+# Compact encoding format: [magic (2 bytes), version (1 byte), dtype code (1 byte)] + raw little-endian values
+ENCODING_MAGIC = b'DE'
+ENCODING_VERSION = 1
+ENCODING_DTYPES = {b'f': np.dtype('<f4'), b'e': np.dtype('<f2')}
+ENCODING_CODES = {'float32': b'f', 'float16': b'e'}
+ENCODING_HEADER_SIZE = 4
+NPY_MAGIC = b'\x93NUMPY'
+
+# Format used by the adapter when inserting arrays ('float32' or 'float16')
+ENCODING_DTYPE = 'float32'
+
+
+def encode_array(arr, dtype=None):
+    """Serialize a 1-D encoding using the compact format
+
+    Args:
+        arr (numpy ndarray): Face encoding
+        dtype (:obj:`str`, optional): Defaults to `ENCODING_DTYPE`. 'float32' or 'float16'
+
+    Returns:
+        bytes
+
+    """
+    dtype = dtype or ENCODING_DTYPE
+    code = ENCODING_CODES[dtype]
+    header = ENCODING_MAGIC + bytes([ENCODING_VERSION]) + code
+    return header + np.ascontiguousarray(arr, dtype=ENCODING_DTYPES[code]).tobytes()
+
+
+def is_compact(blob, dtype=None):
+    """Check if a BLOB uses the compact format (and optionally, a given dtype)"""
+    if bytes(blob[:2]) != ENCODING_MAGIC or blob[2] != ENCODING_VERSION:
+        return False
+    return dtype is None or bytes(blob[3:4]) == ENCODING_CODES[dtype]
+
+
+def decode_array(blob):
+    """Deserialize an encoding stored in the compact (zero-copy) or in the legacy (.npy) format
+
+    Args:
+        blob (bytes): Serialized encoding
+
+    Returns:
+        numpy ndarray (read-only if compact)
+
     """
+    if bytes(blob[:2]) == ENCODING_MAGIC:
+        if blob[2] != ENCODING_VERSION:
+            raise ValueError('Unknown encoding format version: {}'.format(blob[2]))
+        return np.frombuffer(blob, dtype=ENCODING_DTYPES[bytes(blob[3:4])], offset=ENCODING_HEADER_SIZE)
+    elif bytes(blob[:6]) == NPY_MAGIC:
+        return np.load(io.BytesIO(blob))
+    else:
+        raise ValueError('Unknown encoding format')
+
+
+def decode_arrays(blobs):
+    """Deserialize a list of encodings into a matrix
+
+    If all of them are compact and have the same format, the matrix is decoded with a single `np.frombuffer`.
+
+    Args:
+        blobs (list): Serialized encodings
+
+    Returns:
+        numpy ndarray: Matrix (n, dims)
+
+    """
+    if not blobs:
+        return np.empty((0, 0))
+
+    header = bytes(blobs[0][:ENCODING_HEADER_SIZE])
+    if header[:2] == ENCODING_MAGIC and all(len(b) == len(blobs[0]) and bytes(b[:ENCODING_HEADER_SIZE]) == header
+                                            for b in blobs):
+        dtype = ENCODING_DTYPES[header[3:4]]
+        data = np.frombuffer(b''.join(blobs), dtype=dtype).reshape(len(blobs), -1)
+        return data[:, ENCODING_HEADER_SIZE // dtype.itemsize:]  # Skip headers (view)
+    return np.vstack([decode_array(b) for b in blobs])
+
+
+def adapt_array(arr):
+    """Adapter for np.ndarray. Encodings (1-D float arrays) are saved in the compact format
+
     http://stackoverflow.com/a/31312102/190597 (SoulNibbler)
     """
+    if arr.ndim == 1 and arr.dtype.kind == 'f':
+        return sqlite3.Binary(encode_array(arr))
+
     out = io.BytesIO()
     np.save(out, arr)
     out.seek(0)
@@ -57,13 +244,64 @@ def adapt_array(arr):
 
 
 def convert_array(text):
-    out = io.BytesIO(text)
-    out.seek(0)
-    return np.load(out)
+    return decode_array(text)
+
+
+def migrate_encodings(database, dtype='float32', buffer=10000, vacuum=False):
+    """Rewrite (in place) the column `faces.face_encoding` using the compact format
+
+    Rows already in the target format are skipped, so the migration can be interrupted and resumed.
+
+    Args:
+        database (str): Path to the SQLite database
+        dtype (str): 'float32' or 'float16'
+        buffer (int): Rows per commit
+        vacuum (bool): Reclaim the space freed after the migration
+
+    Returns:
+        int: Number of rows rewritten
+
+    """
+    conn = create_connection(database)
+    cur = conn.cursor()
+    has_log = cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'face_updates';"
+                          ).fetchone()[0] > 0
+
+    num_rows = 0
+    last_id = -1
+    with conn:
+        while True:
+            # Keyset pagination (the rows are updated while we iterate over them)
+            rows = cur.execute('SELECT id, face_encoding FROM faces WHERE id > ? AND face_encoding IS NOT NULL '
+                               'ORDER BY id LIMIT ?;', (last_id, buffer)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            data = [(sqlite3.Binary(encode_array(decode_array(blob), dtype)), face_id)
+                    for face_id, blob in rows if not is_compact(blob, dtype)]
+            if data and has_log:
+                # Only the format changes, so the rows logged for `update_index` (see `dolly.schema`) are removed in
+                # the same transaction (it holds the write lock, so the log has no rows of other writers)
+                cur.execute('BEGIN IMMEDIATE;')
+                last_seq = cur.execute('SELECT COALESCE(MAX(seq), 0) FROM face_updates;').fetchone()[0]
+                cur.executemany('UPDATE faces SET face_encoding=? WHERE id=?;', data)
+                cur.execute('DELETE FROM face_updates WHERE seq > ?;', (last_seq,))
+            else:
+                cur.executemany('UPDATE faces SET face_encoding=? WHERE id=?;', data)
+            conn.commit()
+            num_rows += len(data)
+            print("- Commit (last id: {}, rewritten: {})".format(last_id, num_rows))
+
+    if vacuum:
+        conn.execute('VACUUM;')
+    conn.close()
+    print('Finished!')
+    return num_rows
 
 
-# Converts np.array to TEXT when inserting
+# Converts np.array to BLOB when inserting
 sqlite3.register_adapter(np.ndarray, adapt_array)
 
-# Converts TEXT to np.array when selecting
-sqlite3.register_converter("array", convert_array)
\ No newline at end of file
+# Converts BLOB to np.array when selecting
+sqlite3.register_converter("array", convert_array)
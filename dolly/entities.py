@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import numpy as np
+
+from dolly.index import INDEX_FOLDER, file_fingerprint
+from dolly.search import euclidean_distances, merge_topk
+
+__all__ = ['EntityTable', 'EntityIndex', 'get_entity_index']
+
+ENTITY_INDEX_FILENAME = 'entities.npz'
+ENTITY_INDEX_FORMAT = 1
+
+
+class EntityTable:
+    """In-memory mapping face_id => entity (freebase_mid, name), backed by arrays aligned with `np_ids`
+
+    Rows of the encoding matrix are mapped to an entity index (`entity_rows`), so no SQL is needed to enrich results.
+    """
+
+    def __init__(self, np_ids, freebase_mids, names, entity_rows):
+        self.np_ids = np_ids
+        self.freebase_mids = freebase_mids
+        self.names = names
+        self.entity_rows = entity_rows  # Row => entity index (-1 if unknown)
+
+        # Sorted IDs to map face_id => row
+        self.__order = np.argsort(np_ids, kind='stable')
+        self.__sorted_ids = np.asarray(np_ids)[self.__order]
+
+    @classmethod
+    def from_db(cls, conn, np_ids, chunk_size=100000):
+        """Build the table from the `entities` and `faces` tables
+
+        Args:
+            conn: Database connection
+            np_ids (numpy ndarray): Face IDs (row `i` of the matrix is the face `np_ids[i]`)
+            chunk_size (int): Rows per block
+
+        Returns:
+            EntityTable
+
+        """
+        cur = conn.cursor()
+        rows = cur.execute('SELECT freebase_mid, name_en FROM entities;').fetchall()
+        freebase_mids = np.array([r[0] for r in rows], dtype=object)
+        names = np.array([r[1] for r in rows], dtype=object)
+        entity_index = {mid: i for i, mid in enumerate(freebase_mids)}
+
+        table = cls(np_ids, freebase_mids, names, np.full((len(np_ids),), -1, dtype=np.int32))
+        cur.execute('SELECT id, freebase_mid FROM faces WHERE face_encoding IS NOT NULL;')
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            face_rows = table.rows_from_faceids([r[0] for r in rows])
+            found = face_rows >= 0
+            table.entity_rows[face_rows[found]] = [entity_index.get(r[1], -1) for r, f in zip(rows, found) if f]
+        return table
+
+    def rows_from_faceids(self, face_ids):
+        """Get the rows of the matrix for a list of face IDs (-1 if not found)"""
+        face_ids = np.asarray(face_ids, dtype=np.int64)
+        if not len(self.__sorted_ids):
+            return np.full((len(face_ids),), -1, dtype=np.int64)
+
+        pos = np.searchsorted(self.__sorted_ids, face_ids)
+        pos[pos >= len(self.__sorted_ids)] = 0
+        found = self.__sorted_ids[pos] == face_ids
+        return np.where(found, self.__order[pos], -1)
+
+    def lookup(self, face_ids):
+        """Get the entities of a list of face IDs
+
+        Args:
+            face_ids (list): Face IDs
+
+        Returns:
+            dict: {face_id: (freebase_mid, entity_name)} (unknown faces are not included)
+
+        """
+        res = {}
+        face_rows = self.rows_from_faceids(face_ids)
+        for face_id, row in zip(face_ids, face_rows):
+            entity = self.entity_rows[row] if row >= 0 else -1
+            if entity >= 0:
+                res[int(face_id)] = (self.freebase_mids[entity], self.names[entity])
+        return res
+
+
+class EntityIndex:
+    """Centroid encoding of each entity, and the rows of the matrix of its faces
+
+    It is used for a two-stage search: the entities closest to a face are shortlisted by their centroid, and then only
+    their faces are compared. Faces without a known entity are not in the index.
+    """
+
+    def __init__(self, centroids, offsets, rows, fingerprint=None, build_time=None):
+        self.centroids = centroids  # (entities, 128)
+        self.offsets = offsets  # Faces of the entity `i`: rows[offsets[i]:offsets[i + 1]]
+        self.rows = rows  # Rows of the matrix, grouped by entity
+        self.fingerprint = fingerprint  # Fingerprint of the encoding matrix
+        self.build_time = build_time
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, encodings, entity_rows, chunk_size=100000):
+        """Build the index from the matrix of encodings
+
+        Args:
+            encodings (numpy ndarray): Matrix (n, 128) of face encodings
+            entity_rows (numpy ndarray): Entity of each row of the matrix (-1 if unknown). See `EntityTable`
+            chunk_size (int): Rows per block
+
+        Returns:
+            EntityIndex
+
+        """
+        start_t = time.time()
+        entity_rows = np.asarray(entity_rows)
+        valid = entity_rows >= 0
+        entities, compact = np.unique(entity_rows[valid], return_inverse=True)  # Entities with faces only
+
+        # Faces grouped by entity
+        order = np.argsort(compact, kind='stable')
+        rows = np.flatnonzero(valid)[order]
+        counts = np.bincount(compact, minlength=len(entities))
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        # Centroids (block by block, the matrix can be memory-mapped)
+        sums = np.zeros((len(entities), encodings.shape[1] if len(encodings) else 128), dtype=np.float64)
+        entity_of_row = np.full((len(entity_rows),), -1, dtype=np.int64)
+        entity_of_row[valid] = compact
+        for start in range(0, len(encodings), chunk_size):
+            block_entities = entity_of_row[start:start + chunk_size]
+            block_valid = block_entities >= 0
+            np.add.at(sums, block_entities[block_valid], encodings[start:start + chunk_size][block_valid])
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        return cls(centroids, offsets, rows, build_time=round(time.time() - start_t, 3))
+
+    def save(self, filename):
+        """Save the index (to a temporary file first)"""
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, format=ENTITY_INDEX_FORMAT, centroids=self.centroids, offsets=self.offsets, rows=self.rows,
+                     fingerprint=self.fingerprint or '', build_time=self.build_time or 0.0)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with `save`. Returns None if it is missing or has another format"""
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as data:
+            if int(data['format']) != ENTITY_INDEX_FORMAT:
+                return None
+            return cls(data['centroids'], data['offsets'], data['rows'], fingerprint=str(data['fingerprint']),
+                       build_time=float(data['build_time']))
+
+    def search(self, face_encoding, encodings, top_k, shortlist=100, row_alive=None, unique_entities=False):
+        """Find the closest faces to a face among the faces of the entities with the closest centroids
+
+        Args:
+            face_encoding (numpy ndarray): Face encoding
+            encodings (numpy ndarray): Matrix (n, 128) of face encodings
+            top_k (int): Number of faces
+            shortlist (int): Number of entities whose faces are compared
+            row_alive (:obj:`numpy ndarray`, optional): Defaults to None. Rows not deleted
+            unique_entities (bool): Return only the closest face of each entity
+
+        Returns:
+            tuple: (distances, rows) sorted by distance
+
+        """
+        # Stage 1: Closest entities by their centroid
+        shortlist = min(max(shortlist, top_k if unique_entities else 1), len(self.centroids))
+        if shortlist == 0:
+            return np.empty((0,)), np.empty((0,), dtype=np.int64)
+        centroid_dists = euclidean_distances(self.centroids, face_encoding)
+        if shortlist < len(centroid_dists):
+            candidates = np.argpartition(centroid_dists, shortlist - 1)[:shortlist]
+        else:
+            candidates = np.arange(len(centroid_dists))
+
+        # Stage 2: Faces of those entities
+        starts, ends = self.offsets[candidates], self.offsets[candidates + 1]
+        rows = np.concatenate([self.rows[start:end] for start, end in zip(starts, ends)])
+        entities = np.repeat(candidates, ends - starts)
+        order = np.argsort(rows, kind='stable')  # Read the matrix sequentially
+        rows, entities = rows[order], entities[order]
+        dists = euclidean_distances(encodings[rows], face_encoding)
+        if row_alive is not None:
+            dists[~row_alive[rows]] = np.inf
+
+        # Closest face of each entity
+        if unique_entities:
+            order = np.lexsort((rows, dists))
+            _, first = np.unique(entities[order], return_index=True)
+            best = order[first]
+            rows, dists = rows[best], dists[best]
+
+        dists, rows = merge_topk(np.empty((0,)), np.empty((0,), dtype=np.int64), dists, rows, top_k)
+        finite = np.isfinite(dists)
+        return dists[finite], rows[finite]
+
+
+def get_entity_index(data_path, conn, np_ids, encodings, source_files, rebuild=False):
+    """Load the entity index of a dataset from disk, or build it (and save it) if it is missing or stale
+
+    Args:
+        data_path (str): Dataset folder (the index is stored in `{data_path}/index/`)
+        conn: Database connection (entities of the faces)
+        np_ids (numpy ndarray): Face IDs of the matrix
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        source_files (list): Files of the matrix. Their fingerprint is stored with the index
+        rebuild (bool): Force the index to be rebuilt
+
+    Returns:
+        EntityIndex
+
+    """
+    filename = os.path.join(os.path.normpath(data_path), INDEX_FOLDER, ENTITY_INDEX_FILENAME)
+    fingerprint = file_fingerprint(*source_files)
+
+    entity_index = None if rebuild else EntityIndex.load(filename)
+    if entity_index is not None and entity_index.fingerprint == fingerprint:
+        return entity_index
+
+    print('Building entity index...')
+    entity_table = EntityTable.from_db(conn, np_ids)
+    entity_index = EntityIndex.build(encodings, entity_table.entity_rows)
+    entity_index.fingerprint = fingerprint
+
+    # Save it (the dataset could be read-only)
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        entity_index.save(filename)
+    except OSError as e:
+        print('The entity index could not be saved: {}'.format(e))
+    return entity_index
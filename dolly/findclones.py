@@ -2,21 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import re, sys, os, time
-import argparse, sys
 import json
-import shutil
-import glob
-import bisect
-import uuid
 import pickle
-import nmslib
+from concurrent.futures import ThreadPoolExecutor
 
-import face_recognition
 import numpy as np
-from PIL import Image, ImageDraw
-from googleapiclient.discovery import build
 
 from dolly.db import *
+from dolly.index import DEFAULT_EF_SEARCH, get_index
+from dolly.shards import get_sharded_index
+from dolly.search import euclidean_distances, cosine_distances, squared_norms, sq_euclidean_distances, merge_topk
+from dolly.store import matrix_files, load_ids, load_encodings, load_deleted, alive_rows
+from dolly.entities import EntityTable, get_entity_index
+from dolly.quantize import get_compressed
 from dolly.utils import *
 
 __all__ = ['Finder']
@@ -26,46 +24,227 @@ DIRNAME = os.path.dirname(os.path.dirname(__file__))
 
 class Finder:
 
-    def __init__(self, db_conn, in_memory=True, data_path=None):
+    def __init__(self, db_conn, in_memory=True, data_path=None, engine=None, index_params=None, rebuild_index=False,
+                 chunk_size=10000, preload_entities=False, entity_index=False, entity_shortlist=100, compression=None,
+                 rerank_size=100, pq_params=None, num_shards=0, M=None, ef_construction=None, ef_search=None,
+                 num_threads=0):
         # vars
-        self.conn = db_conn
-        self.in_memory = in_memory
+        self.db_conn = db_conn  # Connection, or ConnectionProvider (one connection per thread)
+        self.data_path = data_path
+        self.engine = engine or ('exact' if compression else 'hnsw' if in_memory else 'db')  # 'hnsw', 'exact' or 'db'
+        self.chunk_size = chunk_size  # Rows per block when scanning the DB or the encoding matrix
         self.SQLs = {'faces_with_encodings': 'SELECT * from faces WHERE face_encoding IS NOT NULL;',
-                     'entity_from_faceid': 'SELECT * from entities WHERE freebase_mid=(SELECT freebase_mid from faces WHERE id=?);'
+                     'encodings': 'SELECT id, face_encoding from faces WHERE face_encoding IS NOT NULL;',
+                     'entities_from_faceids': 'SELECT faces.id, faces.freebase_mid, entities.name_en from faces '
+                                              'LEFT JOIN entities ON entities.freebase_mid=faces.freebase_mid '
+                                              'WHERE faces.id IN ({});'
                      }
+        self.entity_table = None
+        self.np_encodings = None
+        self.row_alive = None  # Rows of the matrix searched (see `alive_rows`. None: all of them)
+        self.index_size = 0  # Rows of the matrix in the index (the next ones are searched exactly)
+        self.entity_index = None  # Centroids of the entities (two-stage search)
+        self.entity_shortlist = entity_shortlist  # Entities whose faces are compared in the two-stage search
+        self.compressed = None  # Compressed encodings ('float16' or 'pq') scanned instead of the matrix
+        self.sq_norms = None  # Squared norms of the rows of the matrix (exact engine)
+        self.norm_range = None  # Minimum and maximum norm of the rows of the index (range searches with hnsw)
+        self.rerank_size = rerank_size  # Candidates (HNSW or compressed scan) reranked exactly (0: none)
+        self.num_threads = num_threads  # Threads used to build the index and to search batches (0: all the cores)
+        self.ef_search = None  # Size of the HNSW candidate list (higher: better recall, slower queries)
 
-        # Build index in memory
-        if in_memory:
-            pickle_path = os.path.join(os.path.normpath(data_path), 'pickle/')
+        if self.engine not in ('hnsw', 'exact', 'db'):
+            raise KeyError('Unknown engine')
+        if compression and self.engine != 'exact':
+            raise NotImplementedError('Compressed encodings are only scanned by the exact engine')
+        if num_shards and self.engine != 'hnsw':
+            raise NotImplementedError('Only the hnsw engine can be sharded')
 
-            # Load vectors and build index
-            self.np_ids = pickle.load(open(pickle_path + 'np_ids.pkl', 'rb'))
-            self.index = nmslib.init(method='hnsw', space='cosinesimil')
-            self.index.addDataPointBatch(pickle.load(open(pickle_path + 'np_encodings.pkl', 'rb')))
-            self.index.createIndex()
+        if self.engine != 'db':
+            layout, ids_file, encodings_file = matrix_files(data_path)
+            self.np_ids = load_ids(data_path, layout)
+            self.row_alive = alive_rows(self.np_ids, load_deleted(data_path, layout))
 
-    def findclones(self, face_encoding, top_k=10):
-        if self.in_memory:
-            func = self.__fc_memory
+        # HNSW parameters: M and efConstruction are build parameters (a new index), efSearch is a query parameter
+        if M or ef_construction:
+            index_params = dict(index_params or {})
+            if M:
+                index_params['M'] = M
+            if ef_construction:
+                index_params['efConstruction'] = ef_construction
+
+        # Load index in memory (it is only built if it is missing or stale)
+        if self.engine == 'hnsw' and num_shards:
+            # One process per shard (same interface as a nmslib index)
+            with stage('load_index'):
+                self.index, self.index_meta = get_sharded_index(data_path, num_shards, index_params=index_params,
+                                                                rebuild=rebuild_index)
+            self.index_size = self.index_meta['num_items']
+            if rerank_size or len(self.np_ids) > self.index_size:
+                self.np_encodings = load_encodings(data_path, layout)
+
+        elif self.engine == 'hnsw':
+            with stage('load_index'):
+                self.index, self.index_meta = get_index(data_path,
+                                                        encodings_loader=lambda: load_encodings(data_path, layout),
+                                                        source_files=[encodings_file, ids_file],
+                                                        index_params=index_params, rebuild=rebuild_index,
+                                                        num_threads=num_threads)
+            self.index_size = self.index_meta['num_items']
+
+            # Encodings to rerank the candidates, and rows added after the index was built (see `update_index`)
+            if rerank_size or len(self.np_ids) > self.index_size:
+                self.np_encodings = load_encodings(data_path, layout)
+
+        # efSearch chosen by `tune_ef_search` (saved with the index), unless one is given
+        if self.engine == 'hnsw':
+            self.set_ef_search(ef_search or self.index_meta.get('ef_search'))
+
+        # Exact search over the encodings (memory-mapped with the .npy layout, so the pages are shared)
+        if self.engine == 'exact':
+            # Compressed copy in memory. The exact encodings are only read to rerank the candidates
+            if compression:
+                with stage('load_compressed'):
+                    self.compressed = get_compressed(data_path, compression,
+                                                     encodings_loader=lambda: load_encodings(data_path, layout),
+                                                     source_files=[encodings_file, ids_file], pq_params=pq_params,
+                                                     rebuild=rebuild_index)
+            if not compression or rerank_size:
+                self.np_encodings = load_encodings(data_path, layout)
+            if not compression:
+                with stage('squared_norms'):
+                    self.sq_norms = squared_norms(self.np_encodings)
+
+        # Entity index: shortlist the closest entities by their centroid, then compare only their faces
+        if entity_index:
+            if self.engine == 'db':
+                raise NotImplementedError('The entity index needs the encoding matrix (engines: hnsw or exact)')
+            if self.np_encodings is None:
+                self.np_encodings = load_encodings(data_path, layout)
+            with stage('load_entity_index'):
+                self.entity_index = get_entity_index(data_path, self.conn, self.np_ids, self.np_encodings,
+                                                     source_files=[encodings_file, ids_file], rebuild=rebuild_index)
+
+        # Preload the entities of the faces (no SQL is needed to enrich the results)
+        if preload_entities and self.engine != 'db':
+            self.entity_table = EntityTable.from_db(self.conn, self.np_ids)
+
+    @property
+    def conn(self):
+        if isinstance(self.db_conn, ConnectionProvider):
+            return self.db_conn.get()
+        return self.db_conn
+
+    @property
+    def in_memory(self):
+        return self.engine != 'db'
+
+    @in_memory.setter
+    def in_memory(self, value):
+        if not value:
+            self.engine = 'db'
+        elif self.engine == 'db':
+            self.engine = 'hnsw'
+
+    def set_ef_search(self, ef_search):
+        """Set the size of the candidate list of the HNSW queries (None: the default of nmslib)"""
+        self.ef_search = ef_search
+        self.index.setQueryTimeParams({'efSearch': int(ef_search or DEFAULT_EF_SEARCH)})
+
+    def findclones(self, face_encoding, top_k=10, unique_entities=False):
+        return self.findclones_many(np.asarray([face_encoding]), top_k=top_k, num_threads=1,
+                                    unique_entities=unique_entities)[0]
+
+    def findclones_many(self, encodings, top_k=10, num_threads=0, unique_entities=False):
+        """Find the clones of several faces at once
+
+        With the entity index, the faces are searched in two stages (closest entities by their centroid, then their
+        faces), and the distances are euclidean whatever the engine.
+
+        Args:
+            encodings (numpy ndarray): Matrix (n, 128) of face encodings
+            top_k (int): Number of clones per face
+            num_threads (int): Defaults to zero (the threads of the Finder, or all the cores). Number of threads used
+                to search
+            unique_entities (bool): Return the top-k distinct entities (the closest face of each one)
+
+        Returns:
+            list: Results of each face (same format as `findclones`)
+
+        """
+        funcs = {'hnsw': self.__fc_memory, 'exact': self.__fc_exact, 'db': self.__fc_db}
+        num_threads = num_threads or self.num_threads or os.cpu_count() or 1
+        encodings = np.atleast_2d(encodings)
+        if self.entity_index is not None:
+            with stage('search.entities', count=len(encodings)):
+                all_candidates = self.__fc_entities(encodings, top_k, unique_entities)
+        elif unique_entities:
+            with stage('search.unique_' + self.engine, count=len(encodings)):
+                all_candidates = self.__fc_unique(funcs[self.engine], encodings, top_k, num_threads)
         else:
-            func = self.__fc_db
-        return func(face_encoding, top_k, )
+            with stage('search.' + self.engine, count=len(encodings)):
+                all_candidates = funcs[self.engine](encodings, top_k, num_threads)
+        with stage('enhance_results', count=len(all_candidates)):
+            return self.enhance_results_many(all_candidates)
 
-    def enhance_results(self, top_candidates):
-        res = []
+    def find_within(self, face_encoding, max_distance, limit=None, first_match=False):
+        """Find all the faces within a distance of a face (e.g. 0.6, the tolerance of face_recognition)
 
-        with self.conn:
-            cur = self.conn.cursor()
+        The distance is euclidean (the same as `face_recognition.face_distance`) whatever the engine. The exact and DB
+        scans stop as soon as `first_match` is satisfied, and the hnsw engine asks the index for more candidates until
+        the farthest ones are out of the radius.
+
+        Args:
+            face_encoding (numpy ndarray): Face encoding
+            max_distance (float): Maximum distance (inclusive)
+            limit (:obj:`int`, optional): Defaults to None (all of them). Maximum number of faces (the closest ones)
+            first_match (bool): Stop at the first face found (e.g. to check if someone is already in the DB). It is
+                not always the closest one
+
+        Returns:
+            list: Results sorted by distance (same format as `findclones`). Empty if there is no face in the radius
+
+        """
+        funcs = {'hnsw': self.__fw_memory, 'exact': self.__fw_exact, 'db': self.__fw_db}
+        limit = 1 if first_match else limit
+        face_encoding = np.asarray(face_encoding)
+        with stage('within.' + self.engine):
+            dists, face_ids = funcs[self.engine](face_encoding, max_distance, limit, first_match)
 
-            for i, candidate in enumerate(top_candidates):
-                dist, face_id = candidate
+        order = np.lexsort((face_ids, dists))[:limit]
+        with stage('enhance_results', count=len(order)):
+            return self.enhance_results([(float(dists[i]), int(face_ids[i])) for i in order])
 
-                # Get info from DB
-                db_row = cur.execute(self.SQLs['entity_from_faceid'], (face_id,)).fetchone()
-                res.append((face_id, db_row[1], db_row[2], dist))  # (Face_id, freebase_mid, entity_name, dist)
+    def entities_from_faceids(self, face_ids, batch_size=500):
+        """Get the entities of a list of face IDs with batched queries. Returns {face_id: (freebase_mid, name)}"""
+        res = {}
+        face_ids = list(set(face_ids))
+        cur = self.conn.cursor()
+        for i in range(0, len(face_ids), batch_size):  # Stay below the SQLite limit of variables
+            batch = face_ids[i:i + batch_size]
+            sql = self.SQLs['entities_from_faceids'].format(','.join('?' * len(batch)))
+            for face_id, freebase_mid, entity_name in cur.execute(sql, batch):
+                res[face_id] = (freebase_mid, entity_name)
         return res
 
-    def print_results(self, candidates):
+    def enhance_results(self, top_candidates):
+        return self.enhance_results_many([top_candidates])[0]
+
+    def enhance_results_many(self, all_candidates):
+        face_ids = [face_id for top_candidates in all_candidates for dist, face_id in top_candidates]
+
+        # Get info from memory (if preloaded), and then from the DB (single query for all the faces)
+        entities = self.entity_table.lookup(face_ids) if self.entity_table else {}
+        missing = [face_id for face_id in face_ids if face_id not in entities]
+        if missing:
+            with stage('sql.entities_from_faceids', count=len(missing)):
+                entities.update(self.entities_from_faceids(missing))
+
+        # (Face_id, freebase_mid, entity_name, dist)
+        return [[(face_id,) + entities.get(face_id, (None, None)) + (dist,) for dist, face_id in top_candidates]
+                for top_candidates in all_candidates]
+
+    @staticmethod
+    def print_results(candidates):
         for i, c in enumerate(candidates):
             face_id, freebase_mid, entity_name, dist = c
             values = (i + 1, entity_name, freebase_mid, dist)
@@ -76,31 +255,289 @@ class Finder:
             cur = self.conn.cursor()
             return cur.execute(*args, **kwargs)
 
-    def __fc_memory(self, face_encoding, top_k, **kwargs):
-        ids, distances = self.index.knnQuery(face_encoding, k=top_k)
-        ids_db = self.np_ids[ids]
-        top_candidates = [(float(distances[i]), int(ids_db[i])) for i in range(0, len(ids))]
-        return self.enhance_results(top_candidates)
+    def __fc_entities(self, encodings, top_k, unique_entities=False):
+        all_candidates = []
+        for face_encoding in encodings:
+            dists, rows = self.entity_index.search(face_encoding, self.np_encodings, top_k, self.entity_shortlist,
+                                                   row_alive=self.row_alive, unique_entities=unique_entities)
+            all_candidates.append([(float(dist), int(self.np_ids[row])) for dist, row in zip(dists, rows)])
+        return all_candidates
 
-    def __fc_db(self, face_encoding, top_k=10, **kwargs):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute(self.SQLs['faces_with_encodings'])
+    def __fc_unique(self, func, encodings, top_k, num_threads=1):
+        # Without the entity index: ask the engine for more faces until there are top-k distinct entities
+        all_candidates = [None] * len(encodings)
+        pending, k = list(range(len(encodings))), top_k
+        while pending:
+            k *= 4
+            results = func(encodings[pending], k, num_threads)
+            face_ids = [face_id for top_candidates in results for dist, face_id in top_candidates]
+            entities = self.entity_table.lookup(face_ids) if self.entity_table else {}
+            entities.update(self.entities_from_faceids([face_id for face_id in face_ids if face_id not in entities]))
+
+            still_pending = []
+            for i, top_candidates in zip(pending, results):
+                seen, unique = set(), []
+                for dist, face_id in top_candidates:
+                    key = entities.get(face_id, (None,))[0] or ('face', face_id)  # Faces without entity are unique
+                    if key not in seen:
+                        seen.add(key)
+                        unique.append((dist, face_id))
+                all_candidates[i] = unique[:top_k]
+                if len(unique) < top_k and len(top_candidates) >= k:  # There are more faces to look at
+                    still_pending.append(i)
+            pending = still_pending
+        return all_candidates
+
+    def __fc_memory(self, encodings, top_k, num_threads=1, **kwargs):
+        # Shortlist of the index (cosine), reranked with the euclidean distance (the same as the other engines)
+        shortlist = max(top_k, self.rerank_size or 0)
+        if self.rerank_size and self.np_encodings is None:
+            self.np_encodings = load_encodings(self.data_path)
+        distance_func = euclidean_distances if self.rerank_size else cosine_distances
+
+        with stage('knnQuery', count=len(encodings)):
+            results = self.__knn(encodings, shortlist, num_threads)
+
+        all_candidates = []
+        for face_encoding, (rows, distances) in zip(encodings, results):
+            rows, distances = np.asarray(rows, dtype=np.int64), np.asarray(distances, dtype=np.float64)
+
+            # Skip deleted faces. If there are not enough left, ask the index for more
+            if self.row_alive is not None:
+                k = shortlist
+                while np.count_nonzero(self.row_alive[rows]) < shortlist and k < self.index_size:
+                    k = min(2 * k, self.index_size)
+                    rows, distances = self.index.knnQuery(face_encoding, k=k)
+                    rows, distances = np.asarray(rows, dtype=np.int64), np.asarray(distances, dtype=np.float64)
+                alive = self.row_alive[rows]
+                rows, distances = rows[alive], distances[alive]
+
+            # Exact distances of the shortlist
+            if self.rerank_size:
+                with stage('rerank', count=len(rows)):
+                    distances = euclidean_distances(self.np_encodings[rows], face_encoding)
+                    distances, rows = merge_topk(np.empty((0,)), np.empty((0,), dtype=np.int64), distances, rows,
+                                                 top_k)
+
+            # Merge with the rows that are not in the index yet (exact search, same distance as the results)
+            if len(self.np_ids) > self.index_size:
+                delta = self.np_encodings[self.index_size:]
+                delta_dists = distance_func(delta, face_encoding)
+                delta_rows = np.arange(self.index_size, len(self.np_ids))
+                if self.row_alive is not None:
+                    delta_dists[~self.row_alive[self.index_size:]] = np.inf
+                distances, rows = merge_topk(distances, rows, delta_dists, delta_rows, top_k)
+                rows, distances = rows[np.isfinite(distances)], distances[np.isfinite(distances)]
+
+            ids_db = self.np_ids[rows[:top_k]]
+            all_candidates.append([(float(distances[i]), int(ids_db[i])) for i in range(0, len(ids_db))])
+        return all_candidates
+
+    def __knn(self, encodings, top_k, num_threads=1):
+        k = min(top_k, self.index_size)
+        if len(encodings) == 1:
+            return [self.index.knnQuery(encodings[0], k=k)]
+        return self.index.knnQueryBatch(encodings, k=k, num_threads=num_threads)
+
+    def __fc_exact(self, encodings, top_k, num_threads=1, **kwargs):
+        # Matrix products: the threads come from the BLAS library
+        if self.compressed is None:
+            return self.__scan_matrix(encodings, top_k)
+
+        # Split the faces between threads (numpy releases the GIL)
+        scan = self.__scan_compressed
+        num_threads = min(num_threads, len(encodings))
+        if num_threads <= 1:
+            return scan(encodings, top_k)
+
+        groups = np.array_split(encodings, num_threads)
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            results = pool.map(lambda group: scan(group, top_k), groups)
+        return [top_candidates for group_candidates in results for top_candidates in group_candidates]
+
+    def __scan_matrix(self, encodings, top_k):
+        # Scan the matrix block by block (no private copy of the memory-mapped data). Each block is read once, and the
+        # squared distances to all the faces are a single matrix product (float32)
+        if self.sq_norms is None:
+            self.sq_norms = squared_norms(self.np_encodings)
+        probes = np.asarray(encodings, dtype=np.float32)
+        probes_sq_norms = np.einsum('ij,ij->i', probes, probes)
+        shortlist = min(2 * top_k + 16, len(self.np_encodings))  # Margin for the rounding errors of the product
+        probe_idx = np.arange(len(probes))[:, None]
+        top_dists = np.empty((len(probes), 0), dtype=np.float32)
+        top_rows = np.empty((len(probes), 0), dtype=np.int64)
+
+        for start in range(0, len(self.np_encodings), self.chunk_size):
+            block = self.np_encodings[start:start + self.chunk_size]
+            dists = sq_euclidean_distances(block, self.sq_norms[start:start + len(block)], probes, probes_sq_norms)
+            if self.row_alive is not None:
+                dists[:, ~self.row_alive[start:start + len(block)]] = np.inf
+
+            # Partial selection of the block, merged with the running shortlist
+            if len(block) > shortlist:
+                part = np.argpartition(dists, shortlist - 1, axis=1)[:, :shortlist]
+                dists, rows = dists[probe_idx, part], part + start
+            else:
+                rows = np.broadcast_to(np.arange(start, start + len(block)), dists.shape)
+            top_dists = np.concatenate((top_dists, dists), axis=1)
+            top_rows = np.concatenate((top_rows, rows), axis=1)
+            if top_dists.shape[1] > shortlist:
+                part = np.argpartition(top_dists, shortlist - 1, axis=1)[:, :shortlist]
+                top_dists, top_rows = top_dists[probe_idx, part], top_rows[probe_idx, part]
+
+        # Rerank the shortlist with the exact distances (the same as `face_recognition.face_distance`)
+        all_candidates = []
+        for face_encoding, cand_dists, cand_rows in zip(encodings, top_dists, top_rows):
+            cand_rows = np.sort(cand_rows[np.isfinite(cand_dists)])  # Sorted: sequential reads of the matrix
+            dists = euclidean_distances(self.np_encodings[cand_rows], face_encoding)
+            dists, rows = merge_topk(np.empty((0,)), np.empty((0,), dtype=np.int64), dists, cand_rows, top_k)
+            all_candidates.append([(float(dist), int(self.np_ids[row])) for dist, row in zip(dists, rows)])
+        return all_candidates
+
+    def __scan_compressed(self, encodings, top_k):
+        # Approximate distances over the compressed encodings, keeping a shortlist of candidates. Each block is decoded
+        # once, and the distances to all the faces are computed together
+        shortlist = max(top_k, self.rerank_size or 0)
+        probes = np.asarray(encodings, dtype=np.float32)
+        tables = self.compressed.distance_table(probes) if self.compressed.kind == 'pq' else None
+        tops = [(np.empty((0,)), np.empty((0,), dtype=np.int64)) for _ in range(len(probes))]
+        for start in range(0, len(self.compressed), self.chunk_size):
+            end = min(start + self.chunk_size, len(self.compressed))
+            rows = np.arange(start, end)
+            dists = self.compressed.distances(probes, start, end, tables=tables)
+            if self.row_alive is not None:
+                dists[:, ~self.row_alive[start:end]] = np.inf
+            for i in range(len(probes)):
+                tops[i] = merge_topk(tops[i][0], tops[i][1], dists[i], rows, shortlist)
+
+        # Rerank the shortlist with the exact encodings (same distances as the exact engine)
+        all_candidates = []
+        for face_encoding, (top_dists, top_rows) in zip(encodings, tops):
+            top_rows = top_rows[np.isfinite(top_dists)]
+            top_dists = top_dists[np.isfinite(top_dists)]
+            if self.rerank_size:
+                top_rows = np.sort(top_rows)
+                top_dists = euclidean_distances(self.np_encodings[top_rows], face_encoding)
+                top_dists, top_rows = merge_topk(np.empty((0,)), np.empty((0,), dtype=np.int64), top_dists,
+                                                 top_rows, top_k)
+            all_candidates.append([(float(dist), int(self.np_ids[row]))
+                                   for dist, row in zip(top_dists[:top_k], top_rows[:top_k])])
+        return all_candidates
+
+    @staticmethod
+    def __merge_within(top, dists, ids, limit=None):
+        # Keep all the matches (or only the closest `limit` ones)
+        if limit:
+            return merge_topk(top[0], top[1], dists, ids, limit)
+        return np.concatenate((top[0], dists)), np.concatenate((top[1], ids))
+
+    def __fw_exact(self, face_encoding, max_distance, limit=None, first_match=False):
+        if self.np_encodings is None:  # Compressed encodings without rerank
+            self.np_encodings = load_encodings(self.data_path)
+        if self.sq_norms is None:
+            self.sq_norms = squared_norms(self.np_encodings)
+
+        # Candidates with the matrix product (a margin for its rounding errors), checked with the exact distance
+        probe = np.asarray(face_encoding, dtype=np.float32)[None, :]
+        probe_sq_norms = np.einsum('ij,ij->i', probe, probe)
+        max_sq_distance = max_distance ** 2 + 1e-4
+        top = (np.empty((0,)), np.empty((0,), dtype=np.int64))
+        for start in range(0, len(self.np_encodings), self.chunk_size):
+            block = self.np_encodings[start:start + self.chunk_size]
+            sq_dists = sq_euclidean_distances(block, self.sq_norms[start:start + len(block)], probe, probe_sq_norms)
+            rows = np.nonzero(sq_dists[0] <= max_sq_distance)[0]
+            if self.row_alive is not None:
+                rows = rows[self.row_alive[start + rows]]
+            if not len(rows):
+                continue
+
+            dists = euclidean_distances(block[rows], face_encoding)
+            inside = dists <= max_distance
+            top = self.__merge_within(top, dists[inside], self.np_ids[start + rows[inside]], limit)
+            if first_match and len(top[0]):
+                break
+        return top
+
+    def __cosine_radius(self, face_encoding, max_distance):
+        # Largest cosine distance of a row within an euclidean distance of a face, given the norms of the rows
+        if self.norm_range is None:
+            norms = np.sqrt(squared_norms(self.np_encodings[:self.index_size]))
+            self.norm_range = (float(np.min(norms)), float(np.max(norms))) if len(norms) else (0.0, 0.0)
+
+        norm = float(np.linalg.norm(face_encoding))
+        if norm <= max_distance or self.norm_range[0] <= 0:
+            return np.inf  # The ball contains the origin: any direction
+        closest = np.clip(np.sqrt(norm ** 2 - max_distance ** 2), *self.norm_range)  # Minimizes the cosine
+        return 1.0 - (closest ** 2 + norm ** 2 - max_distance ** 2) / (2.0 * closest * norm) + 1e-5
+
+    def __fw_memory(self, face_encoding, max_distance, limit=None, first_match=False):
+        if self.np_encodings is None:
+            self.np_encodings = load_encodings(self.data_path)
+
+        # Grow the candidates of the index until they cover the radius (translated to a cosine distance)
+        top = (np.empty((0,)), np.empty((0,), dtype=np.int64))
+        k = min(max(limit or 0, 32), self.index_size)
+        while k:
+            with stage('knnQuery'):
+                rows, index_dists = self.index.knnQuery(face_encoding, k=k)
+            rows = np.asarray(rows, dtype=np.int64)
+            dists = euclidean_distances(self.np_encodings[rows], face_encoding)
+            inside = dists <= max_distance
+            if self.row_alive is not None:
+                inside &= self.row_alive[rows]
+
+            # With a limit, only the radius of the closest `limit` faces must be covered
+            radius = max_distance
+            if limit and np.count_nonzero(inside) >= limit:
+                radius = np.partition(dists[inside], limit - 1)[limit - 1]
+            covered = len(index_dists) and index_dists[-1] > self.__cosine_radius(face_encoding, radius)
+            if covered or k >= self.index_size or (first_match and np.any(inside)):
+                top = self.__merge_within(top, dists[inside], self.np_ids[rows[inside]], limit)
+                break
+            k = min(2 * k, self.index_size)
+
+        # Rows that are not in the index yet (exact)
+        if len(self.np_ids) > self.index_size and not (first_match and len(top[0])):
+            dists = euclidean_distances(self.np_encodings[self.index_size:], face_encoding)
+            inside = dists <= max_distance
+            if self.row_alive is not None:
+                inside &= self.row_alive[self.index_size:]
+            top = self.__merge_within(top, dists[inside], self.np_ids[self.index_size:][inside], limit)
+        return top
+
+    def __fw_db(self, face_encoding, max_distance, limit=None, first_match=False):
+        top = (np.empty((0,)), np.empty((0,), dtype=np.int64))
+        cur = self.conn.cursor()
+        cur.execute(self.SQLs['encodings'])
+        while True:
+            rows = cur.fetchmany(self.chunk_size)
+            if not rows:
+                break
+
+            ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            dists = euclidean_distances(decode_arrays([row[1] for row in rows]), face_encoding)
+            inside = dists <= max_distance
+            top = self.__merge_within(top, dists[inside], ids[inside], limit)
+            if first_match and len(top[0]):
+                break
+        return top
 
-            # Find similar faces, without using too much memory
-            top_candidates = []  # Max. size 10
-            for row in cur:  # Iterator. Doesn't load the whole table
-                face_id = int(row[0])
-                dist = float(face_recognition.face_distance([convert_array(row[5])], face_encoding)[0])
+    def __fc_db(self, encodings, top_k, num_threads=1, **kwargs):
+        cur = self.conn.cursor()
+        cur.execute(self.SQLs['encodings'])
 
-                # Add to list IN ORDER
-                t = (dist, face_id)
-                if len(top_candidates) < top_k:
-                    bisect.insort(top_candidates, t)
-                else:
-                    if dist < top_candidates[-1][0]:  # Closer than the last element
-                        bisect.insort(top_candidates, t)
-                        top_candidates.pop()  # Remove last element
+        # Find similar faces, block by block (memory is bounded by the chunk size). Each block is decoded once
+        tops = [(np.empty((0,)), np.empty((0,), dtype=np.int64)) for _ in range(len(encodings))]
+        while True:
+            rows = cur.fetchmany(self.chunk_size)
+            if not rows:
+                break
 
-            return self.enhance_results(top_candidates)
+            ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            block = decode_arrays([row[1] for row in rows])
+            for i, face_encoding in enumerate(encodings):
+                dists = euclidean_distances(block, face_encoding)
+                tops[i] = merge_topk(tops[i][0], tops[i][1], dists, ids, top_k)
 
+        return [[(float(dist), int(face_id)) for dist, face_id in zip(top_dists, top_ids)]
+                for top_dists, top_ids in tops]
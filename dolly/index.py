@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+from dolly.db import create_connection, decode_arrays
+from dolly.schema import migrate_schema
+from dolly.store import matrix_files, load_ids, load_encodings, append_matrix, load_deleted, save_deleted, \
+    compact_matrix
+
+__all__ = ['file_fingerprint', 'build_index', 'save_index', 'save_index_meta', 'load_index', 'read_index_meta',
+           'is_index_stale', 'get_index', 'update_index']
+
+INDEX_FOLDER = 'index/'
+INDEX_FILENAME = 'hnsw.bin'
+META_FILENAME = 'hnsw.json'
+INDEX_FORMAT = 1
+
+DEFAULT_METHOD = 'hnsw'
+DEFAULT_SPACE = 'cosinesimil'
+DEFAULT_EF_SEARCH = 20  # Default efSearch of the HNSW queries of nmslib
+
+
+def file_fingerprint(*filenames, sample_size=1 << 16, num_samples=16):
+    """Compute a cheap SHA-1 fingerprint of the content of one or more files
+
+    Only the size and some blocks of each file are hashed: the first bytes (the header of a `.npy` file), the last
+    ones (the last rows appended) and `num_samples` blocks evenly spaced in between. So it takes the same time for any
+    size of the matrix, and it only depends on the content: a copy of the dataset (other folder, host, backup,...)
+    keeps the fingerprint of its indexes. The matrix is extended in place or compacted (see `dolly.store`), which
+    changes the size. A rewrite with the same number of rows is only detected through the sampled blocks, so rebuild
+    the indexes explicitly after rewriting rows of the matrix in place.
+
+    Args:
+        *filenames (str): Files to hash (in order)
+        sample_size (int): Bytes of each block read
+        num_samples (int): Blocks read between the first and the last bytes of each file
+
+    Returns:
+        str: Hexadecimal digest
+
+    """
+    sha1 = hashlib.sha1()
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        sha1.update('{};'.format(size).encode())
+        with open(filename, 'rb') as f:
+            if size <= (num_samples + 2) * sample_size:
+                sha1.update(f.read())
+                continue
+            step = (size - sample_size) // (num_samples + 1)
+            for offset in [i * step for i in range(num_samples + 1)] + [size - sample_size]:
+                f.seek(offset)
+                sha1.update(f.read(sample_size))
+    return sha1.hexdigest()
+
+
+def build_index(encodings, method=DEFAULT_METHOD, space=DEFAULT_SPACE, index_params=None, print_progress=False,
+                num_threads=0):
+    """Build a nmslib index from a matrix of encodings
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        method (str): nmslib method
+        space (str): nmslib space
+        index_params (:obj:`dict`, optional): Defaults to None. Parameters for `createIndex` (e.g. M, efConstruction)
+        print_progress (bool): Show nmslib progress bar
+        num_threads (int): Defaults to zero (all the cores). Threads used to build the index. It does not change the
+            index, so it is not part of `index_params`
+
+    Returns:
+        nmslib index
+
+    """
+    import nmslib
+
+    index = nmslib.init(method=method, space=space)
+    index.addDataPointBatch(encodings)
+    params = dict(index_params or {})
+    if num_threads:
+        params['indexThreadQty'] = num_threads
+    index.createIndex(params, print_progress=print_progress)
+    return index
+
+
+def save_index(index, index_path, meta):
+    """Save a built index and its metadata (build parameters, fingerprint,...)
+
+    The index is written to a temporary file first, so a crash while saving never leaves a broken artifact behind.
+
+    Args:
+        index: nmslib index
+        index_path (str): Folder where the index will be saved
+        meta (dict): Metadata to save alongside the index
+
+    """
+    if not os.path.isdir(index_path):
+        os.makedirs(index_path)
+
+    index_file = os.path.join(index_path, INDEX_FILENAME)
+
+    index.saveIndex(index_file + '.tmp')
+    os.replace(index_file + '.tmp', index_file)
+    save_index_meta(index_path, meta)
+
+
+def save_index_meta(index_path, meta):
+    """Save (only) the metadata of an index"""
+    meta_file = os.path.join(index_path, META_FILENAME)
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def load_index(index_path, method=DEFAULT_METHOD, space=DEFAULT_SPACE):
+    """Load an index previously saved with `save_index`
+
+    Args:
+        index_path (str): Folder where the index was saved
+        method (str): nmslib method
+        space (str): nmslib space
+
+    Returns:
+        nmslib index
+
+    """
+    import nmslib
+
+    index = nmslib.init(method=method, space=space)
+    index.loadIndex(os.path.join(index_path, INDEX_FILENAME))
+    return index
+
+
+def read_index_meta(index_path):
+    """Read the metadata of a saved index
+
+    Args:
+        index_path (str): Folder where the index was saved
+
+    Returns:
+        dict: Metadata or None if there is no (complete) index artifact
+
+    """
+    index_file = os.path.join(index_path, INDEX_FILENAME)
+    meta_file = os.path.join(index_path, META_FILENAME)
+    if not (os.path.isfile(index_file) and os.path.isfile(meta_file)):
+        return None
+
+    try:
+        with open(meta_file) as f:
+            return json.load(f)
+    except ValueError:  # Corrupted metadata
+        return None
+
+
+def is_index_stale(meta, fingerprint, method=DEFAULT_METHOD, space=DEFAULT_SPACE, index_params=None):
+    """Check if a saved index no longer matches its source encodings or build parameters
+
+    Args:
+        meta (dict): Metadata of the saved index (see `read_index_meta`)
+        fingerprint (str): Fingerprint of the current source encodings
+        method (str): nmslib method
+        space (str): nmslib space
+        index_params (:obj:`dict`, optional): Defaults to None. Parameters for `createIndex`
+
+    Returns:
+        bool
+
+    """
+    if not meta:
+        return True
+    return (meta.get('format') != INDEX_FORMAT or
+            meta.get('fingerprint') != fingerprint or
+            meta.get('method') != method or
+            meta.get('space') != space or
+            meta.get('index_params') != (index_params or {}))
+
+
+def get_index(data_path, encodings_loader, source_files, method=DEFAULT_METHOD, space=DEFAULT_SPACE,
+              index_params=None, rebuild=False, num_threads=0):
+    """Load the index of a dataset from disk, or build it (and save it) if it is missing or stale
+
+    Args:
+        data_path (str): Dataset folder (the index is stored in `{data_path}/index/`)
+        encodings_loader (callable): Returns the matrix of encodings. Only called if the index must be built
+        source_files (list): Files the encodings come from. Their fingerprint is stored with the index
+        method (str): nmslib method
+        space (str): nmslib space
+        index_params (:obj:`dict`, optional): Defaults to None (the parameters of the saved index, if any).
+            Parameters for `createIndex`
+        rebuild (bool): Force the index to be rebuilt
+        num_threads (int): Defaults to zero (all the cores). Threads used to build the index
+
+    Returns:
+        tuple: (nmslib index, metadata)
+
+    """
+    index_path = os.path.join(os.path.normpath(data_path), INDEX_FOLDER)
+    fingerprint = file_fingerprint(*source_files)
+    meta = read_index_meta(index_path)
+    if index_params is None and meta:
+        index_params = meta.get('index_params')
+
+    # Load the saved index if it is still valid
+    if not rebuild and not is_index_stale(meta, fingerprint, method, space, index_params):
+        return load_index(index_path, method, space), meta
+
+    # Build index
+    print('Building index...')
+    start_t = time.time()
+    encodings = encodings_loader()
+    index = build_index(encodings, method, space, index_params, num_threads=num_threads)
+    meta = {'format': INDEX_FORMAT,
+            'method': method,
+            'space': space,
+            'index_params': index_params or {},
+            'fingerprint': fingerprint,
+            'num_items': int(len(encodings)),  # Rows of the matrix in the index (the next ones are searched exactly)
+            'num_updates': 0,
+            'build_time': round(time.time() - start_t, 3),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    # Save it (the dataset could be read-only)
+    try:
+        save_index(index, index_path, meta)
+    except OSError as e:
+        print('The index could not be saved: {}'.format(e))
+    return index, meta
+
+
+def _fetch_encodings(conn, sql, params, chunk_size=10000):
+    ids, encodings = [], []
+    cur = conn.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        ids.extend(row[0] for row in rows)
+        encodings.append(decode_arrays([row[1] for row in rows]))
+    return ids, encodings
+
+
+def _fetch_rewritten(conn, data_path, layout, np_ids, deleted, tolerance=1e-3):
+    # Faces of the matrix whose encoding was rewritten in the DB (see the log `face_updates`), if it really changed
+    # (e.g. not if it was only stored in another format, see `migrate_encodings`)
+    last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM face_updates;').fetchone()[0]
+    logged = np.array([row[0] for row in conn.execute('SELECT DISTINCT face_id FROM face_updates WHERE seq <= ?;',
+                                                      (last_seq,))], dtype=np.int64)
+    logged = np.setdiff1d(np.intersect1d(logged, np_ids), deleted)
+    if not len(logged):
+        return last_seq, [], []
+
+    rows = np.nonzero(np.isin(np_ids, logged))[0]
+    last_row = dict(zip(np_ids[rows].tolist(), rows.tolist()))  # Last row of each face
+    matrix = load_encodings(data_path, layout)
+    changed_ids, changed_encodings = [], []
+    for i in range(0, len(logged), 500):
+        batch = [int(face_id) for face_id in logged[i:i + 500]]
+        sql = 'SELECT id, face_encoding FROM faces WHERE id IN ({}) ORDER BY id;'.format(','.join('?' * len(batch)))
+        b_ids, b_encodings = _fetch_encodings(conn, sql, batch)
+        if not b_ids:
+            continue
+        b_encodings = np.vstack(b_encodings)
+        old = np.asarray(matrix[[last_row[face_id] for face_id in b_ids]], dtype=np.float32)
+        changed = np.abs(b_encodings - old).max(axis=1) > tolerance
+        changed_ids.extend(face_id for face_id, c in zip(b_ids, changed) if c)
+        changed_encodings.append(b_encodings[changed])
+    return last_seq, changed_ids, changed_encodings
+
+
+def update_index(database, data_path, index_params=None, rebuild=False, rebuild_fraction=0.1, max_delta_fraction=0.2):
+    """Bring the matrix and the index of a dataset up to date with the DB, incrementally
+
+    Faces with an ID above the high-water mark of the matrix (its maximum ID), that got an encoding after the last
+    export, or whose encoding was rewritten (logged by a trigger, see `dolly.schema`), are appended to the matrix (the
+    old row of a rewritten face is no longer searched, see `alive_rows`). Faces deleted from the DB are recorded as
+    tombstones. The HNSW index cannot
+    grow once built, so the new rows are searched exactly by `Finder` until the next rebuild.
+
+    A full rebuild (deleted rows are removed from the matrix) is done if requested, if deletes and updates exceed
+    `rebuild_fraction` of the indexed faces, or if the rows pending to be indexed exceed `max_delta_fraction`. The
+    shards of the dataset (if any) are updated or rebuilt the same way (see `dolly.shards`), so a sharded dataset
+    never needs the single index.
+
+    Args:
+        database (str): Path to the SQLite database
+        data_path (str): Dataset folder
+        index_params (:obj:`dict`, optional): Defaults to None. Parameters for `createIndex`
+        rebuild (bool): Force a full rebuild
+        rebuild_fraction (float): Fraction of deletes/updates that triggers a full rebuild
+        max_delta_fraction (float): Fraction of rows pending to be indexed that triggers a full rebuild
+
+    Returns:
+        dict: Summary of the update (appended, updated, deleted, rebuilt)
+
+    """
+    layout, ids_file, encodings_file = matrix_files(data_path)
+    fingerprint = file_fingerprint(encodings_file, ids_file) if os.path.isfile(encodings_file) else None
+    np_ids = load_ids(data_path, layout)
+    deleted = load_deleted(data_path, layout)
+    high_water = int(np_ids.max()) if len(np_ids) else 0
+
+    # Compare the faces of the DB with the faces of the matrix (only IDs)
+    conn = create_connection(database)
+    migrate_schema(conn)  # Log of the rewritten encodings
+    db_ids = np.array([row[0] for row in conn.execute('SELECT id FROM faces WHERE face_encoding IS NOT NULL;')],
+                      dtype=np.int64)
+    old_ids = db_ids[db_ids <= high_water]
+    updated_ids = old_ids[~np.isin(old_ids, np_ids)]  # Encoded after the last export
+    removed_ids = np_ids[~np.isin(np_ids, db_ids)]
+    new_deleted = np.setdiff1d(removed_ids, deleted)
+
+    # Append new faces (above the high-water mark) and updated faces
+    ids, encodings = _fetch_encodings(conn, 'SELECT id, face_encoding FROM faces WHERE id > ? AND '
+                                            'face_encoding IS NOT NULL ORDER BY id;', (high_water,))
+    for i in range(0, len(updated_ids), 500):
+        batch = [int(face_id) for face_id in updated_ids[i:i + 500]]
+        sql = 'SELECT id, face_encoding FROM faces WHERE id IN ({}) ORDER BY id;'.format(','.join('?' * len(batch)))
+        b_ids, b_encodings = _fetch_encodings(conn, sql, batch)
+        ids.extend(b_ids)
+        encodings.extend(b_encodings)
+
+    # Append again the faces whose encoding was rewritten (see `alive_rows`)
+    last_seq, changed_ids, changed_encodings = _fetch_rewritten(conn, data_path, layout, np_ids,
+                                                                np.concatenate((deleted, new_deleted)))
+    ids.extend(changed_ids)
+    encodings.extend(changed_encodings)
+
+    if ids:
+        append_matrix(data_path, ids, np.vstack(encodings), layout)
+    if len(new_deleted):
+        save_deleted(data_path, np.concatenate((deleted, new_deleted)), layout)
+    with conn:  # The rewritten encodings are in the matrix now
+        conn.execute('DELETE FROM face_updates WHERE seq <= ?;', (last_seq,))
+    conn.close()
+
+    num_updated = len(updated_ids) + len(changed_ids)
+    summary = {'appended': len(ids) - num_updated, 'updated': int(num_updated),
+               'deleted': int(len(new_deleted)), 'rebuilt': False}
+
+    # Update the metadata of the index and of the shards, or rebuild them. Only the ones built from the matrix before
+    # this update are still valid (a stale one is rebuilt when it is loaded)
+    from dolly.shards import read_shards_plan, save_shards_plan, plan_shards, build_shards
+    index_path = os.path.join(os.path.normpath(data_path), INDEX_FOLDER)
+    meta = read_index_meta(index_path)
+    plan = read_shards_plan(data_path)
+    meta_valid = bool(meta) and meta.get('fingerprint') == fingerprint
+    plan_valid = bool(plan) and plan.get('fingerprint') == fingerprint
+    if (meta_valid or plan_valid) and not rebuild:
+        base = meta if meta_valid else plan
+        num_items = max(base['num_items'], 1)
+        num_changes = len(deleted) + len(new_deleted) + base.get('num_updates', 0) + num_updated
+        num_pending = len(np_ids) + len(ids) - base['num_items']
+        rebuild = num_changes > rebuild_fraction * num_items or num_pending > max_delta_fraction * num_items
+
+    if (meta_valid or plan_valid) and not rebuild:
+        _, ids_file, encodings_file = matrix_files(data_path, layout)
+        fingerprint = file_fingerprint(encodings_file, ids_file)
+        if meta_valid:
+            meta['fingerprint'] = fingerprint
+            meta['num_updates'] = meta.get('num_updates', 0) + int(num_updated)
+            save_index_meta(index_path, meta)
+        if plan_valid:
+            plan['fingerprint'] = fingerprint
+            plan['num_updates'] = plan.get('num_updates', 0) + int(num_updated)
+            save_shards_plan(data_path, plan)
+    else:
+        compact_matrix(data_path, layout)
+        _, ids_file, encodings_file = matrix_files(data_path, layout)
+        if meta or not plan:
+            get_index(data_path, encodings_loader=lambda: load_encodings(data_path, layout),
+                      source_files=[encodings_file, ids_file], index_params=index_params, rebuild=True)
+        if plan:  # Same number of shards, over the new matrix
+            plan_shards(data_path, plan['num_shards'],
+                        index_params=plan['index_params'] if index_params is None else index_params)
+            build_shards(data_path)
+        summary['rebuilt'] = True
+    return summary
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import csv
+import time
+from functools import partial
+
+from dolly.db import *
+from dolly.schema import migrate_schema
+from dolly.utils import *
+
+__all__ = ['read_tsv', 'get_checkpoint', 'save_checkpoint', 'process_face', 'ingest_faces']
+
+SQLs = {'add': 'INSERT INTO faces(image_name, face_location, freebase_mid, face_encoding, image_search_rank, '
+               'image_url, hard_face) VALUES(?, ?, ?, ?, ?, ?, ?);',
+        'update': 'UPDATE faces SET face_location=?, face_encoding=?, hard_face=? WHERE id=?;',
+        'entity_summary': 'SELECT total, encodings FROM entity_summary WHERE freebase_mid=?;',
+        'entity_faces': 'SELECT id, image_name, image_search_rank FROM faces WHERE freebase_mid=?;',
+        'entity_pending_faces': 'SELECT id, image_name, image_search_rank FROM faces WHERE freebase_mid=? AND '
+                                'face_encoding IS NULL AND coalesce(hard_face, 0) = 0;',
+        'get_checkpoint': 'SELECT offset FROM ingest_checkpoints WHERE filename=?;',
+        'save_checkpoint': 'INSERT OR REPLACE INTO ingest_checkpoints(filename, offset, updated_at) VALUES (?, ?, ?);'}
+
+
+def read_tsv(filename, offset=0, **csvkargs):
+    """Read a TSV file from a byte offset
+
+    Args:
+        filename (str): Path to the TSV file
+        offset (int): Byte offset where the reading starts (e.g. a checkpoint)
+        **csvkargs: Args for `csv.reader`
+
+    Yields:
+        tuple: (byte offset of the end of the row, row)
+
+    """
+    csvkargs = dict({'delimiter': '\t', 'quoting': csv.QUOTE_NONE}, **csvkargs)
+    csv.field_size_limit(sys.maxsize)  # The images are base64 fields (larger than the default limit of 128KB)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for line in iter(f.readline, b''):
+            offset += len(line)
+            row = next(csv.reader([line.decode('utf-8')], **csvkargs), None)
+            if row:
+                yield offset, row
+
+
+def get_checkpoint(conn, filename):
+    """Get the byte offset of the last row committed from a file (0 if there is none)"""
+    row = conn.execute(SQLs['get_checkpoint'], (os.path.basename(filename),)).fetchone()
+    return row[0] if row else 0
+
+
+def save_checkpoint(cur, filename, offset):
+    """Save the byte offset of the last row committed from a file (call it within the transaction of the rows)"""
+    cur.execute(SQLs['save_checkpoint'], (os.path.basename(filename), offset, time.strftime('%Y-%m-%dT%H:%M:%S')))
+
+
+def _save_face_image(faces_folder, freebase_mid, isr, img):
+    celeb_folder = os.path.join(os.path.normpath(faces_folder), freebase_mid)
+    if not os.path.isdir(celeb_folder):
+        os.makedirs(celeb_folder, exist_ok=True)
+    img.save(os.path.join(celeb_folder, '{}-FaceId-0.jpg'.format(isr)))
+
+
+def process_face(task, encode_face=True, faces_folder=None):
+    """Decode a face of the MS-Celeb TSV, detect it and encode it (runs in the workers)
+
+    Args:
+        task (tuple): (action ('a': add, 'u': update), row, face_id or None)
+        encode_face (bool): Compute the encoding of the face
+        faces_folder (:obj:`str`, optional): Defaults to None. Folder where the images of the faces are saved
+
+    Returns:
+        tuple: Values for the SQL of the action (None if the image cannot be decoded)
+
+    """
+    # Column1: Image ID
+    # Column2: FaceData_Base64Encoded
+    # Column3: Freebase MID
+    # Column4: ImageSearchRank
+    # Column5: ImageURL
+    import face_recognition
+    action, row, face_id = task
+
+    # Decode image in base64. A corrupt row is skipped, so it never stops the job (binascii.Error is a ValueError and
+    # PIL.UnidentifiedImageError an OSError)
+    try:
+        img = decode_b64_image(row[1])
+        np_image = np.array(img)
+    except (ValueError, OSError) as e:
+        print('- Skipped row {} (the image cannot be decoded: {})'.format(row[0], e))
+        return None
+
+    face_location = encoding = None
+    try:
+        face_location = face_recognition.face_locations(np_image)[0]
+        encoding = face_recognition.face_encodings(np_image, [face_location])[0] if encode_face else None
+        hard_face = False
+        if faces_folder:
+            _save_face_image(faces_folder, freebase_mid=row[2], isr=row[3], img=img)
+    except IndexError:  # Face not found with HOG. Try with CNN?
+        hard_face = True
+
+    if action == 'a':
+        return row[0], str(face_location), row[2], encoding, row[3], row[4], hard_face
+    elif action == 'u':
+        return str(face_location), encoding, hard_face, face_id
+    else:
+        raise KeyError('Unknown action')
+
+
+def _entity_encodings(cur, freebase_mid):
+    # Number of encodings of an entity (None if it has no faces)
+    row = cur.execute(SQLs['entity_summary'], (freebase_mid,)).fetchone()
+    return row[1] if row and row[0] else None
+
+
+def _entity_faces(cur, freebase_mid):
+    # Faces of an entity in the DB: {(image_name, image_search_rank): ID if it is pending to be encoded, else None}
+    faces = {(row[1], str(row[2])): None for row in cur.execute(SQLs['entity_faces'], (freebase_mid,))}
+    for face_id, image_name, isr in cur.execute(SQLs['entity_pending_faces'], (freebase_mid,)):
+        faces[(image_name, str(isr))] = face_id
+    return faces
+
+
+def _plan_faces(rows, cur, index_encodings, min_num_encodings):
+    # Decide what to do with each row: add the face, update it (it has no encoding yet) or skip it. The counts of an
+    # entity are read once (see `entity_summary`), and its faces once per run of rows of the entity.
+    # The rows are planned ahead of the writer (up to the faces in flight in the pool), and the encodings of an entity
+    # are only counted once written, so `min_num_encodings` can be exceeded by up to that window. The faces in flight
+    # are not counted as encodings on purpose: some of them turn out to be hard faces (no encoding), and the rows
+    # skipped because of them would leave the entity short
+    faces_mid, faces = None, {}
+    for offset, row in rows:
+        if row[2] not in index_encodings:
+            index_encodings[row[2]] = _entity_encodings(cur, row[2])
+        total_encodings = index_encodings[row[2]]
+
+        if total_encodings is None:  # [ADD] Entity doesn't exist
+            yield offset, ('a', row, None)
+            continue
+        elif total_encodings >= min_num_encodings:  # Entity has enough encodings
+            continue
+
+        # Does the face really exist in our DB?
+        if faces_mid != row[2]:
+            faces_mid, faces = row[2], _entity_faces(cur, row[2])
+        key = (row[0], str(row[3]))
+        if key not in faces:  # [ADD] Face doesn't exist
+            yield offset, ('a', row, None)
+        elif faces[key] is not None:  # [UPDATE] (no encoding and no hard/null)
+            yield offset, ('u', row, faces[key])
+
+
+def ingest_faces(filename, database, faces_folder=None, workers=1, buffer=1000, min_num_encodings=1, resume=True):
+    """Load the faces of a MS-Celeb TSV file into the database
+
+    The job is a pipeline of three stages: rows are parsed and planned (add/update/skip) in this process, decoded,
+    detected and encoded in a pool of processes, and written to the DB in batches. The byte offset of the last row
+    committed is saved in the same transaction, so a restart resumes from there. The schema of the DB is migrated
+    first (see `dolly.schema`): the counts of each entity and its faces are read through its indexes, so there is no
+    scan of the faces at start nor a query per row.
+
+    Args:
+        filename (str): Path to the TSV file
+        database (str): Path to the SQLite database
+        faces_folder (:obj:`str`, optional): Defaults to None. Folder where the images of the faces are saved
+        workers (int): Number of processes used to decode, detect and encode the faces
+        buffer (int): Faces per commit
+        min_num_encodings (int): Entities with this number of encodings are skipped (0 = don't encode faces). With
+            several workers, an entity can get up to `2 * workers` extra encodings (the faces in flight)
+        resume (bool): Start from the last checkpoint of the file
+
+    Returns:
+        tuple: (faces added, faces updated)
+
+    """
+    migrate_schema(database)
+    conn = create_connection(database)
+
+    # Number of encodings of the entities seen (read from `entity_summary` as they appear)
+    index_encodings = {}  # {key => num_encodings}
+    offset = get_checkpoint(conn, filename) if resume else 0
+    if offset:
+        print('Resuming from byte {}...'.format(offset))
+
+    # Pipeline: parse => plan => (pool) decode/detect/encode => write
+    tasks = _plan_faces(read_tsv(filename, offset), conn.cursor(), index_encodings, min_num_encodings)
+    func = partial(_process_planned, encode_face=min_num_encodings > 0, faces_folder=faces_folder)
+    results = imap_ordered(func, tasks, workers=workers)
+
+    data_add, data_update = [], []
+    num_added = num_updated = num_commits = 0
+    last_offset = None
+    for (row_offset, (action, row, face_id)), values in results:
+        if values is None:  # Corrupt row
+            continue
+        if action == 'a':
+            data_add.append(values)
+            b_encoding = values[3] is not None
+        else:
+            data_update.append(values)
+            b_encoding = values[1] is not None
+        index_encodings[row[2]] = (index_encodings.get(row[2]) or 0) + (1 if b_encoding else 0)
+        last_offset = row_offset
+
+        # Commit the batch and the checkpoint atomically
+        if len(data_add) + len(data_update) >= buffer:
+            num_commits += 1
+            _commit_faces(conn, filename, data_add, data_update, last_offset, num_commits)
+            num_added, num_updated = num_added + len(data_add), num_updated + len(data_update)
+            data_add, data_update = [], []
+
+    if last_offset is not None and (data_add or data_update):
+        num_commits += 1
+        _commit_faces(conn, filename, data_add, data_update, last_offset, num_commits)
+        num_added, num_updated = num_added + len(data_add), num_updated + len(data_update)
+
+    conn.close()
+    print('Finished!')
+    return num_added, num_updated
+
+
+def _commit_faces(conn, filename, data_add, data_update, offset, num_commit):
+    with conn:
+        cur = conn.cursor()
+        cur.executemany(SQLs['add'], data_add)
+        cur.executemany(SQLs['update'], data_update)
+        save_checkpoint(cur, filename, offset)
+    print("- Commit #{}\t\t(offset: {}, Added: {}, Modified: {})".format(num_commit, offset, len(data_add),
+                                                                         len(data_update)))
+
+
+def _process_planned(planned, encode_face=True, faces_folder=None):
+    offset, task = planned
+    return process_face(task, encode_face=encode_face, faces_folder=faces_folder)
@@ -2,21 +2,52 @@
 # -*- coding: utf-8 -*-
 
 import uuid
-
-import face_recognition
-from PIL import Image, ImageDraw
-from googleapiclient.discovery import build
+import json
+from functools import partial
+from contextlib import redirect_stdout
 
 from dolly.utils import *
 
+# face_recognition (dlib models), PIL and the Google API client are imported by the functions that need them, so
+# importing dolly (e.g. to run its CLI) stays fast
+
+
+def detect_faces(image, scale=1.0, model='hog'):
+    """Find all faces in an image, detecting them in a downscaled copy of it
+
+    Args:
+        image (str or numpy ndarray): Filename (JPEG files are decoded at reduced scale) or image
+        scale (float): Defaults to one (full resolution). Scale factor of the image used to detect the faces
+        model (str): 'hog' or 'cnn'
+
+    Returns:
+        list: Face locations in the full-resolution image
+
+    """
+    import face_recognition
+
+    if scale == 1:
+        np_image = image_loader(image)
+        with stage('face_locations'):
+            return face_recognition.face_locations(np_image, model=model)
+
+    np_small, factors = image_loader_scaled(image, scale)
+    with stage('face_locations'):
+        face_locations = face_recognition.face_locations(np_small, model=model)
+    shape = (int(round(np_small.shape[0] / factors[0])), int(round(np_small.shape[1] / factors[1])))
+    return scale_locations(face_locations, factors, shape)
 
-def findfaces(np_image, save_path=None, prefix_name=None, **kwargs):
+
+def findfaces(np_image, save_path=None, prefix_name=None, face_locations=None, scale=1.0, **kwargs):
     """Find all faces in an image
 
     Args:
         np_image (numpy ndarray): A Numpy matrix that represents the image
         save_path (:obj:`str`, optional): Defaults to None. Path to save the faces faound.
         prefix_name: (:obj:`str`, optional): Defaults to None. Prefix for the faces to be saved.
+        face_locations: (:obj:`list`, optional): Defaults to None. Face locations already detected (e.g. by a server).
+        scale: (:obj:`float`, optional): Defaults to one. Scale of the image used to detect the faces (crops are
+            always taken from the full-resolution image).
 
     Returns:
         list: Face locations
@@ -24,7 +55,8 @@ def findfaces(np_image, save_path=None, prefix_name=None, **kwargs):
     """
 
     # Get attributes
-    face_locations = face_recognition.face_locations(np_image)
+    if face_locations is None:
+        face_locations = detect_faces(np_image, scale=scale)
 
     # For each faces
     for i in range(0, len(face_locations)):
@@ -39,25 +71,32 @@ def findfaces(np_image, save_path=None, prefix_name=None, **kwargs):
                 prefix_name = str(uuid.uuid1())
 
             path = os.path.normpath(save_path) + '/' + prefix_name + '_face_' + str(i) + '.jpg'
-            crop_image(np_image, face_locations[i], path)
+            with stage('crop_image'):
+                crop_image(np_image, face_locations[i], path)
 
     return face_locations
 
 
-def draw_boxes(np_image, save_path=None, **kwargs):
+def draw_boxes(np_image, save_path=None, face_locations=None, **kwargs):
     """Draw boxes to highlight each face in an image
 
     Args:
         np_image (numpy ndarray): A Numpy matrix that represents the image
         save_path (:obj:`str`, optional): Defaults to None. Path to save the faces faound.
+        face_locations: (:obj:`list`, optional): Defaults to None. Face locations already detected.
 
     Returns:
         tuple: PIL image, List of face locations
 
     """
 
+    from PIL import Image, ImageDraw
+
     # Find all the faces
-    face_locations = face_recognition.face_locations(np_image)
+    if face_locations is None:
+        import face_recognition
+        with stage('face_locations'):
+            face_locations = face_recognition.face_locations(np_image)
 
     # Convert the image to a PIL-format image so that we can draw on top of it with the Pillow library
     # See http://pillow.readthedocs.io/ for more about PIL/Pillow
@@ -84,12 +123,13 @@ def draw_boxes(np_image, save_path=None, **kwargs):
     return pil_image, face_locations
 
 
-def draw_landmarks(np_image, save_path=None, **kwargs):
+def draw_landmarks(np_image, save_path=None, face_landmarks_list=None, **kwargs):
     """Draw landmarks to highlight the features of each face in an image
 
     Args:
         np_image (numpy ndarray): A Numpy matrix that represents the image
         save_path (:obj:`str`, optional): Defaults to None. Path to save the faces faound.
+        face_landmarks_list: (:obj:`list`, optional): Defaults to None. Face landmarks already computed.
 
     Returns:
         tuple: PIL image, List of face landmarks
@@ -107,8 +147,13 @@ def draw_landmarks(np_image, save_path=None, **kwargs):
         'bottom_lip'
     ]
 
+    from PIL import Image, ImageDraw
+
     # Find all facial features in all the faces in the image
-    face_landmarks_list = face_recognition.face_landmarks(np_image)
+    if face_landmarks_list is None:
+        import face_recognition
+        with stage('face_landmarks'):
+            face_landmarks_list = face_recognition.face_landmarks(np_image)
 
     # Convert the image to a PIL-format image so that we can draw on top of it with the Pillow library
     # See http://pillow.readthedocs.io/ for more about PIL/Pillow
@@ -132,13 +177,35 @@ def draw_landmarks(np_image, save_path=None, **kwargs):
     return pil_image, face_landmarks_list
 
 
-def findfacesdir(directory, save_path, max_faces=0, **kwargs):
+def _findfaces_file(filename, save_path, scale=1.0, server=None):
+    """Find (and save) the faces of an image file. Returns its face locations and the output of `findfaces`"""
+    f_name, f_ext = os.path.splitext(os.path.basename(filename))
+    output = io.StringIO()
+    with redirect_stdout(output):
+        if server or scale < 1:  # The full image is only decoded if there are faces to crop
+            if server:
+                from dolly.server import remote_face_locations
+                face_locations = remote_face_locations(server, filename)
+            else:
+                face_locations = detect_faces(filename, scale=scale)
+            np_image = image_loader(filename) if save_path and face_locations else None
+            findfaces(np_image, save_path, prefix_name=f_name, face_locations=face_locations)
+        else:
+            face_locations = findfaces(image_loader(filename), save_path, prefix_name=f_name)
+    return face_locations, output.getvalue()
+
+
+def findfacesdir(directory, save_path, max_faces=0, workers=1, scale=1.0, server=None, **kwargs):
     """Find all faces in a directory
 
     Args:
         directory (str): Path where look for the images to analyze.
         save_path (str): Path where the faces found will be saved.
         max_faces: (:obj:`int`, optional): Defaults to zero. Maximum number of faces to extract from the directory.
+        workers: (:obj:`int`, optional): Defaults to one. Number of processes used to analyze the images.
+        scale: (:obj:`float`, optional): Defaults to one. Scale of the images used to detect the faces.
+        server: (:obj:`str`, optional): Defaults to None. URL of a running dolly server that detects the faces (the
+            faces are cropped here).
 
     Returns:
         int: Number of faces found
@@ -146,15 +213,17 @@ def findfacesdir(directory, save_path, max_faces=0, **kwargs):
     """
 
     num_faces = 0
-    for filename in images_in_path(directory):
+    results = imap_ordered(partial(_findfaces_file, save_path=save_path, scale=scale, server=server),
+                           images_in_path(directory), workers=workers)
+    for filename, (face_locations, output) in results:  # Results in order (whatever the number of workers)
         f_head, f_tail = os.path.split(filename)  # File data
-        f_name, f_ext = os.path.splitext(f_tail)
 
         print('Finding faces (%d) in: %s' % (num_faces+1, f_tail))
-        face_locations = findfaces(image_loader(filename), save_path, prefix_name=f_name)
+        print(output, end='')
         num_faces += len(face_locations)
 
         if max_faces != 0 and num_faces > max_faces:  # Stop
+            results.close()  # Cancel the images not started yet
             break
 
     print('Finished.')
@@ -162,26 +231,106 @@ def findfacesdir(directory, save_path, max_faces=0, **kwargs):
     return num_faces
 
 
-def analyze_face(np_image, model='hog'):
+def analyze_faces(np_image, model='hog', max_faces=0, landmarks=True, encodings=True, face_locations=None,
+                  scale=1.0):
+    """Get face locations, landmarks and encodings of all the faces in an image
+
+    Faces are detected once, and the landmarks and encodings of all of them are computed from those detections (one
+    call per stage for all the faces). The encodings use the 5-point shape of each face, like the encodings of the
+    datasets, and the landmarks the 68-point shape.
+
+        Args:
+            np_image (numpy ndarray): A Numpy matrix that represents the image
+            model (str): 'hog' or 'cnn'
+            max_faces (int): Defaults to zero (all). Maximum number of faces to analyze
+            landmarks (bool): Compute the landmarks of the faces
+            encodings (bool): Compute the encodings of the faces
+            face_locations: (:obj:`list`, optional): Defaults to None. Face locations already detected
+            scale (float): Defaults to one. Scale of the image used to detect the faces (landmarks and encodings are
+                computed on the full-resolution image)
+
+        Returns:
+            list: (face location, face landmarks, face encoding) of each face (None if not computed)
+
+    """
+
+    import face_recognition
+
+    # Find all faces (once)
+    if face_locations is None:
+        face_locations = detect_faces(np_image, scale=scale, model=model)
+    face_locations = list(face_locations[:max_faces] if max_faces else face_locations)
+    if not face_locations:
+        return []
+
+    # Derive the features of all the faces from the same detections
+    face_landmarks = face_encodings = [None] * len(face_locations)
+    if landmarks:
+        with stage('face_landmarks', count=len(face_locations)):
+            face_landmarks = face_recognition.face_landmarks(np_image, face_locations)
+    if encodings:
+        with stage('face_encodings', count=len(face_locations)):
+            face_encodings = face_recognition.face_encodings(np_image, face_locations)
+    return list(zip(face_locations, face_landmarks, face_encodings))
+
+
+def analyze_face(np_image, model='hog', scale=1.0):
     """Get face locations, landmarks and encodings from the first found face
 
         Args:
             np_image (numpy ndarray): A Numpy matrix that represents the image
             model (str): 'hog' or 'cnn'
+            scale (float): Defaults to one. Scale of the image used to detect the faces
 
         Returns:
             tuple: (list of face locations, list of face landmarks, list of face encodings)
 
     """
+    faces = analyze_faces(np_image, model=model, max_faces=1, scale=scale)
+    return faces[0] if faces else (None, None, None)
+
+
+def annotate(np_image, save_path, prefix_name=None, model='hog', scale=1.0, **kwargs):
+    """Find all faces in an image and save their boxes, landmarks, crops and a JSON sidecar, detecting them only once
+
+    Files saved in `save_path`:
+        {prefix}_boxes.jpg: Image with the boxes of the faces
+        {prefix}_landmarks.jpg: Image with the landmarks of the faces
+        {prefix}_face_{i}.jpg: Crop of each face
+        {prefix}.json: Location, landmarks and encoding of each face
+
+    Args:
+        np_image (numpy ndarray): A Numpy matrix that represents the image
+        save_path (str): Path where the files will be saved.
+        prefix_name: (:obj:`str`, optional): Defaults to None. Prefix of the files.
+        model (str): 'hog' or 'cnn'
+        scale (float): Defaults to one. Scale of the image used to detect the faces
+
+    Returns:
+        list: (face location, face landmarks, face encoding) of each face
+
+    """
+    prefix_name = prefix_name or str(uuid.uuid1())
+    prefix_path = os.path.join(os.path.normpath(save_path), prefix_name)
+
+    faces = analyze_faces(np_image, model=model, scale=scale)
+    face_locations = [face[0] for face in faces]
 
-    # Find all facial features
-    face_locations = face_recognition.face_locations(np_image, model=model)
-    if len(face_locations):
-        face_location = face_locations[0]
-        face_landmarks = face_recognition.face_landmarks(np_image, [face_location])[0]
-        face_encoding = face_recognition.face_encodings(np_image, [face_location])[0]
-        return face_location, face_landmarks, face_encoding
-    return None, None, None
+    with stage('annotate.draw'):
+        draw_boxes(np_image, prefix_path + '_boxes.jpg', face_locations=face_locations)
+        draw_landmarks(np_image, prefix_path + '_landmarks.jpg', face_landmarks_list=[face[1] for face in faces])
+    findfaces(np_image, save_path, prefix_name=prefix_name, face_locations=face_locations)
+
+    # Sidecar
+    sidecar = {'image_shape': list(np_image.shape), 'model': model,
+               'faces': [{'face_location': list(location),
+                          'face_landmarks': {feature: [list(point) for point in points]
+                                             for feature, points in landmarks.items()},
+                          'face_encoding': [float(x) for x in encoding]}
+                         for location, landmarks, encoding in faces]}
+    with open(prefix_path + '.json', 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    return faces
 
 
 def get_more_info(api_key, freebase=True, **kwargs):
@@ -195,6 +344,8 @@ def get_more_info(api_key, freebase=True, **kwargs):
             dict
 
     """
+    from googleapiclient.discovery import build
+
     if freebase:
         kwargs['ids'] = '/' + kwargs['ids'].replace('.', '/')
 
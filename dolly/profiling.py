@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from contextlib import contextmanager
+
+__all__ = ['stage', 'add_hook', 'remove_hook', 'Profile']
+
+# Callbacks `hook(stage_name, seconds, count)` called at the end of each stage. Without hooks, stages are not timed
+_hooks = []
+
+
+class _NullStage:
+    # Shared no-op context, so a disabled stage costs a function call and an `if`
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+@contextmanager
+def _timed_stage(name, count):
+    start_t = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_t
+        for hook in list(_hooks):
+            hook(name, elapsed, count)
+
+
+def stage(name, count=1):
+    """Time a stage of the pipeline (only if there is a hook registered)
+
+    Example:
+        with stage('face_locations'):
+            face_locations = face_recognition.face_locations(np_image)
+
+    Args:
+        name (str): Name of the stage
+        count (int): Number of items processed by the stage (e.g. faces in a batch)
+
+    Returns:
+        Context manager
+
+    """
+    if not _hooks:
+        return _NULL_STAGE
+    return _timed_stage(name, count)
+
+
+def add_hook(hook):
+    """Register a callback `hook(stage_name, seconds, count)` that receives the timing of every stage"""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a callback added with `add_hook`"""
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+class Profile:
+    """Collect the timings of the stages run within a block (or between `start` and `stop`)
+
+    The stages run by other processes (e.g. the workers of `findfacesdir`) are not collected.
+
+    Example:
+        with Profile() as profile:
+            res = f.findclones(face_encoding=f_enc, top_k=10)
+        profile.print_report()
+
+    """
+
+    def __init__(self):
+        self.stats = {}  # {stage_name: [calls, items, total seconds, max seconds]}
+        self.lock = threading.Lock()
+
+    def __call__(self, name, elapsed, count=1):
+        with self.lock:
+            stats = self.stats.setdefault(name, [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += count
+            stats[2] += elapsed
+            stats[3] = max(stats[3], elapsed)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        add_hook(self)
+
+    def stop(self):
+        remove_hook(self)
+
+    def report(self):
+        """Timings per stage: {stage_name: {'calls', 'items', 'total', 'mean', 'max'}} (seconds)"""
+        return {name: {'calls': calls, 'items': items, 'total': total, 'mean': total / calls, 'max': max_t}
+                for name, (calls, items, total, max_t) in self.stats.items()}
+
+    def print_report(self):
+        print('Profile:')
+        for name, s in sorted(self.report().items(), key=lambda x: -x[1]['total']):
+            values = (name, s['total'] * 1000, s['calls'], s['items'], s['mean'] * 1000, s['max'] * 1000)
+            print('\t- {}: {:.2f}ms\t(calls: {}, items: {}, mean: {:.2f}ms, max: {:.2f}ms)'.format(*values))
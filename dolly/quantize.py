@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+
+import numpy as np
+
+from dolly.index import INDEX_FOLDER, file_fingerprint
+from dolly.search import sq_euclidean_distances
+
+__all__ = ['COMPRESSIONS', 'train_pq', 'pq_encode', 'CompressedMatrix', 'build_compressed', 'save_compressed',
+           'load_compressed', 'get_compressed']
+
+COMPRESSIONS = ('float16', 'pq')
+COMPRESSED_FORMAT = 1
+
+DEFAULT_PQ_PARAMS = {'num_subvectors': 16, 'num_centroids': 256, 'iterations': 20, 'sample_size': 100000}
+
+
+def _sq_distances(x, centroids):
+    # Squared euclidean distances (n, k) between the rows of two matrices
+    return (np.sum(x ** 2, axis=1)[:, None] - 2.0 * np.dot(x, centroids.T) +
+            np.sum(centroids ** 2, axis=1)[None, :])
+
+
+def _kmeans(x, k, iterations=20, rng=None, chunk_size=50000):
+    # Lloyd's algorithm. Empty clusters are moved to random points
+    rng = rng or np.random.RandomState(0)
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iterations):
+        labels = np.concatenate([np.argmin(_sq_distances(x[i:i + chunk_size], centroids), axis=1)
+                                 for i in range(0, len(x), chunk_size)])
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=x[:, j], minlength=k) for j in range(x.shape[1])], axis=1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty][:, None]
+        centroids[empty] = x[rng.choice(len(x), int(np.sum(empty)))]
+    return centroids
+
+
+def train_pq(encodings, num_subvectors=16, num_centroids=256, iterations=20, sample_size=100000, seed=0):
+    """Train the codebooks of a product quantizer
+
+    Each encoding is split in `num_subvectors` sub-vectors, and each sub-vector is replaced by the index of its closest
+    centroid (k-means) in the codebook of its subspace.
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        num_subvectors (int): Number of subspaces (bytes per code). It must divide the dimensions
+        num_centroids (int): Centroids per subspace (up to 256, so each one fits in a byte)
+        iterations (int): Iterations of k-means
+        sample_size (int): Encodings used to train
+        seed (int): Random seed
+
+    Returns:
+        numpy ndarray: Codebooks (num_subvectors, num_centroids, dims / num_subvectors)
+
+    """
+    dims = encodings.shape[1]
+    if dims % num_subvectors:
+        raise ValueError('The number of subvectors must divide the dimensions ({})'.format(dims))
+    if not 0 < num_centroids <= 256:
+        raise ValueError('The number of centroids must be in [1, 256]')
+
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(len(encodings), min(sample_size, len(encodings)), replace=False)
+    sample = np.asarray(encodings[np.sort(sample)], dtype=np.float32)
+
+    sub_dims = dims // num_subvectors
+    return np.stack([_kmeans(sample[:, m * sub_dims:(m + 1) * sub_dims], num_centroids, iterations, rng)
+                     for m in range(num_subvectors)]).astype(np.float32)
+
+
+def pq_encode(encodings, codebooks, chunk_size=50000):
+    """Encode a matrix of encodings as product-quantized codes (n, num_subvectors) of uint8"""
+    num_subvectors, _, sub_dims = codebooks.shape
+    codes = np.empty((len(encodings), num_subvectors), dtype=np.uint8)
+    for start in range(0, len(encodings), chunk_size):
+        block = np.asarray(encodings[start:start + chunk_size], dtype=np.float32)
+        for m in range(num_subvectors):
+            sub = block[:, m * sub_dims:(m + 1) * sub_dims]
+            codes[start:start + len(block), m] = np.argmin(_sq_distances(sub, codebooks[m]), axis=1)
+    return codes
+
+
+class CompressedMatrix:
+    """Compressed copy of the encoding matrix ('float16' or product-quantized 'pq' codes)
+
+    Distances are approximations of the euclidean distance. For 'pq', the distance between a face and a code is
+    computed with a lookup table of the distances between the face and the centroids (asymmetric distance).
+    """
+
+    def __init__(self, kind, data, codebooks=None, meta=None):
+        if kind not in COMPRESSIONS:
+            raise KeyError('Unknown compression')
+        self.kind = kind
+        self.data = data  # float16 matrix (n, dims) or codes (n, num_subvectors)
+        self.codebooks = codebooks
+        self.meta = meta or {}
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.codebooks.nbytes if self.codebooks is not None else 0)
+
+    def distance_table(self, face_encodings):
+        """Squared distances (m, num_subvectors, num_centroids) between the faces (m, dims) and the centroids ('pq'
+        only)"""
+        num_subvectors, _, sub_dims = self.codebooks.shape
+        sub_faces = np.asarray(face_encodings, dtype=np.float32).reshape(-1, num_subvectors, 1, sub_dims)
+        return np.sum((self.codebooks[None] - sub_faces) ** 2, axis=3)
+
+    def distances(self, face_encodings, start=0, end=None, tables=None):
+        """Approximate euclidean distances between several faces and the rows [start, end) of the matrix
+
+        The block is decoded once for all the faces: 'float16' rows are converted to float32 once and the distances
+        to all the faces are a single matrix product (see `sq_euclidean_distances`).
+
+        Args:
+            face_encodings (numpy ndarray): Matrix (m, dims) of face encodings
+            start (int): First row
+            end (:obj:`int`, optional): Defaults to None (last row). End of the rows
+            tables (:obj:`numpy ndarray`, optional): Defaults to None. Distance tables of the faces (see
+                `distance_table`), to compute them once per face
+
+        Returns:
+            numpy ndarray: Distances (m, end - start)
+
+        """
+        block = self.data[start:end]
+        if self.kind == 'float16':
+            block = block.astype(np.float32)
+            probes = np.asarray(face_encodings, dtype=np.float32).reshape(-1, block.shape[1])
+            dists = sq_euclidean_distances(block, np.einsum('ij,ij->i', block, block), probes,
+                                           np.einsum('ij,ij->i', probes, probes))
+            return np.sqrt(np.maximum(dists, 0, out=dists), out=dists)
+
+        tables = self.distance_table(face_encodings) if tables is None else tables
+        dists = np.zeros((len(tables), len(block)), dtype=np.float32)
+        for m in range(block.shape[1]):
+            dists += tables[:, m, block[:, m]]
+        return np.sqrt(dists)
+
+
+def build_compressed(encodings, kind, pq_params=None):
+    """Build a compressed copy of a matrix of encodings
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        kind (str): 'float16' or 'pq'
+        pq_params (:obj:`dict`, optional): Defaults to None. Parameters of `train_pq`
+
+    Returns:
+        CompressedMatrix
+
+    """
+    if kind == 'float16':
+        return CompressedMatrix(kind, np.asarray(encodings, dtype=np.float16))
+    elif kind == 'pq':
+        codebooks = train_pq(encodings, **dict(DEFAULT_PQ_PARAMS, **(pq_params or {})))
+        return CompressedMatrix(kind, pq_encode(encodings, codebooks), codebooks)
+    else:
+        raise KeyError('Unknown compression')
+
+
+def _compressed_files(data_path, kind):
+    path = os.path.join(os.path.normpath(data_path), INDEX_FOLDER)
+    return (os.path.join(path, kind + '.npy'), os.path.join(path, kind + '_codebooks.npy'),
+            os.path.join(path, kind + '.json'))
+
+
+def save_compressed(data_path, compressed):
+    """Save a compressed matrix (and its metadata) in the `index/` folder of a dataset"""
+    data_file, codebooks_file, meta_file = _compressed_files(data_path, compressed.kind)
+    os.makedirs(os.path.dirname(data_file), exist_ok=True)
+
+    for filename, arr in ((data_file, compressed.data), (codebooks_file, compressed.codebooks)):
+        if arr is not None:
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, arr)
+            os.replace(filename + '.tmp', filename)
+
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(compressed.meta, f, indent=2, sort_keys=True)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def load_compressed(data_path, kind):
+    """Load a compressed matrix saved with `save_compressed` (in memory). Returns None if there is none"""
+    data_file, codebooks_file, meta_file = _compressed_files(data_path, kind)
+    if not (os.path.isfile(data_file) and os.path.isfile(meta_file)):
+        return None
+    if kind == 'pq' and not os.path.isfile(codebooks_file):
+        return None
+
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+    except ValueError:  # Corrupted metadata
+        return None
+    codebooks = np.load(codebooks_file) if kind == 'pq' else None
+    return CompressedMatrix(kind, np.load(data_file), codebooks, meta)
+
+
+def get_compressed(data_path, kind, encodings_loader, source_files, pq_params=None, rebuild=False):
+    """Load the compressed matrix of a dataset, or build it (and save it) if it is missing or stale
+
+    Args:
+        data_path (str): Dataset folder (it is stored in `{data_path}/index/`)
+        kind (str): 'float16' or 'pq'
+        encodings_loader (callable): Returns the matrix of encodings. Only called if it must be built
+        source_files (list): Files the encodings come from. Their fingerprint is stored with the compressed matrix
+        pq_params (:obj:`dict`, optional): Defaults to None. Parameters of `train_pq`
+        rebuild (bool): Force it to be rebuilt
+
+    Returns:
+        CompressedMatrix
+
+    """
+    if kind not in COMPRESSIONS:
+        raise KeyError('Unknown compression')
+
+    fingerprint = file_fingerprint(*source_files)
+    params = dict(DEFAULT_PQ_PARAMS, **(pq_params or {})) if kind == 'pq' else {}
+    compressed = None if rebuild else load_compressed(data_path, kind)
+    if compressed is not None and compressed.meta.get('format') == COMPRESSED_FORMAT and \
+            compressed.meta.get('fingerprint') == fingerprint and compressed.meta.get('params') == params:
+        return compressed
+
+    print('Compressing encodings ({})...'.format(kind))
+    start_t = time.time()
+    compressed = build_compressed(encodings_loader(), kind, params)
+    compressed.meta = {'format': COMPRESSED_FORMAT, 'kind': kind, 'params': params, 'fingerprint': fingerprint,
+                       'num_items': len(compressed), 'build_time': round(time.time() - start_t, 3),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    # Save it (the dataset could be read-only)
+    try:
+        save_compressed(data_path, compressed)
+    except OSError as e:
+        print('The compressed encodings could not be saved: {}'.format(e))
+    return compressed
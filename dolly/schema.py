@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from dolly.db import create_connection
+
+__all__ = ['SCHEMA_VERSION', 'MIGRATIONS', 'get_schema_version', 'migrate_schema']
+
+# Each migration is a list of statements. The version of the schema of a DB (`PRAGMA user_version`) is the number of
+# migrations applied, so only the new ones are applied when dolly is updated. Never edit a released migration: add
+# a new one
+MIGRATIONS = [
+    # 1. Tables of the msceleb dataset (`Finder.enhance_results` looks up the entities by `freebase_mid`), and the
+    # checkpoints of the loader (see `dolly.ingest`)
+    ['CREATE TABLE IF NOT EXISTS "entities" (id INTEGER PRIMARY KEY AUTOINCREMENT, freebase_mid TEXT, name_en TEXT, '
+     'gkg_json TEXT);',
+     'CREATE TABLE IF NOT EXISTS "faces" (id INTEGER PRIMARY KEY AUTOINCREMENT, image_name TEXT, face_location TEXT, '
+     'face_landmarks TEXT, freebase_mid TEXT, face_encoding TEXT, image_search_rank int NULL, image_url TEXT NULL, '
+     'hard_face INTEGER NULL, CONSTRAINT faces_entities_freebase_mid_fk FOREIGN KEY (freebase_mid) REFERENCES '
+     'entities (freebase_mid));',
+     'CREATE UNIQUE INDEX IF NOT EXISTS entity_freebase_mid_uindex ON "entities" (freebase_mid);',
+     'CREATE TABLE IF NOT EXISTS ingest_checkpoints (filename TEXT PRIMARY KEY, offset INTEGER NOT NULL, '
+     'updated_at TEXT);'],
+
+    # 2. Indexes of the lookups of the loader: the faces of an entity (covering: the ID of the faces is the rowid, so
+    # it is in the index too) and the faces of an entity pending to be encoded (partial: only a few faces)
+    ['CREATE INDEX IF NOT EXISTS faces_entity_image_index ON "faces" (freebase_mid, image_name, image_search_rank);',
+     'CREATE INDEX IF NOT EXISTS faces_pending_index ON "faces" (freebase_mid, image_name, image_search_rank) '
+     'WHERE face_encoding IS NULL AND coalesce(hard_face, 0) = 0;'],
+
+    # 3. Number of faces, encodings and hard faces of each entity, kept up to date by triggers (no GROUP BY over all
+    # the faces to know them)
+    ['CREATE TABLE IF NOT EXISTS entity_summary (freebase_mid TEXT PRIMARY KEY NOT NULL, '
+     'total INTEGER NOT NULL DEFAULT 0, encodings INTEGER NOT NULL DEFAULT 0, hard_faces INTEGER NOT NULL DEFAULT 0) '
+     'WITHOUT ROWID;',
+     'INSERT OR REPLACE INTO entity_summary (freebase_mid, total, encodings, hard_faces) '
+     'SELECT freebase_mid, COUNT(*), COUNT(face_encoding), SUM(coalesce(hard_face, 0) <> 0) FROM faces '
+     'WHERE freebase_mid IS NOT NULL GROUP BY freebase_mid;',
+     'CREATE TRIGGER IF NOT EXISTS entity_summary_insert AFTER INSERT ON faces WHEN NEW.freebase_mid IS NOT NULL '
+     'BEGIN '
+     'INSERT OR IGNORE INTO entity_summary (freebase_mid) VALUES (NEW.freebase_mid); '
+     'UPDATE entity_summary SET total = total + 1, encodings = encodings + (NEW.face_encoding IS NOT NULL), '
+     'hard_faces = hard_faces + (coalesce(NEW.hard_face, 0) <> 0) WHERE freebase_mid = NEW.freebase_mid; '
+     'END;',
+     'CREATE TRIGGER IF NOT EXISTS entity_summary_delete AFTER DELETE ON faces WHEN OLD.freebase_mid IS NOT NULL '
+     'BEGIN '
+     'UPDATE entity_summary SET total = total - 1, encodings = encodings - (OLD.face_encoding IS NOT NULL), '
+     'hard_faces = hard_faces - (coalesce(OLD.hard_face, 0) <> 0) WHERE freebase_mid = OLD.freebase_mid; '
+     'END;',
+     # Only if the counts change (e.g. not when the encodings are rewritten, see `migrate_encodings`)
+     'CREATE TRIGGER IF NOT EXISTS entity_summary_update AFTER UPDATE OF freebase_mid, face_encoding, hard_face '
+     'ON faces WHEN OLD.freebase_mid IS NOT NEW.freebase_mid OR '
+     '(OLD.face_encoding IS NULL) <> (NEW.face_encoding IS NULL) OR '
+     '(coalesce(OLD.hard_face, 0) <> 0) <> (coalesce(NEW.hard_face, 0) <> 0) '
+     'BEGIN '
+     'UPDATE entity_summary SET total = total - 1, encodings = encodings - (OLD.face_encoding IS NOT NULL), '
+     'hard_faces = hard_faces - (coalesce(OLD.hard_face, 0) <> 0) WHERE freebase_mid = OLD.freebase_mid; '
+     'INSERT OR IGNORE INTO entity_summary (freebase_mid) SELECT NEW.freebase_mid WHERE NEW.freebase_mid IS NOT NULL; '
+     'UPDATE entity_summary SET total = total + 1, encodings = encodings + (NEW.face_encoding IS NOT NULL), '
+     'hard_faces = hard_faces + (coalesce(NEW.hard_face, 0) <> 0) WHERE freebase_mid = NEW.freebase_mid; '
+     'END;'],
+
+    # 4. Log of the faces whose encoding is rewritten (e.g. encoded again). `update_index` appends the new encodings to
+    # the matrix (the old row is left out of the search) and clears the log
+    ['CREATE TABLE IF NOT EXISTS face_updates (seq INTEGER PRIMARY KEY AUTOINCREMENT, face_id INTEGER NOT NULL, '
+     'updated_at TEXT);',
+     'CREATE TRIGGER IF NOT EXISTS face_updates_encoding AFTER UPDATE OF face_encoding ON faces '
+     'WHEN OLD.face_encoding IS NOT NULL AND NEW.face_encoding IS NOT NULL AND OLD.face_encoding IS NOT '
+     'NEW.face_encoding '
+     'BEGIN '
+     "INSERT INTO face_updates (face_id, updated_at) VALUES (NEW.id, datetime('now')); "
+     'END;'],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    """Version of the schema of a DB (number of migrations applied)"""
+    return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+
+def migrate_schema(database, version=SCHEMA_VERSION):
+    """Apply the migrations of the schema pending in a DB
+
+    Each migration is applied in its own transaction, together with the new version, so an interrupted migration is
+    rolled back and applied again the next time.
+
+    Args:
+        database (str or sqlite3.Connection): Path to the SQLite database, or a (read-write) connection to it
+        version (int): Defaults to the latest. Version to migrate to
+
+    Returns:
+        int: Version of the schema
+
+    """
+    conn = create_connection(database) if isinstance(database, str) else database
+    current = get_schema_version(conn)
+    if current > SCHEMA_VERSION:
+        raise ValueError('The schema of the DB (v{}) is newer than this version of dolly (v{})'.format(
+            current, SCHEMA_VERSION))
+
+    for i in range(current, version):
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute('BEGIN;')
+        try:
+            for sql in MIGRATIONS[i]:
+                conn.execute(sql)
+            conn.execute('PRAGMA user_version={:d};'.format(i + 1))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print('- Schema migrated to v{}'.format(i + 1))
+
+    if isinstance(database, str):
+        conn.close()
+    return max(current, version)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+__all__ = ['euclidean_distances', 'cosine_distances', 'squared_norms', 'sq_euclidean_distances', 'merge_topk']
+
+
+def euclidean_distances(encodings, face_encoding):
+    """Euclidean distance between each row of a block of encodings and a face encoding
+
+    It is computed exactly as `face_recognition.face_distance`, so the distances are the same (bit by bit).
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        face_encoding (numpy ndarray): Face encoding to compare with
+
+    Returns:
+        numpy ndarray: Distances (n,)
+
+    """
+    if len(encodings) == 0:
+        return np.empty((0,))
+    return np.linalg.norm(encodings - face_encoding, axis=1)
+
+
+def cosine_distances(encodings, face_encoding):
+    """Cosine distance (1 - cosine similarity) between each row of a block of encodings and a face encoding
+
+    It is the distance of the nmslib space 'cosinesimil', so it can be merged with the results of the HNSW index.
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        face_encoding (numpy ndarray): Face encoding to compare with
+
+    Returns:
+        numpy ndarray: Distances (n,)
+
+    """
+    if len(encodings) == 0:
+        return np.empty((0,))
+    norms = np.linalg.norm(encodings, axis=1) * np.linalg.norm(face_encoding)
+    return 1.0 - np.dot(encodings, face_encoding) / np.where(norms > 0, norms, 1.0)
+
+
+def squared_norms(encodings, chunk_size=100000):
+    """Squared euclidean norm of each row of a matrix of encodings (float32), computed block by block
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings (it can be memory-mapped)
+        chunk_size (int): Rows per block
+
+    Returns:
+        numpy ndarray: Squared norms (n,)
+
+    """
+    norms = np.empty((len(encodings),), dtype=np.float32)
+    for start in range(0, len(encodings), chunk_size):
+        block = np.asarray(encodings[start:start + chunk_size], dtype=np.float32)
+        norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+    return norms
+
+
+def sq_euclidean_distances(block, block_sq_norms, probes, probes_sq_norms):
+    """Squared euclidean distances between several probes and a block of encodings, as one matrix product
+
+    ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2, so most of the work is a single (BLAS) matrix product. The result is an
+    approximation in float32 (rounding errors ~1e-6): use `euclidean_distances` to get the exact distances of the
+    candidates.
+
+    Args:
+        block (numpy ndarray): Matrix (n, 128) of face encodings
+        block_sq_norms (numpy ndarray): Squared norms of the block (n,) (see `squared_norms`)
+        probes (numpy ndarray): Matrix (m, 128) of face encodings (float32)
+        probes_sq_norms (numpy ndarray): Squared norms of the probes (m,)
+
+    Returns:
+        numpy ndarray: Squared distances (m, n)
+
+    """
+    dists = np.dot(probes, np.asarray(block, dtype=np.float32).T)
+    dists *= -2.0
+    dists += block_sq_norms[None, :]
+    dists += probes_sq_norms[:, None]
+    return dists
+
+
+def merge_topk(top_dists, top_ids, dists, ids, top_k):
+    """Merge a running top-k with a new block of candidates
+
+    Only a partial selection is done over the block, and the result is sorted by (distance, id).
+
+    Args:
+        top_dists (numpy ndarray): Distances of the current top-k (sorted)
+        top_ids (numpy ndarray): IDs of the current top-k
+        dists (numpy ndarray): Distances of the new candidates
+        ids (numpy ndarray): IDs of the new candidates
+        top_k (int): Number of candidates to keep
+
+    Returns:
+        tuple: (distances, ids) of the new top-k
+
+    """
+    dists = np.concatenate((top_dists, dists))
+    ids = np.concatenate((top_ids, ids))
+
+    # Partial selection. Ties with the k-th distance are kept so they can be broken by id
+    if len(dists) > top_k:
+        kth_dist = np.partition(dists, top_k - 1)[top_k - 1]
+        mask = dists <= kth_dist
+        dists, ids = dists[mask], ids[mask]
+
+    order = np.lexsort((ids, dists))[:top_k]
+    return dists[order], ids[order]
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import base64
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from dolly.processing import analyze_face
+from dolly.utils import decode_b64_image
+
+__all__ = ['DEFAULT_URL', 'make_server', 'serve', 'request_server', 'server_is_running', 'encode_image_file',
+           'remote_face_locations', 'remote_face_landmarks']
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_URL = 'http://{}:{}'.format(DEFAULT_HOST, DEFAULT_PORT)
+
+
+def _analyze_b64(image_b64, model='hog'):
+    # Runs in the workers: decode the image and get the encoding of the first face
+    np_image = np.array(decode_b64_image(image_b64).convert('RGB'))
+    return analyze_face(np_image=np_image, model=model)[2]
+
+
+def _findfaces_b64(image_b64, model='hog'):
+    # Runs in the workers: decode the image and find all its faces
+    import face_recognition
+
+    np_image = np.array(decode_b64_image(image_b64).convert('RGB'))
+    return face_recognition.face_locations(np_image, model=model)
+
+
+def _landmarks_b64(image_b64):
+    # Runs in the workers: decode the image and get the landmarks of all its faces
+    import face_recognition
+
+    np_image = np.array(decode_b64_image(image_b64).convert('RGB'))
+    return face_recognition.face_landmarks(np_image)
+
+
+def _format_results(results):
+    return [{'face_id': face_id, 'freebase_mid': freebase_mid, 'name': entity_name, 'distance': dist}
+            for face_id, freebase_mid, entity_name, dist in results]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Set by `make_server`
+    finder = None
+    pool = None
+    info = {}
+
+    def do_GET(self):
+        if self.path == '/ping':
+            self._send(200, dict({'status': 'ok'}, **self.info))
+        else:
+            self._send(404, {'error': 'Unknown endpoint'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length).decode('utf-8'))
+
+            if self.path == '/findclones':
+                self._send(200, self._findclones(payload))
+            elif self.path == '/findfaces':
+                locations = self.pool.submit(_findfaces_b64, payload['image'], payload.get('model', 'hog')).result()
+                self._send(200, {'face_locations': [list(loc) for loc in locations]})
+            elif self.path == '/facelandmarks':
+                landmarks = self.pool.submit(_landmarks_b64, payload['image']).result()
+                self._send(200, {'face_landmarks': landmarks})
+            else:
+                self._send(404, {'error': 'Unknown endpoint'})
+        except (KeyError, ValueError, TypeError) as e:
+            self._send(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+    def _findclones(self, payload):
+        top_k = int(payload.get('top_k', 10))
+
+        # Encodings given or computed from an image by the workers (first face)
+        if 'encodings' in payload:
+            encodings = np.asarray(payload['encodings'], dtype=np.float64).reshape(-1, 128)
+        else:
+            f_enc = self.pool.submit(_analyze_b64, payload['image'], payload.get('model', 'hog')).result()
+            if f_enc is None:
+                return {'results': [[]]}
+            encodings = np.asarray([f_enc])
+
+        results = self.finder.findclones_many(encodings, top_k=top_k,
+                                              unique_entities=bool(payload.get('unique_entities', False)))
+        return {'results': [_format_results(res) for res in results]}
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print('[{}] {}'.format(self.log_date_time_string(), format % args))
+
+
+class _Server(ThreadingHTTPServer):
+    # The pool of processes of the handlers is shut down with the server
+    pool = None
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def make_server(finder, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, info=None):
+    """Create the HTTP server of a Finder without starting it (see `serve`)
+
+    Call `serve_forever` to answer the requests, and `shutdown` and `server_close` to stop it (and its pool of
+    processes). Use `port=0` to bind any free port (see `server_address`).
+
+    Args:
+        finder (Finder): Finder used to answer the queries. See `serve`
+        host (str): Address to bind
+        port (int): Port to bind
+        workers (:obj:`int`, optional): Defaults to the number of cores. Processes used to analyze the images
+        info (:obj:`dict`, optional): Defaults to None. Extra information returned by /ping
+
+    Returns:
+        ThreadingHTTPServer
+
+    """
+    pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    handler = type('Handler', (_Handler,), {'finder': finder, 'pool': pool, 'info': info or {}})
+    try:
+        httpd = _Server((host, port), handler)
+    except OSError:
+        pool.shutdown()
+        raise
+    httpd.pool = pool
+    return httpd
+
+
+def serve(finder, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, info=None):
+    """Serve a Finder (and the face detection) through a local HTTP endpoint, keeping everything warm
+
+    Endpoints:
+        GET /ping: Status of the server
+        POST /findclones: JSON {"image": base64 or "encodings": [[...], ...], "top_k": int, "model": str,
+            "unique_entities": bool}
+        POST /findfaces: JSON {"image": base64, "model": str}
+        POST /facelandmarks: JSON {"image": base64}
+
+    Args:
+        finder (Finder): Finder used to answer the queries. The requests are answered by concurrent threads, so give
+            it a `ConnectionProvider` (one connection per thread)
+        host (str): Address to bind
+        port (int): Port to bind
+        workers (:obj:`int`, optional): Defaults to the number of cores. Processes used to analyze the images
+        info (:obj:`dict`, optional): Defaults to None. Extra information returned by /ping
+
+    """
+    workers = workers or os.cpu_count() or 1
+    httpd = make_server(finder, host=host, port=port, workers=workers, info=info)
+    print('Serving on http://{}:{} ({} workers)...'.format(host, httpd.server_address[1], workers))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping...')
+    finally:
+        httpd.server_close()
+
+
+def request_server(url, path, payload=None, timeout=60):
+    """Send a request to a running server
+
+    Args:
+        url (str): URL of the server
+        path (str): Endpoint
+        payload (:obj:`dict`, optional): Defaults to None (GET). JSON body (POST)
+        timeout (float): Timeout in seconds
+
+    Returns:
+        dict
+
+    """
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    req = urllib.request.Request(url.rstrip('/') + path, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as res:
+        return json.loads(res.read().decode('utf-8'))
+
+
+def server_is_running(url=DEFAULT_URL, timeout=0.5):
+    """Check if a server is running (and answering) at an URL"""
+    try:
+        return request_server(url, '/ping', timeout=timeout).get('status') == 'ok'
+    except (urllib.error.URLError, OSError, ValueError):
+        return False
+
+
+def encode_image_file(filename):
+    """Read an image file as base64 (to send it to a server)"""
+    with open(filename, 'rb') as f:
+        return base64.b64encode(f.read()).decode('ascii')
+
+
+def remote_face_locations(url, filename, model='hog'):
+    """Find the faces of an image file with a running server (see `/findfaces`)
+
+    Returns:
+        list: Face locations (top, right, bottom, left)
+
+    """
+    res = request_server(url, '/findfaces', {'image': encode_image_file(filename), 'model': model})
+    return [tuple(loc) for loc in res['face_locations']]
+
+
+def remote_face_landmarks(url, filename):
+    """Get the landmarks of the faces of an image file with a running server (see `/facelandmarks`)
+
+    Returns:
+        list: Landmarks of each face ({feature: [(x, y), ...]})
+
+    """
+    res = request_server(url, '/facelandmarks', {'image': encode_image_file(filename)})
+    return [{feature: [tuple(point) for point in points] for feature, points in face.items()}
+            for face in res['face_landmarks']]
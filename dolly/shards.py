@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dolly.index import INDEX_FOLDER, DEFAULT_METHOD, DEFAULT_SPACE, file_fingerprint, build_index
+from dolly.search import merge_topk
+from dolly.store import matrix_files, load_encodings
+
+__all__ = ['plan_shards', 'read_shards_plan', 'save_shards_plan', 'build_shard', 'build_shards', 'ShardedIndex',
+           'get_sharded_index']
+
+SHARDS_FOLDER = 'shards/'
+PLAN_FILENAME = 'shards.json'
+SHARDS_FORMAT = 1
+
+
+def _shards_path(data_path):
+    return os.path.join(os.path.normpath(data_path), INDEX_FOLDER, SHARDS_FOLDER)
+
+
+def _shard_files(data_path, shard):
+    path = _shards_path(data_path)
+    return os.path.join(path, 'hnsw-{}.bin'.format(shard)), os.path.join(path, 'hnsw-{}.json'.format(shard))
+
+
+def _write_json(filename, data):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):  # Missing or corrupted
+        return None
+
+
+def plan_shards(data_path, num_shards, index_params=None, method=DEFAULT_METHOD, space=DEFAULT_SPACE):
+    """Split the rows of the encoding matrix in shards and save the plan with the dataset
+
+    Shard `i` indexes the rows [bounds[i], bounds[i + 1]) of the matrix. Once the plan is saved, each shard can be
+    built independently (see `build_shard`), so the builds can run in parallel (even in different hosts: the
+    fingerprint of the matrix only depends on its content, see `file_fingerprint`).
+
+    Args:
+        data_path (str): Dataset folder (the plan is stored in `{data_path}/index/shards/`)
+        num_shards (int): Number of shards
+        index_params (:obj:`dict`, optional): Defaults to None. Parameters for `createIndex`
+        method (str): nmslib method
+        space (str): nmslib space
+
+    Returns:
+        dict: Plan
+
+    """
+    layout, ids_file, encodings_file = matrix_files(data_path)
+    num_items = len(load_encodings(data_path, layout))
+    if not 0 < num_shards <= max(num_items, 1):
+        raise ValueError('The number of shards must be in [1, {}]'.format(max(num_items, 1)))
+
+    bounds = np.linspace(0, num_items, num_shards + 1).astype(np.int64)
+    fingerprint = file_fingerprint(encodings_file, ids_file)
+    plan = {'format': SHARDS_FORMAT,
+            'method': method,
+            'space': space,
+            'index_params': index_params or {},
+            'fingerprint': fingerprint,  # Current matrix (rows can be appended, see `update_index`)
+            'build_id': fingerprint,  # Matrix the shards are built from
+            'num_shards': num_shards,
+            'bounds': [int(b) for b in bounds],
+            'num_items': int(num_items),  # Rows of the matrix in the shards (the next ones are searched exactly)
+            'num_updates': 0,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    save_shards_plan(data_path, plan)
+    return plan
+
+
+def read_shards_plan(data_path):
+    """Read the plan of the shards of a dataset (None if there is none)"""
+    return _read_json(os.path.join(_shards_path(data_path), PLAN_FILENAME))
+
+
+def save_shards_plan(data_path, plan):
+    """Save the plan of the shards of a dataset"""
+    os.makedirs(_shards_path(data_path), exist_ok=True)
+    _write_json(os.path.join(_shards_path(data_path), PLAN_FILENAME), plan)
+
+
+def _is_shard_built(data_path, plan, shard):
+    index_file, meta_file = _shard_files(data_path, shard)
+    meta = _read_json(meta_file)
+    return (os.path.isfile(index_file) and meta is not None and meta.get('build_id') == plan['build_id'] and
+            meta.get('bounds') == plan['bounds'][shard:shard + 2] and meta.get('index_params') == plan['index_params'])
+
+
+def build_shard(data_path, shard):
+    """Build (and save) one shard of the plan of a dataset
+
+    Args:
+        data_path (str): Dataset folder
+        shard (int): Shard to build
+
+    Returns:
+        dict: Metadata of the shard
+
+    """
+    plan = read_shards_plan(data_path)
+    if plan is None:
+        raise ValueError('There is no plan of shards (see `plan_shards`)')
+    if not 0 <= shard < plan['num_shards']:
+        raise KeyError('Unknown shard')
+
+    start, end = plan['bounds'][shard:shard + 2]
+    start_t = time.time()
+    encodings = load_encodings(data_path)[start:end]  # Only the slice (the .npy matrix is memory-mapped)
+    index = build_index(encodings, plan['method'], plan['space'], plan['index_params'])
+
+    index_file, meta_file = _shard_files(data_path, shard)
+    index.saveIndex(index_file + '.tmp')
+    os.replace(index_file + '.tmp', index_file)
+    meta = {'shard': shard, 'bounds': [start, end], 'build_id': plan['build_id'],
+            'index_params': plan['index_params'], 'num_items': end - start,
+            'build_time': round(time.time() - start_t, 3), 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    _write_json(meta_file, meta)
+    return meta
+
+
+def build_shards(data_path, shards=None, workers=None):
+    """Build the shards of the plan of a dataset, each one in its own process
+
+    Args:
+        data_path (str): Dataset folder
+        shards (:obj:`list`, optional): Defaults to None (all the shards not built yet). Shards to build
+        workers (:obj:`int`, optional): Defaults to None (one per shard). Number of processes
+
+    Returns:
+        list: Metadata of the shards built
+
+    """
+    plan = read_shards_plan(data_path)
+    if shards is None:
+        shards = [i for i in range(plan['num_shards']) if not _is_shard_built(data_path, plan, i)]
+    if not shards:
+        return []
+
+    print('Building {} shards...'.format(len(shards)))
+    if len(shards) == 1:
+        return [build_shard(data_path, shards[0])]
+    with ProcessPoolExecutor(max_workers=workers or len(shards)) as pool:
+        return list(pool.map(build_shard, [data_path] * len(shards), shards))
+
+
+# State of the processes of the shards (one shard per process)
+_shard_index = None
+_shard_offset = 0
+
+
+def _init_shard(index_file, method, space, offset):
+    global _shard_index, _shard_offset
+    import nmslib
+
+    _shard_index = nmslib.init(method=method, space=space)
+    _shard_index.loadIndex(index_file)
+    _shard_offset = offset
+
+
+def _set_shard_params(params):
+    _shard_index.setQueryTimeParams(params)
+
+
+def _query_shard(encodings, k, num_threads=1):
+    results = _shard_index.knnQueryBatch(encodings, k=k, num_threads=num_threads)
+    return [(np.asarray(rows, dtype=np.int64) + _shard_offset, np.asarray(dists, dtype=np.float64))
+            for rows, dists in results]
+
+
+class ShardedIndex:
+    """Shards of an index, each one loaded and queried in its own process
+
+    Queries are sent to all the shards at once (scatter), and the top-k of each shard are merged (gather). It has the
+    same query methods as a nmslib index, and the rows returned are rows of the whole matrix.
+    """
+
+    def __init__(self, data_path, plan):
+        self.plan = plan
+        self.bounds = plan['bounds']
+        self.pools = []
+        for shard in range(plan['num_shards']):
+            index_file, _ = _shard_files(data_path, shard)
+            self.pools.append(ProcessPoolExecutor(max_workers=1, initializer=_init_shard,
+                                                  initargs=(index_file, plan['method'], plan['space'],
+                                                            self.bounds[shard])))
+
+    def __len__(self):
+        return self.plan['num_items']
+
+    def knnQueryBatch(self, encodings, k=10, num_threads=1):
+        # Scatter. The shards run at once, so they share the threads (0: all the cores)
+        encodings = np.asarray(encodings, dtype=np.float32)
+        shard_threads = max(1, (num_threads or os.cpu_count() or 1) // len(self.pools))
+        futures = [pool.submit(_query_shard, encodings, min(k, self.bounds[i + 1] - self.bounds[i]), shard_threads)
+                   for i, pool in enumerate(self.pools)]
+
+        # Gather: merge the top-k of the shards
+        shard_results = [future.result() for future in futures]
+        results = []
+        for i in range(len(encodings)):
+            dists, rows = np.empty((0,)), np.empty((0,), dtype=np.int64)
+            for shard_result in shard_results:
+                dists, rows = merge_topk(dists, rows, shard_result[i][1], shard_result[i][0], k)
+            results.append((rows, dists))
+        return results
+
+    def knnQuery(self, encoding, k=10):
+        return self.knnQueryBatch(np.asarray([encoding]), k=k)[0]
+
+    def setQueryTimeParams(self, params):
+        # Each pool has a single process, so every shard gets them
+        for future in [pool.submit(_set_shard_params, params) for pool in self.pools]:
+            future.result()
+
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown(wait=False)
+        self.pools = []
+
+
+def get_sharded_index(data_path, num_shards, index_params=None, rebuild=False, workers=None):
+    """Load the shards of a dataset, or plan and build them if they are missing or stale
+
+    Args:
+        data_path (str): Dataset folder
+        num_shards (int): Number of shards
+        index_params (:obj:`dict`, optional): Defaults to None (the parameters of the saved plan, if any).
+            Parameters for `createIndex`
+        rebuild (bool): Force the shards to be rebuilt
+        workers (:obj:`int`, optional): Defaults to None (one per shard). Processes used to build the shards
+
+    Returns:
+        tuple: (ShardedIndex, plan)
+
+    """
+    layout, ids_file, encodings_file = matrix_files(data_path)
+    plan = read_shards_plan(data_path)
+    if index_params is None and plan:
+        index_params = plan.get('index_params')
+    if rebuild or plan is None or plan.get('format') != SHARDS_FORMAT or plan['num_shards'] != num_shards or \
+            plan['index_params'] != (index_params or {}) or \
+            plan['fingerprint'] != file_fingerprint(encodings_file, ids_file):
+        plan = plan_shards(data_path, num_shards, index_params)
+
+    # Build the shards missing (or all of them)
+    build_shards(data_path, shards=list(range(num_shards)) if rebuild else None, workers=workers)
+    return ShardedIndex(data_path, plan), plan
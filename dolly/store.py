@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+
+import numpy as np
+
+from dolly.db import create_connection, decode_arrays
+
+__all__ = ['matrix_files', 'load_ids', 'load_encodings', 'save_matrix', 'append_matrix', 'load_deleted', 'save_deleted',
+           'alive_rows', 'compact_matrix', 'pickles_to_npy', 'export_matrix']
+
+PICKLE_FOLDER = 'pickle/'
+NPY_FOLDER = 'npy/'
+IDS_FILENAME = 'np_ids'
+ENCODINGS_FILENAME = 'np_encodings'
+DELETED_FILENAME = 'np_deleted.npy'
+
+
+def matrix_files(data_path, layout=None):
+    """Get the files of the encoding matrix of a dataset
+
+    The `.npy` layout (`{data_path}/npy/`) is preferred over the pickle layout (`{data_path}/pickle/`) when both exist.
+
+    Args:
+        data_path (str): Dataset folder
+        layout (:obj:`str`, optional): Defaults to None (auto). 'npy' or 'pickle'
+
+    Returns:
+        tuple: (layout, ids file, encodings file)
+
+    """
+    data_path = os.path.normpath(data_path)
+    npy_path = os.path.join(data_path, NPY_FOLDER)
+    pickle_path = os.path.join(data_path, PICKLE_FOLDER)
+    npy_files = (npy_path + IDS_FILENAME + '.npy', npy_path + ENCODINGS_FILENAME + '.npy')
+    pickle_files = (pickle_path + IDS_FILENAME + '.pkl', pickle_path + ENCODINGS_FILENAME + '.pkl')
+
+    if layout is None:
+        layout = 'npy' if all(os.path.isfile(f) for f in npy_files) else 'pickle'
+
+    if layout == 'npy':
+        return ('npy',) + npy_files
+    elif layout == 'pickle':
+        return ('pickle',) + pickle_files
+    else:
+        raise KeyError('Unknown layout')
+
+
+def load_ids(data_path, layout=None):
+    """Load the array of face IDs (row `i` of the matrix is the face `ids[i]` of the DB)"""
+    layout, ids_file, _ = matrix_files(data_path, layout)
+    if layout == 'npy':
+        return np.load(ids_file)
+    return pickle.load(open(ids_file, 'rb'))
+
+
+def load_encodings(data_path, layout=None, mmap_mode='r'):
+    """Load the matrix of encodings
+
+    With the `.npy` layout the matrix is memory-mapped, so all the processes that open it share the same pages (page
+    cache) instead of holding their own private copy.
+
+    Args:
+        data_path (str): Dataset folder
+        layout (:obj:`str`, optional): Defaults to None (auto). 'npy' or 'pickle'
+        mmap_mode (:obj:`str`, optional): Defaults to 'r'. Use None to load the matrix in memory
+
+    Returns:
+        numpy ndarray (or numpy memmap)
+
+    """
+    layout, _, encodings_file = matrix_files(data_path, layout)
+    if layout == 'npy':
+        return np.load(encodings_file, mmap_mode=mmap_mode)
+    return pickle.load(open(encodings_file, 'rb'))
+
+
+def _save_npy(filename, arr):
+    with open(filename + '.tmp', 'wb') as f:
+        np.save(f, arr)
+    os.replace(filename + '.tmp', filename)
+
+
+def save_matrix(data_path, ids, encodings, layout='npy'):
+    """Save the array of face IDs and the matrix of encodings of a dataset
+
+    Args:
+        data_path (str): Dataset folder
+        ids (numpy ndarray): Face IDs
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        layout (str): 'npy' or 'pickle'
+
+    """
+    layout, ids_file, encodings_file = matrix_files(data_path, layout)
+    folder = os.path.dirname(ids_file)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    ids = np.asarray(ids, dtype=np.int32)
+    encodings = np.asarray(encodings, dtype=np.float32)
+    if layout == 'npy':
+        _save_npy(ids_file, ids)
+        _save_npy(encodings_file, encodings)
+    else:
+        pickle.dump(ids, open(ids_file, 'wb'))
+        pickle.dump(encodings, open(encodings_file, 'wb'))
+
+
+def _append_npy(filename, arr):
+    # Append rows to a .npy file in place: the data is written at the end and then the shape of the header is updated
+    with open(filename, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+        if fortran_order or arr.shape[1:] != shape[1:]:
+            raise ValueError('The rows do not match the array of {}'.format(filename))
+
+        # New header (same length, padded with spaces)
+        new_shape = (shape[0] + arr.shape[0],) + shape[1:]
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(dtype), new_shape)
+        header_start = 10 if version == (1, 0) else 12  # magic + version + header length
+        header_size = data_offset - header_start
+        if len(header) + 1 > header_size:  # It doesn't fit (very unlikely)
+            f.close()
+            _save_npy(filename, np.concatenate((np.load(filename), arr)))
+            return
+
+        f.seek(0, os.SEEK_END)
+        f.write(arr.tobytes())
+        f.flush()
+        f.seek(header_start)
+        f.write((header.ljust(header_size - 1) + '\n').encode('latin1'))
+
+
+def append_matrix(data_path, ids, encodings, layout=None):
+    """Append face IDs and encodings to the matrix of a dataset
+
+    The `.npy` files are extended in place. The pickles must be rewritten.
+
+    Args:
+        data_path (str): Dataset folder
+        ids (numpy ndarray): Face IDs
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        layout (:obj:`str`, optional): Defaults to None (auto). 'npy' or 'pickle'
+
+    """
+    layout, ids_file, encodings_file = matrix_files(data_path, layout)
+    ids = np.asarray(ids, dtype=np.int32)
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(len(ids), -1)
+
+    if layout == 'npy':
+        _append_npy(encodings_file, encodings)
+        _append_npy(ids_file, ids)
+    else:
+        save_matrix(data_path, np.concatenate((load_ids(data_path, layout), ids)),
+                    np.concatenate((load_encodings(data_path, layout), encodings)), layout)
+
+
+def load_deleted(data_path, layout=None):
+    """Load the IDs of the faces deleted from the DB that are still in the matrix (tombstones)"""
+    layout, ids_file, _ = matrix_files(data_path, layout)
+    filename = os.path.join(os.path.dirname(ids_file), DELETED_FILENAME)
+    if os.path.isfile(filename):
+        return np.load(filename)
+    return np.empty((0,), dtype=np.int32)
+
+
+def save_deleted(data_path, ids, layout=None):
+    """Save the IDs of the faces deleted from the DB that are still in the matrix (tombstones)"""
+    layout, ids_file, _ = matrix_files(data_path, layout)
+    _save_npy(os.path.join(os.path.dirname(ids_file), DELETED_FILENAME), np.unique(np.asarray(ids, dtype=np.int32)))
+
+
+def alive_rows(ids, deleted=None):
+    """Rows of the matrix that are searched: the faces not deleted from the DB, and only the last row of each face (a
+    face whose encoding is rewritten in the DB is appended again, see `update_index`)
+
+    Args:
+        ids (numpy ndarray): Face IDs of the rows of the matrix
+        deleted (:obj:`numpy ndarray`, optional): Defaults to None. Face IDs deleted from the DB (tombstones)
+
+    Returns:
+        numpy ndarray: Boolean mask of the rows, or None if all of them are searched
+
+    """
+    alive = ~np.isin(ids, deleted) if deleted is not None and len(deleted) else None
+    if len(ids) > 1 and np.any(np.diff(ids) <= 0):  # Rows appended after the export (maybe of the same faces)
+        last_rows = len(ids) - 1 - np.unique(ids[::-1], return_index=True)[1]
+        if len(last_rows) < len(ids):
+            latest = np.zeros(len(ids), dtype=bool)
+            latest[last_rows] = True
+            alive = latest if alive is None else alive & latest
+    return alive
+
+
+def compact_matrix(data_path, layout=None):
+    """Remove the deleted faces (tombstones) and the old rows of the faces appended again from the matrix of a dataset
+
+    Returns:
+        int: Number of rows removed
+
+    """
+    layout = matrix_files(data_path, layout)[0]
+    ids = load_ids(data_path, layout)
+    keep = alive_rows(ids, load_deleted(data_path, layout))
+    if keep is None:
+        return 0
+
+    save_matrix(data_path, ids[keep], load_encodings(data_path, layout)[keep], layout)
+    save_deleted(data_path, [], layout)
+    return int(len(ids) - keep.sum())
+
+
+def pickles_to_npy(data_path):
+    """Convert the pickle layout of a dataset into the `.npy` layout"""
+    save_matrix(data_path, load_ids(data_path, 'pickle'), load_encodings(data_path, 'pickle'), layout='npy')
+
+
+def export_matrix(database, data_path, chunk_size=10000):
+    """Export the encodings of the DB into the `.npy` layout
+
+    The matrix is written block by block into a memory-mapped file, so the whole table is never held in memory.
+
+    Args:
+        database (str): Path to the SQLite database
+        data_path (str): Dataset folder
+        chunk_size (int): Rows per block
+
+    Returns:
+        int: Number of encodings exported
+
+    """
+    _, ids_file, encodings_file = matrix_files(data_path, 'npy')
+    folder = os.path.dirname(ids_file)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    conn = create_connection(database)
+    cur = conn.cursor()
+    num_faces, max_id = cur.execute('SELECT COUNT(*), MAX(id) FROM faces WHERE face_encoding IS NOT NULL;').fetchone()
+
+    ids = np.empty((num_faces,), dtype=np.int32)
+    encodings = None
+    offset = 0
+    cur.execute('SELECT id, face_encoding FROM faces WHERE face_encoding IS NOT NULL AND id <= ? ORDER BY id;',
+                (max_id,))
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        block = decode_arrays([row[1] for row in rows])
+        if encodings is None:
+            encodings = np.lib.format.open_memmap(encodings_file + '.tmp', mode='w+', dtype=np.float32,
+                                                  shape=(num_faces, block.shape[1]))
+        ids[offset:offset + len(rows)] = [row[0] for row in rows]
+        encodings[offset:offset + len(rows)] = block
+        offset += len(rows)
+        print('- Exported faces: {}/{}'.format(offset, num_faces))
+    conn.close()
+
+    if encodings is None:
+        raise ValueError('There are no encodings in the database')
+    encodings.flush()
+    del encodings
+    os.replace(encodings_file + '.tmp', encodings_file)
+    _save_npy(ids_file, ids)
+    return offset
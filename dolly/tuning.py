@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import numpy as np
+
+from dolly.db import decode_arrays
+from dolly.index import INDEX_FOLDER, save_index_meta
+from dolly.shards import ShardedIndex, save_shards_plan
+from dolly.search import squared_norms, sq_euclidean_distances
+from dolly.store import load_encodings
+
+__all__ = ['DEFAULT_EF_SEARCH', 'sample_probes', 'exact_neighbors', 'measure_recall', 'tune_ef_search']
+
+DEFAULT_EF_SEARCH = (10, 20, 40, 80, 160, 320, 640, 1280)
+
+
+def sample_probes(conn, np_ids, num_probes=200, row_alive=None, seed=0, batch_size=500):
+    """Sample faces of the DB to use as queries (probes)
+
+    Args:
+        conn (sqlite3.Connection): Connection to the DB
+        np_ids (numpy ndarray): Face IDs of the rows of the matrix
+        num_probes (int): Number of probes
+        row_alive (:obj:`numpy ndarray`, optional): Defaults to None. Rows not deleted from the DB
+        seed (int): Random seed
+
+    Returns:
+        tuple: (face IDs, encodings) of the probes
+
+    """
+    candidates = np_ids if row_alive is None else np_ids[row_alive]
+    rng = np.random.RandomState(seed)
+    face_ids = np.sort(rng.choice(candidates, min(num_probes, len(candidates)), replace=False))
+
+    found = {}
+    for start in range(0, len(face_ids), batch_size):
+        batch = [int(face_id) for face_id in face_ids[start:start + batch_size]]
+        sql = 'SELECT id, face_encoding FROM faces WHERE id IN ({});'.format(','.join('?' * len(batch)))
+        rows = conn.execute(sql, batch).fetchall()
+        for face_id, enc in zip([r[0] for r in rows], decode_arrays([r[1] for r in rows])):
+            found[face_id] = enc
+
+    face_ids = np.asarray([face_id for face_id in face_ids if int(face_id) in found], dtype=np_ids.dtype)
+    return face_ids, np.asarray([found[int(face_id)] for face_id in face_ids], dtype=np.float32)
+
+
+def exact_neighbors(encodings, probes, top_k, exclude_rows=None, row_alive=None, metric='cosine', chunk_size=50000):
+    """Exact top-k rows of the matrix for each probe
+
+    Args:
+        encodings (numpy ndarray): Matrix (n, 128) of face encodings
+        probes (numpy ndarray): Matrix (m, 128) of queries
+        top_k (int): Number of neighbours
+        exclude_rows (:obj:`numpy ndarray`, optional): Defaults to None. Row of each probe to leave out (held out)
+        row_alive (:obj:`numpy ndarray`, optional): Defaults to None. Rows not deleted from the DB
+        metric (str): 'cosine' (the distance of the index) or 'euclidean' (the distance of the reranked results)
+        chunk_size (int): Rows per block
+
+    Returns:
+        numpy ndarray: Rows (m, top_k) sorted by distance
+
+    """
+    if metric not in ('cosine', 'euclidean'):
+        raise KeyError('Unknown metric')
+    probes = np.asarray(probes, dtype=np.float32)
+    if metric == 'cosine':
+        probes = probes / np.maximum(np.linalg.norm(probes, axis=1), 1e-12)[:, None]
+    probes_sq_norms = np.einsum('ij,ij->i', probes, probes)
+    k = min(top_k, len(encodings))
+    top_dists = np.full((len(probes), 0), np.inf)
+    top_rows = np.empty((len(probes), 0), dtype=np.int64)
+    probe_idx = np.arange(len(probes))[:, None]
+
+    for start in range(0, len(encodings), chunk_size):
+        block = np.asarray(encodings[start:start + chunk_size], dtype=np.float32)
+        if metric == 'cosine':
+            block = block / np.maximum(np.linalg.norm(block, axis=1), 1e-12)[:, None]
+            dists = 1.0 - np.dot(probes, block.T)  # (m, block)
+        else:
+            dists = sq_euclidean_distances(block, squared_norms(block), probes, probes_sq_norms)
+        rows = np.arange(start, start + len(block))
+        if row_alive is not None:
+            dists[:, ~row_alive[start:start + len(block)]] = np.inf
+        if exclude_rows is not None:
+            inside = (exclude_rows >= start) & (exclude_rows < start + len(block))
+            dists[np.nonzero(inside)[0], exclude_rows[inside] - start] = np.inf
+
+        # Keep the top-k of the block and merge it with the running top-k
+        kb = min(k, len(block))
+        part = np.argpartition(dists, kb - 1, axis=1)[:, :kb]
+        top_dists = np.concatenate((top_dists, dists[probe_idx, part]), axis=1)
+        top_rows = np.concatenate((top_rows, rows[part]), axis=1)
+        order = np.argsort(top_dists, axis=1, kind='mergesort')[:, :k]
+        top_dists, top_rows = top_dists[probe_idx, order], top_rows[probe_idx, order]
+    return top_rows
+
+
+def measure_recall(index, probes, truth, top_k, exclude_rows=None, num_threads=0, shortlist=None):
+    """Recall@k of an index (the fraction of the exact top-k it returns)
+
+    Args:
+        index: nmslib index (or ShardedIndex)
+        probes (numpy ndarray): Matrix (m, 128) of queries
+        truth (numpy ndarray): Exact top-k rows of each probe (see `exact_neighbors`)
+        top_k (int): Number of neighbours
+        exclude_rows (:obj:`numpy ndarray`, optional): Defaults to None. Row of each probe to leave out
+        num_threads (int): Defaults to zero (all the cores). Threads used to search
+        shortlist (:obj:`int`, optional): Defaults to None (top_k). Candidates reranked with the exact distance. The
+            true neighbours in the shortlist are the ones returned after the rerank
+
+    Returns:
+        float: Recall
+
+    """
+    shortlist = max(top_k, shortlist or 0)
+    k = shortlist + (1 if exclude_rows is not None else 0)  # The probe itself is in the index
+    results = index.knnQueryBatch(probes, k=k, num_threads=num_threads or os.cpu_count() or 1)
+
+    hits = 0
+    for i, (rows, _) in enumerate(results):
+        rows = [r for r in rows if exclude_rows is None or r != exclude_rows[i]][:shortlist]
+        hits += len(set(rows) & set(truth[i]))
+    return hits / float(truth.size) if truth.size else 1.0
+
+
+def tune_ef_search(finder, recall=0.95, top_k=10, num_probes=200, candidates=DEFAULT_EF_SEARCH, seed=0, save=True):
+    """Find the smallest efSearch of the index of a Finder that reaches a recall@k, and save it with the index
+
+    The probes are faces of the DB (held out: each one is excluded from its own neighbours), and the ground truth is
+    the exact search over the encoding matrix with the distance of the results: euclidean if the Finder reranks a
+    shortlist of the index (see `rerank_size`), or cosine.
+
+    HNSW searches with max(efSearch, k), and the Finder asks the index for max(top_k, rerank_size) candidates, so any
+    efSearch below that shortlist behaves the same. The candidates below it are replaced by the shortlist size (e.g.
+    with the default rerank of 100 the first candidate is 100).
+
+    Args:
+        finder (Finder): Finder with the 'hnsw' engine
+        recall (float): Target recall@k
+        top_k (int): Number of neighbours
+        num_probes (int): Number of probes
+        candidates (tuple): Values of efSearch to try (in ascending order). They start at the shortlist size
+        seed (int): Random seed
+        save (bool): Save the chosen efSearch with the index (it is used by default by the Finders that load it)
+
+    Returns:
+        dict: Tuning results (chosen efSearch, recall and latency of each candidate,...)
+
+    """
+    if finder.engine != 'hnsw':
+        raise NotImplementedError('Only the hnsw engine can be tuned')
+
+    # Probes and their exact neighbours (only the rows in the index)
+    encodings = finder.np_encodings if finder.np_encodings is not None else load_encodings(finder.data_path)
+    encodings, np_ids = encodings[:finder.index_size], finder.np_ids[:finder.index_size]
+    row_alive = finder.row_alive[:finder.index_size] if finder.row_alive is not None else None
+    face_ids, probes = sample_probes(finder.conn, np_ids, num_probes, row_alive, seed)
+    sorter = np.argsort(np_ids)
+    exclude_rows = sorter[np.searchsorted(np_ids, face_ids, sorter=sorter)]  # Row of each probe
+    metric = 'euclidean' if finder.rerank_size else 'cosine'
+    truth = exact_neighbors(encodings, probes, top_k, exclude_rows=exclude_rows, row_alive=row_alive, metric=metric)
+
+    shortlist = max(top_k, finder.rerank_size or 0)
+    candidates = sorted(set(max(ef_search, shortlist) for ef_search in candidates))
+
+    print('Tuning efSearch (recall@{} >= {}, {} probes)...'.format(top_k, recall, len(probes)))
+    previous, curve, chosen = finder.ef_search, {}, None
+    for ef_search in candidates:
+        finder.set_ef_search(ef_search)
+        start_t = time.perf_counter()
+        ef_recall = measure_recall(finder.index, probes, truth, top_k, exclude_rows, finder.num_threads,
+                                   shortlist=finder.rerank_size)
+        latency = (time.perf_counter() - start_t) / max(len(probes), 1) * 1000.0
+        curve[str(ef_search)] = {'recall': round(ef_recall, 4), 'latency_ms': round(latency, 4)}
+        print('\t- efSearch={}: recall={:.4f}; {:.3f}ms/query'.format(ef_search, ef_recall, latency))
+        if ef_recall >= recall:
+            chosen = ef_search
+            break
+
+    if chosen is None:
+        print('The target recall was not reached. Using the largest efSearch ({})'.format(candidates[-1]))
+        chosen = candidates[-1]
+    finder.set_ef_search(chosen if save else previous)
+
+    tuning = {'ef_search': chosen, 'recall': recall, 'top_k': top_k, 'num_probes': len(probes), 'seed': seed,
+              'metric': metric, 'rerank_size': finder.rerank_size or 0, 'curve': curve,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if save:
+        finder.index_meta['ef_search'] = chosen
+        finder.index_meta['tuning'] = tuning
+        if isinstance(finder.index, ShardedIndex):
+            save_shards_plan(finder.data_path, finder.index_meta)
+        else:
+            save_index_meta(os.path.join(os.path.normpath(finder.data_path), INDEX_FOLDER), finder.index_meta)
+    return tuning
@@ -5,16 +5,19 @@ import os, shutil, glob
 import codecs
 import base64
 import io
+from collections import deque
 
 import numpy as np
-from face_recognition import load_image_file
-from PIL import Image
+
+from dolly.profiling import stage
 
 
 def image_loader(filename_or_np_array):
     # Input as a filename
     if isinstance(filename_or_np_array, str):
-        return load_image_file(filename_or_np_array)
+        from face_recognition import load_image_file
+        with stage('image_loader'):
+            return load_image_file(filename_or_np_array)
     # Input as a Numpy ndarray
     elif isinstance(filename_or_np_array, np.ndarray):
         return filename_or_np_array
@@ -23,8 +26,66 @@ def image_loader(filename_or_np_array):
         raise TypeError('Invalid image type')
 
 
+def image_loader_scaled(filename_or_np_array, scale=1.0):
+    """Load an image downscaled (e.g. to detect its faces faster)
+
+    JPEG files are decoded directly at a reduced scale (PIL draft mode), so the full image is never decoded.
+
+    Args:
+        filename_or_np_array (str or numpy ndarray): Filename or image
+        scale (float): Scale factor (0, 1]
+
+    Returns:
+        tuple: (numpy ndarray of the downscaled image, (scale y, scale x) actually applied)
+
+    """
+    from PIL import Image
+
+    if not 0 < scale <= 1:
+        raise ValueError('The scale must be in (0, 1]')
+
+    with stage('image_loader'):
+        if isinstance(filename_or_np_array, str):
+            img = Image.open(filename_or_np_array)
+            full_size = img.size
+            size = (max(1, int(round(full_size[0] * scale))), max(1, int(round(full_size[1] * scale))))
+            if scale < 1:
+                img.draft('RGB', size)  # JPEG: decode at 1/2, 1/4 or 1/8 of the size (never below `size`)
+            img = img.convert('RGB')
+        elif isinstance(filename_or_np_array, np.ndarray):
+            img = Image.fromarray(filename_or_np_array)
+            full_size = img.size
+            size = (max(1, int(round(full_size[0] * scale))), max(1, int(round(full_size[1] * scale))))
+        else:
+            raise TypeError('Invalid image type')
+
+        if img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        return np.array(img), (size[1] / full_size[1], size[0] / full_size[0])
+
+
+def scale_locations(face_locations, scale, shape):
+    """Map face locations found in a downscaled image back to the full-resolution image
+
+    Args:
+        face_locations (list): Face locations (top, right, bottom, left) in the downscaled image
+        scale (tuple): (scale y, scale x) of the downscaled image (see `image_loader_scaled`)
+        shape (tuple): Shape of the full-resolution image
+
+    Returns:
+        list: Face locations in the full-resolution image
+
+    """
+    scale_y, scale_x = scale
+    return [(max(int(round(top / scale_y)), 0), min(int(round(right / scale_x)), shape[1]),
+             min(int(round(bottom / scale_y)), shape[0]), max(int(round(left / scale_x)), 0))
+            for top, right, bottom, left in face_locations]
+
+
 def crop_image(np_image, coords, save_path=None):
     # Load PIL image and crop it
+    from PIL import Image
+
     (top, right, bottom, left) = coords
     pil_image = Image.fromarray(np_image)
     pil_image = pil_image.crop((left, top, right, bottom))
@@ -61,6 +122,8 @@ def decode_str(text):
 
 
 def decode_b64_image(str_img):
+    from PIL import Image
+
     data = base64.b64decode(str_img)
     return Image.open(io.BytesIO(data))
 
@@ -72,3 +135,33 @@ def isLast(itr):
     old = new
   yield True, old
 
+
+def imap_ordered(func, iterable, workers=1, max_in_flight=None):
+    """Apply a function to each item using a pool of processes, yielding (item, result) in the input order
+
+    At most `max_in_flight` items (defaults to twice the number of workers) are submitted but not yet consumed, so
+    the consumer can stop at any moment without much wasted work. With one worker, everything runs in this process.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield item, func(item)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_in_flight = max_in_flight or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        try:
+            for item in iterable:
+                pending.append((item, pool.submit(func, item)))
+                if len(pending) >= max_in_flight:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:  # Consumer stopped: don't start the remaining work
+            for item, future in pending:
+                future.cancel()
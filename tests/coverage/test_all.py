@@ -1,7 +1,10 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 from PIL import Image
+from benchmarks.synthetic import make_dataset, make_encodings, make_queries
 from dolly.processing import *
 
 BASE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data/tests/')
@@ -12,6 +15,23 @@ PICKLE_PATH = os.path.join(BASE_DIR, 'pickle/')
 
 class TestDolly(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Synthetic dataset (40 people, 50 faces each) built once for the tests of the engines
+        cls.synthetic_path = tempfile.mkdtemp()
+        make_dataset(cls.synthetic_path, 2000)
+        cls.synthetic_queries = make_queries(make_encodings(2000)[0], 5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.synthetic_path, ignore_errors=True)
+
+    def copy_synthetic_dataset(self, data_path):
+        # Each test works on its own copy (the indexes and the updates are written in the dataset folder)
+        for folder in ('db', 'pickle', 'npy'):
+            shutil.copytree(os.path.join(self.synthetic_path, folder), os.path.join(data_path, folder))
+        return os.path.join(data_path, 'db/msceleb.sqlite')
+
     def test_crop_image(self):
         filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
         save_path = os.path.join(IMAGES_PATH, 'cropped/') + 'obama_cropped.jpg'
@@ -51,6 +71,27 @@ class TestDolly(unittest.TestCase):
         self.assertEqual(len(res), 2)
 
 
+    def test_annotate(self):
+        import json
+        filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
+        save_path = os.path.join(IMAGES_PATH, 'cropped/')
+        prefix = 'testing_annotate'
+
+        # Boxes, landmarks, crops and sidecar from the same detections
+        res = annotate(np_image=image_loader(filename), save_path=save_path, prefix_name=prefix)
+        self.assertEqual(len(res), 1)
+        for suffix in ['_boxes.jpg', '_landmarks.jpg', '_face_0.jpg', '.json']:
+            self.assertEqual(os.path.isfile(save_path + prefix + suffix), True)
+        with open(save_path + prefix + '.json') as f:
+            sidecar = json.load(f)
+        self.assertEqual(len(sidecar['faces'][0]['face_encoding']), 128)
+
+        # Same features as the first face of analyze_face
+        f_loc, f_lmarks, f_enc = analyze_face(np_image=image_loader(filename))
+        self.assertEqual(tuple(res[0][0]), tuple(f_loc))
+        self.assertEqual(res[0][1], f_lmarks)
+        self.assertEqual(list(res[0][2]), list(f_enc))
+
     def test_findfacesdir(self):
         directory = os.path.join(IMAGES_PATH, 'original/')
         save_path = os.path.join(IMAGES_PATH, 'cropped/')
@@ -59,6 +100,26 @@ class TestDolly(unittest.TestCase):
         res = findfacesdir(directory=directory, save_path=save_path)
         self.assertGreater(res, 0)  # num_faces images
 
+        # Same number of faces with a pool of processes
+        res2 = findfacesdir(directory=directory, save_path=save_path, workers=2)
+        self.assertEqual(res, res2)
+
+    def test_detect_faces_scaled(self):
+        from benchmarks.detection import matched_faces
+        filename = os.path.join(IMAGES_PATH, 'original/two_people.jpg')
+
+        # Faces found in the image decoded at half scale are mapped back to the full-resolution image
+        res = detect_faces(filename)
+        res2 = detect_faces(filename, scale=0.5)
+        res3 = detect_faces(image_loader(filename), scale=0.5)
+        self.assertEqual(len(res), len(res2))
+        self.assertEqual(matched_faces(res, res2), len(res))
+        self.assertEqual(matched_faces(res, res3), len(res))
+
+        # Encodings are computed on the full-resolution image
+        f_loc, f_lmarks, f_enc = analyze_face(np_image=image_loader(filename), scale=0.5)
+        self.assertEqual(len(f_enc), 128)
+
     def test_findclones(self):
         filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
         database = os.path.join(DB_PATH, 'msceleb.sqlite')
@@ -85,6 +146,716 @@ class TestDolly(unittest.TestCase):
         for i in range(0, len(res)):
             self.assertEqual(res[i][0], gs_values[i][0])
 
+    def test_findclones_db_chunks(self):
+        import pickle
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        f = Finder(db_conn=create_connection(database), in_memory=False, data_path=BASE_DIR)
+        f_enc = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))[3]
+
+        # The result must not depend on the size of the blocks
+        res = f.findclones(face_encoding=f_enc, top_k=3)
+        for chunk_size in [1, 2, 100]:
+            f.chunk_size = chunk_size
+            self.assertEqual(f.findclones(face_encoding=f_enc, top_k=3), res)
+        self.assertEqual(res[0][0], 4)
+
+    def test_migrate_encodings(self):
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.db import create_connection, migrate_encodings, decode_arrays, is_compact
+        from dolly.schema import migrate_schema
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database2 = os.path.join(tmp_dir, 'msceleb.sqlite')
+            shutil.copy(database, database2)
+
+            # Rewrite the encodings (a second run has nothing to do)
+            self.assertEqual(migrate_encodings(database2), 5)
+            self.assertEqual(migrate_encodings(database2), 0)
+
+            # Same encodings in both formats
+            sql = 'SELECT face_encoding FROM faces ORDER BY id;'
+            legacy = [r[0] for r in create_connection(database).execute(sql)]
+            compact = [r[0] for r in create_connection(database2).execute(sql)]
+            self.assertTrue(all(is_compact(b, 'float32') for b in compact))
+            self.assertLess(len(compact[0]), len(legacy[0]))
+            self.assertTrue(np.allclose(decode_arrays(legacy), decode_arrays(compact)))
+            self.assertTrue(np.allclose(decode_arrays(legacy[:2]), decode_arrays(compact[:1] + legacy[1:2])))
+
+            # A change of format is not logged as a rewrite of the encodings (see `update_index`)
+            database3 = os.path.join(tmp_dir, 'msceleb3.sqlite')
+            shutil.copy(database, database3)
+            migrate_schema(database3)
+            self.assertEqual(migrate_encodings(database3, dtype='float16'), 5)
+            self.assertEqual(create_connection(database3).execute('SELECT COUNT(*) FROM face_updates;').fetchone()[0],
+                             0)
+
+    def test_findclones_exact_mmap(self):
+        import pickle
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+        from dolly.store import pickles_to_npy, matrix_files
+
+        f_enc = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))[3]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shutil.copytree(PICKLE_PATH, os.path.join(tmp_dir, 'pickle/'))
+            pickles_to_npy(tmp_dir)
+            self.assertEqual(matrix_files(tmp_dir)[0], 'npy')
+
+            # Exact search over the memory-mapped matrix
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact', chunk_size=2)
+            self.assertIsInstance(f.np_encodings, np.memmap)
+            res = f.findclones(face_encoding=f_enc, top_k=3)
+
+            # Same results as the scan over the DB
+            f.in_memory = False
+            res2 = f.findclones(face_encoding=f_enc, top_k=3)
+            self.assertEqual([r[:3] for r in res], [r[:3] for r in res2])
+            self.assertTrue(np.allclose([r[3] for r in res], [r[3] for r in res2]))
+
+    def test_findclones_exact_blas(self):
+        import face_recognition
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+        from dolly.store import load_encodings
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)
+            queries = self.synthetic_queries
+            encodings = np.asarray(load_encodings(tmp_dir))
+
+            # Same distances as face_recognition (bit by bit), whatever the size of the blocks
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact', chunk_size=300)
+            res = f.findclones_many(queries, top_k=10)
+            for q, res_q in zip(queries, res):
+                dists = face_recognition.face_distance(encodings, q)
+                self.assertEqual([r[3] for r in res_q], sorted(dists)[:10])
+            f.chunk_size = 5000
+            self.assertEqual(f.findclones_many(queries, top_k=10), res)
+            self.assertEqual(f.findclones(face_encoding=queries[0], top_k=10), res[0])
+
+    def test_preloaded_entities(self):
+        import pickle
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        f_enc = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))[3]
+        f = Finder(db_conn=create_connection(database), data_path=BASE_DIR, engine='exact')
+        f2 = Finder(db_conn=create_connection(database), data_path=BASE_DIR, engine='exact', preload_entities=True)
+
+        # Same enrichment from memory and from the DB
+        self.assertEqual(f.findclones(face_encoding=f_enc, top_k=5), f2.findclones(face_encoding=f_enc, top_k=5))
+        self.assertEqual(f2.entity_table.lookup([4, 999]), {4: ('m.02mjmr', 'Barack Obama')})
+        self.assertEqual(f.entities_from_faceids([4, 999]), {4: ('m.02mjmr', 'Barack Obama')})
+
+    def test_findclones_many(self):
+        import pickle
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        encodings = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))
+        for engine in ['hnsw', 'exact', 'db']:
+            f = Finder(db_conn=create_connection(database), data_path=BASE_DIR, engine=engine, chunk_size=2)
+
+            # Same results as one query per face
+            res = f.findclones_many(encodings, top_k=3, num_threads=2)
+            self.assertEqual(len(res), len(encodings))
+            self.assertEqual(res, [f.findclones(face_encoding=e, top_k=3) for e in encodings])
+            self.assertEqual(res[3][0][0], 4)
+
+    def test_ingest_faces(self):
+        import base64
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.ingest import ingest_faces, read_tsv
+        from dolly.db import create_connection
+
+        with open(os.path.join(IMAGES_PATH, 'original/obama.jpg'), 'rb') as f:
+            b64_image = base64.b64encode(f.read()).decode()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database2 = os.path.join(tmp_dir, 'msceleb.sqlite')
+            tsv_filename = os.path.join(tmp_dir, 'faces.tsv')
+            shutil.copy(database, database2)
+            with open(tsv_filename, 'w') as f:
+                for i in range(3):
+                    row = ['img{}'.format(i), b64_image, 'm.test', str(i), 'http://url/{}'.format(i)]
+                    f.write('\t'.join(row) + '\n')
+
+            # Rows and their offsets
+            rows = list(read_tsv(tsv_filename))
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(list(read_tsv(tsv_filename, offset=rows[0][0]))[0], rows[1])
+            with open(tsv_filename + '.big', 'w') as f:  # Fields above the default limit of the csv module
+                f.write('\t'.join(['img', 'A' * 200000, 'm.test', '0', 'http://url']) + '\n')
+            self.assertEqual(len(list(read_tsv(tsv_filename + '.big'))[0][1][1]), 200000)
+
+            # Load the faces, and resume (nothing left to do)
+            self.assertEqual(ingest_faces(tsv_filename, database2, workers=2, buffer=2, min_num_encodings=5), (3, 0))
+            self.assertEqual(ingest_faces(tsv_filename, database2, workers=2, buffer=2, min_num_encodings=5), (0, 0))
+
+            conn = create_connection(database2)
+            sql = "SELECT COUNT(face_encoding) FROM faces WHERE freebase_mid='m.test';"
+            self.assertEqual(conn.execute(sql).fetchone()[0], 3)
+            sql = 'SELECT offset FROM ingest_checkpoints;'
+            self.assertEqual(conn.execute(sql).fetchone()[0], rows[-1][0])
+
+            # Faces of the entity pending to be encoded are updated (the others are skipped)
+            with conn:
+                conn.execute("UPDATE faces SET face_encoding=NULL WHERE image_name='img0';")
+            self.assertEqual(ingest_faces(tsv_filename, database2, min_num_encodings=5, resume=False), (0, 1))
+
+            # Corrupt rows (bad base64, not an image) are skipped, and the job (and its resume) goes on
+            with open(tsv_filename + '.bad', 'w') as f:
+                for i, image in enumerate(['abc', base64.b64encode(b'not an image').decode(), b64_image]):
+                    f.write('\t'.join(['bad{}'.format(i), image, 'm.bad', str(i), 'http://url/{}'.format(i)]) + '\n')
+            self.assertEqual(ingest_faces(tsv_filename + '.bad', database2, workers=2, min_num_encodings=5), (1, 0))
+            self.assertEqual(ingest_faces(tsv_filename + '.bad', database2, workers=2, min_num_encodings=5), (0, 0))
+            sql = "SELECT image_name FROM faces WHERE freebase_mid='m.bad';"
+            self.assertEqual(conn.execute(sql).fetchall(), [('bad2',)])
+            conn.close()
+
+    def test_migrate_schema(self):
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.db import create_connection
+        from dolly.schema import SCHEMA_VERSION, get_schema_version, migrate_schema
+
+        summary_sql = 'SELECT freebase_mid, total, encodings, hard_faces FROM entity_summary WHERE total > 0 ' \
+                      'ORDER BY freebase_mid;'
+        group_by_sql = 'SELECT freebase_mid, COUNT(*), COUNT(face_encoding), SUM(coalesce(hard_face, 0) <> 0) ' \
+                       'FROM faces GROUP BY freebase_mid ORDER BY freebase_mid;'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database2 = os.path.join(tmp_dir, 'msceleb.sqlite')
+            shutil.copy(database, database2)
+
+            # Migrate (only once)
+            self.assertEqual(migrate_schema(database2), SCHEMA_VERSION)
+            conn = create_connection(database2)
+            self.assertEqual(get_schema_version(conn), SCHEMA_VERSION)
+            self.assertEqual(migrate_schema(conn), SCHEMA_VERSION)
+            plan = conn.execute('EXPLAIN QUERY PLAN SELECT id, image_name, image_search_rank FROM faces '
+                                'WHERE freebase_mid=?;', ('m.test',)).fetchall()
+            self.assertIn('COVERING INDEX faces_entity_image_index', plan[0][-1])
+
+            # The counts of the entities are kept up to date
+            self.assertEqual(conn.execute(summary_sql).fetchall(), conn.execute(group_by_sql).fetchall())
+            with conn:
+                mid = conn.execute('SELECT freebase_mid FROM faces LIMIT 1;').fetchone()[0]
+                conn.execute("INSERT INTO faces(image_name, freebase_mid, hard_face) VALUES ('a', 'm.test', 0);")
+                conn.execute("INSERT INTO faces(image_name, freebase_mid, hard_face) VALUES ('b', ?, 1);", (mid,))
+                conn.execute("UPDATE faces SET face_encoding=x'00', freebase_mid=? WHERE image_name='a';", (mid,))
+                conn.execute('DELETE FROM faces WHERE id IN (SELECT id FROM faces LIMIT 2);')
+            self.assertEqual(conn.execute(summary_sql).fetchall(), conn.execute(group_by_sql).fetchall())
+            conn.close()
+
+    def test_update_index(self):
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection, migrate_encodings
+        from dolly.index import update_index
+        from dolly.store import load_ids, load_encodings
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database2 = os.path.join(tmp_dir, 'msceleb.sqlite')
+            shutil.copy(database, database2)
+            conn = create_connection(database2)
+
+            # First build (no matrix yet)
+            shutil.copytree(PICKLE_PATH, os.path.join(tmp_dir, 'pickle/'))
+            summary = update_index(database2, tmp_dir)
+            self.assertEqual(summary['rebuilt'], True)
+            f_enc = load_encodings(tmp_dir)[3]
+
+            # New face: appended to the matrix, searched exactly until the next rebuild
+            conn.execute("INSERT INTO faces(image_name, freebase_mid, face_encoding) VALUES ('new', 'm.02mjmr', ?);",
+                         (f_enc + 0.001,))
+            conn.commit()
+            summary = update_index(database2, tmp_dir, max_delta_fraction=1.0)
+            self.assertEqual((summary['appended'], summary['rebuilt']), (1, False))
+            f = Finder(db_conn=conn, data_path=tmp_dir)
+            self.assertEqual((f.index_size, len(f.np_ids)), (5, 6))
+            res = f.findclones(face_encoding=f_enc, top_k=2)
+            self.assertEqual([r[0] for r in res], [4, int(load_ids(tmp_dir)[-1])])
+
+            # Rewritten encoding: appended again, and the old row is no longer searched (nothing to do if only the
+            # format changed)
+            migrate_encodings(database2, dtype='float16')
+            summary = update_index(database2, tmp_dir, rebuild_fraction=1.0, max_delta_fraction=1.0)
+            self.assertEqual(summary['updated'], 0)
+            face_id = int(load_ids(tmp_dir)[0])
+            conn.execute('UPDATE faces SET face_encoding=? WHERE id=?;', (f_enc + 0.002, face_id))
+            conn.commit()
+            summary = update_index(database2, tmp_dir, rebuild_fraction=1.0, max_delta_fraction=1.0)
+            self.assertEqual((summary['updated'], summary['appended'], summary['rebuilt']), (1, 0, False))
+            f = Finder(db_conn=conn, data_path=tmp_dir)
+            self.assertEqual((len(f.np_ids), f.row_alive[0], f.row_alive[-1]), (7, False, True))
+            self.assertIn(face_id, [r[0] for r in f.findclones(face_encoding=f_enc, top_k=3)])
+
+            # Deleted face: skipped until the next rebuild, which removes it from the matrix
+            conn.execute('DELETE FROM faces WHERE id=4;')
+            conn.commit()
+            summary = update_index(database2, tmp_dir, rebuild_fraction=1.0, max_delta_fraction=1.0)
+            self.assertEqual((summary['deleted'], summary['rebuilt']), (1, False))
+            f = Finder(db_conn=conn, data_path=tmp_dir)
+            self.assertNotIn(4, [r[0] for r in f.findclones(face_encoding=f_enc, top_k=3)])
+            self.assertEqual(update_index(database2, tmp_dir, rebuild=True)['rebuilt'], True)
+            self.assertNotIn(4, load_ids(tmp_dir))
+            self.assertEqual(len(load_ids(tmp_dir)), len(set(load_ids(tmp_dir))))
+
+    def test_server(self):
+        import pickle
+        import threading
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+        filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
+
+        from dolly.findclones import Finder
+        from dolly.db import ConnectionProvider
+        import face_recognition
+        from dolly.server import make_server, request_server, server_is_running, encode_image_file, \
+            remote_face_locations, remote_face_landmarks
+
+        # Any free port. The server (and its pool of processes) is stopped at the end
+        f = Finder(db_conn=ConnectionProvider(database), data_path=BASE_DIR, engine='exact')
+        httpd = make_server(f, port=0, workers=1)
+        self.addCleanup(f.db_conn.close)
+        self.addCleanup(httpd.server_close)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.shutdown)
+        url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+        self.assertTrue(server_is_running(url))
+
+        # Encodings and images
+        encodings = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))
+        res = request_server(url, '/findclones', {'encodings': encodings[:2].tolist(), 'top_k': 3})['results']
+        self.assertEqual([r[0]['face_id'] for r in res], [1, 2])
+
+        # Concurrent requests (each thread of the server with its own connection)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            res2 = list(pool.map(lambda e: request_server(url, '/findclones', {'encodings': [e], 'top_k': 3}),
+                                 encodings.tolist() * 4))
+        self.assertEqual([r['results'][0][0]['face_id'] for r in res2], list(range(1, len(encodings) + 1)) * 4)
+        res = request_server(url, '/findclones', {'image': encode_image_file(filename), 'top_k': 3})['results']
+        self.assertEqual(res[0][0]['face_id'], 4)
+        res = request_server(url, '/findfaces', {'image': encode_image_file(filename)})
+        self.assertEqual(len(res['face_locations']), 1)
+
+        # Detection and landmarks of the CLI commands (drawn or cropped locally)
+        np_image = image_loader(filename)
+        self.assertEqual(remote_face_locations(url, filename), face_recognition.face_locations(np_image))
+        self.assertEqual(remote_face_landmarks(url, filename), face_recognition.face_landmarks(np_image))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertEqual(findfacesdir(os.path.join(IMAGES_PATH, 'original/'), tmp_dir, server=url),
+                             findfacesdir(os.path.join(IMAGES_PATH, 'original/'), None))
+
+    def test_import_time(self):
+        import subprocess
+        import sys
+
+        # Importing dolly (and its CLI) must not load the heavy dependencies. Only numpy takes a noticeable time
+        heavy_modules = ['face_recognition', 'dlib', 'nmslib', 'PIL', 'googleapiclient']
+        code = ('import sys, time; t = time.perf_counter(); import numpy; t2 = time.perf_counter(); '
+                'import dolly, dolly.cli; t3 = time.perf_counter(); print(t3 - t); print(t3 - t2); '
+                'print(",".join(m for m in {} if m in sys.modules))'.format(heavy_modules))
+        root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root_dir).decode().splitlines()
+        import_time, dolly_time = float(output[0]), float(output[1])
+        loaded = output[2] if len(output) > 2 else ''
+        self.assertEqual(loaded, '')
+        self.assertLess(import_time, 2.0)
+        self.assertLess(dolly_time, 0.5)  # Without numpy
+
+    def test_persisted_index(self):
+        filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+        from dolly.index import read_index_meta, is_index_stale, file_fingerprint
+        from dolly.store import matrix_files, append_matrix
+
+        # Build (and save) the index, then load it from disk
+        f = Finder(db_conn=create_connection(database), in_memory=True, data_path=BASE_DIR, rebuild_index=True)
+        f2 = Finder(db_conn=create_connection(database), in_memory=True, data_path=BASE_DIR)
+        meta = read_index_meta(os.path.join(BASE_DIR, 'index/'))
+        self.assertEqual(meta['num_items'], len(f.np_ids))
+        self.assertEqual(f2.index_meta['fingerprint'], meta['fingerprint'])
+        self.assertTrue(is_index_stale(meta, fingerprint='0' * 40))
+        self.assertTrue(is_index_stale(meta, meta['fingerprint'], index_params={'M': 8}))
+
+        # The fingerprint only depends on the content: a copy of the dataset (new paths and times) keeps its index
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_path, data_path2 = os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b')
+            database2 = self.copy_synthetic_dataset(data_path)
+            f3 = Finder(db_conn=create_connection(database2), data_path=data_path, engine='hnsw')
+            shutil.copytree(data_path, data_path2, copy_function=shutil.copy)
+            f4 = Finder(db_conn=create_connection(database2), data_path=data_path2, engine='hnsw')
+            self.assertEqual(f4.index_meta['created'], f3.index_meta['created'])
+            encodings_file, encodings_file2 = matrix_files(data_path)[2], matrix_files(data_path2)[2]
+            self.assertEqual(file_fingerprint(encodings_file2, sample_size=4096),
+                             file_fingerprint(encodings_file, sample_size=4096))
+            append_matrix(data_path2, [2001], np.zeros((1, 128)))
+            self.assertNotEqual(file_fingerprint(encodings_file2, sample_size=4096),
+                                file_fingerprint(encodings_file, sample_size=4096))
+
+        # Same results with the built and the loaded index
+        f_loc, f_lmarks, f_enc = analyze_face(np_image=image_loader(filename), model='hog')
+        res = f.findclones(face_encoding=f_enc, top_k=3)
+        res2 = f2.findclones(face_encoding=f_enc, top_k=3)
+        self.assertEqual([r[0] for r in res], [r[0] for r in res2])
+
+    def test_entity_index(self):
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)  # 40 people, 50 faces each
+            queries = self.synthetic_queries
+
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact')
+            f2 = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact', entity_index=True)
+            self.assertEqual(len(f2.entity_index), 40)
+
+            # All the entities are shortlisted: same results as the exact search
+            for q in queries:
+                res = f.findclones(face_encoding=q, top_k=5)
+                self.assertEqual(f2.findclones(face_encoding=q, top_k=5), res)
+
+                # Top-k distinct people (over-fetching from the engine, or with the entity index)
+                unique = f.findclones(face_encoding=q, top_k=5, unique_entities=True)
+                self.assertEqual(len(set(r[1] for r in unique)), 5)
+                self.assertEqual(unique[0], res[0])
+                self.assertEqual(f2.findclones(face_encoding=q, top_k=5, unique_entities=True), unique)
+
+            # Only the faces of the closest entities are compared
+            f2.entity_shortlist = 1
+            self.assertEqual(len(set(r[1] for r in f2.findclones(face_encoding=queries[0], top_k=5))), 1)
+
+    def test_compressed_encodings(self):
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)
+            queries = self.synthetic_queries
+
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact')
+            res = f.findclones_many(queries, top_k=5)
+            for compression in ['float16', 'pq']:
+                f2 = Finder(db_conn=create_connection(database), data_path=tmp_dir, compression=compression,
+                            rerank_size=50, pq_params={'sample_size': 1000, 'iterations': 5})
+                self.assertEqual(f2.compressed.kind, compression)
+                self.assertLess(f2.compressed.data.nbytes, f.np_encodings.nbytes)
+
+                # The distances to several faces are computed at once (one decoding of the block)
+                dists = f2.compressed.distances(queries, 0, 100)
+                self.assertEqual(dists.shape, (len(queries), 100))
+                for query, query_dists in zip(queries, dists):
+                    np.testing.assert_allclose(query_dists, f2.compressed.distances(query[None], 0, 100)[0], atol=1e-4)
+                if compression == 'float16':
+                    np.testing.assert_allclose(dists[0], np.linalg.norm(f.np_encodings[:100] - queries[0], axis=1),
+                                               atol=1e-2)
+
+                # The shortlist is reranked with the exact encodings (same distances as the exact engine)
+                self.assertEqual(f2.findclones_many(queries, top_k=5), res)
+
+                # Approximate distances only
+                f2.rerank_size = 0
+                res2 = f2.findclones_many(queries, top_k=5)
+                self.assertEqual([len(r) for r in res2], [5] * len(queries))
+
+    def test_sharded_index(self):
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+        from dolly.index import update_index, read_index_meta
+        from dolly.shards import read_shards_plan, build_shards, get_sharded_index
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)
+            queries = self.synthetic_queries
+
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact')
+            f2 = Finder(db_conn=create_connection(database), data_path=tmp_dir, num_shards=3)
+            try:
+                self.assertEqual(read_shards_plan(tmp_dir)['bounds'], [0, 666, 1333, 2000])
+                self.assertEqual(len(f2.index), 2000)
+
+                # The top-k of the shards are merged (row IDs of the whole matrix)
+                res, res2 = f.findclones_many(queries, top_k=5), f2.findclones_many(queries, top_k=5)
+                self.assertEqual([r[0][0] for r in res2], [r[0][0] for r in res])
+                self.assertEqual(f2.findclones(face_encoding=queries[0], top_k=5)[0][0], res[0][0][0])
+            finally:
+                f2.index.close()
+
+            # The shards are only built once, and a copy of the dataset keeps them
+            self.assertEqual(build_shards(tmp_dir), [])
+            with tempfile.TemporaryDirectory() as tmp_dir2:
+                copy_path = os.path.join(tmp_dir2, 'copy')
+                shutil.copytree(tmp_dir, copy_path, copy_function=shutil.copy)
+                plan_file = os.path.join(copy_path, 'index/shards/shards.json')
+                plan_time = os.stat(plan_file).st_mtime_ns
+                index, plan = get_sharded_index(copy_path, 3)
+                index.close()
+                self.assertEqual(os.stat(plan_file).st_mtime_ns, plan_time)  # Not planned again
+                self.assertEqual(build_shards(copy_path), [])
+
+            # Updates: the shards are rebuilt over the compacted matrix (the single index is not needed)
+            conn = create_connection(database)
+            conn.execute('DELETE FROM faces WHERE id % 3 = 0;')
+            conn.commit()
+            self.assertTrue(update_index(database, tmp_dir)['rebuilt'])
+            self.assertIsNone(read_index_meta(os.path.join(tmp_dir, 'index/')))
+            self.assertEqual(read_shards_plan(tmp_dir)['bounds'], [0, 444, 889, 1334])
+            conn.execute("INSERT INTO faces(image_name, freebase_mid, face_encoding) VALUES ('new', 'm.0000000', ?);",
+                         (queries[0].astype(np.float32),))
+            conn.commit()
+            summary = update_index(database, tmp_dir)
+            self.assertEqual((summary['appended'], summary['rebuilt']), (1, False))
+            f3 = Finder(db_conn=conn, data_path=tmp_dir, num_shards=3)
+            try:
+                self.assertEqual(len(f3.index), 1334)
+                self.assertEqual(f3.findclones(face_encoding=queries[0], top_k=1)[0][0], 2001)
+            finally:
+                f3.index.close()
+
+    def test_hnsw_rerank(self):
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)
+            queries = self.synthetic_queries
+
+            # The shortlist of the index is reranked with the euclidean distance: same results as the exact engine
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact')
+            f2 = Finder(db_conn=create_connection(database), data_path=tmp_dir, rerank_size=50)
+            res = f.findclones_many(queries, top_k=5)
+            self.assertEqual(f2.findclones_many(queries, top_k=5), res)
+            self.assertEqual(f2.findclones(face_encoding=queries[0], top_k=5), res[0])
+
+            # Without rerank, the distances are the ones of the index (cosine)
+            f2.rerank_size = 0
+            res2 = f2.findclones(face_encoding=queries[0], top_k=5)
+            self.assertEqual(res2[0][:3], res[0][0][:3])
+            self.assertLess(res2[0][3], res[0][0][3])
+
+    def test_find_within(self):
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)
+            queries = self.synthetic_queries[:3]
+
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='exact', chunk_size=300)
+            f2 = Finder(db_conn=create_connection(database), data_path=tmp_dir)
+            f3 = Finder(db_conn=create_connection(database), data_path=tmp_dir, engine='db', chunk_size=300)
+            for q in queries:
+                # All the faces within the radius (the same ones as a top-k search)
+                res = f.findclones(face_encoding=q, top_k=100)
+                radius = res[20][3]
+                within = f.find_within(q, radius)
+                self.assertEqual(within, [r for r in res if r[3] <= radius])
+                self.assertEqual(f3.find_within(q, radius), within)
+                within2 = f2.find_within(q, radius)  # Approximate (the faces the index finds)
+                self.assertTrue(set(within2) <= set(within))
+                self.assertGreaterEqual(len(within2), 0.9 * len(within))
+
+                # The closest ones, or any of them
+                self.assertEqual(f.find_within(q, radius, limit=5), within[:5])
+                for finder in (f, f2, f3):
+                    first = finder.find_within(q, radius, first_match=True)
+                    self.assertEqual(len(first), 1)
+                    self.assertIn(first[0], within)
+                    self.assertEqual(finder.find_within(q, 0.0), [])
+
+    def test_tune_ef_search(self):
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+        from dolly.index import read_index_meta, DEFAULT_EF_SEARCH
+        from dolly.tuning import tune_ef_search
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = self.copy_synthetic_dataset(tmp_dir)
+
+            f = Finder(db_conn=create_connection(database), data_path=tmp_dir, M=8, ef_construction=50, num_threads=2)
+            self.assertEqual(f.index_meta['index_params'], {'M': 8, 'efConstruction': 50})
+            self.assertIsNone(f.ef_search)
+
+            # Without saving, the index is reset to the default efSearch of nmslib
+            class RecordedIndex:
+                def __init__(self, index):
+                    self.index, self.params = index, []
+
+                def __getattr__(self, name):
+                    return getattr(self.index, name)
+
+                def setQueryTimeParams(self, params):
+                    self.params.append(params)
+                    self.index.setQueryTimeParams(params)
+            f.index = RecordedIndex(f.index)
+            tune_ef_search(f, recall=0.9, top_k=5, num_probes=50, save=False)
+            self.assertIsNone(f.ef_search)
+            self.assertEqual(f.index.params[-1], {'efSearch': DEFAULT_EF_SEARCH})
+            self.assertNotIn('ef_search', read_index_meta(os.path.join(tmp_dir, 'index/')))
+            f.index = f.index.index
+
+            # Smallest efSearch with the target recall (saved with the index)
+            tuning = tune_ef_search(f, recall=0.9, top_k=5, num_probes=50)
+            self.assertGreaterEqual(tuning['curve'][str(tuning['ef_search'])]['recall'], 0.9)
+            self.assertEqual(min(int(ef_search) for ef_search in tuning['curve']), 100)  # Shortlist of the rerank
+            self.assertEqual(read_index_meta(os.path.join(tmp_dir, 'index/'))['ef_search'], tuning['ef_search'])
+
+            # It is used by default (the saved index is not rebuilt), unless another one is given
+            f2 = Finder(db_conn=create_connection(database), data_path=tmp_dir)
+            self.assertEqual(f2.index_meta['created'], f.index_meta['created'])
+            self.assertEqual(f2.ef_search, tuning['ef_search'])
+            f3 = Finder(db_conn=create_connection(database), data_path=tmp_dir, ef_search=200)
+            self.assertEqual(f3.ef_search, 200)
+
+    def test_async_finder(self):
+        import asyncio
+        import pickle
+        import sqlite3
+        import threading
+        import time
+        filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.aio import AsyncFinder
+        from dolly.findclones import Finder
+        from dolly.db import ConnectionProvider
+
+        encodings = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))
+
+        async def run():
+            async with AsyncFinder.open(database, data_path=BASE_DIR, engine='exact', max_concurrency=2,
+                                        threads=3, processes=1) as af:
+                # Concurrent searches (each thread with its own read-only connection)
+                res = await asyncio.gather(*[af.findclones(e, top_k=3) for e in encodings])
+                self.assertEqual(res, [af.finder.findclones(e, top_k=3) for e in encodings])
+                self.assertEqual(await af.findclones_many(encodings, top_k=3), res)
+                with self.assertRaises(sqlite3.OperationalError):
+                    af.finder.execute('DELETE FROM faces;')
+
+                # Detection and encoding in the pool of processes
+                res2 = await af.findclones_image(filename, top_k=3)
+                self.assertEqual(res2[0][0], 4)
+
+                # Cancellation: a job waiting for its turn never runs
+                release, ran = threading.Event(), []
+                running = [asyncio.ensure_future(af._run(af.thread_pool, release.wait, 10)) for _ in range(2)]
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(af._run(af.thread_pool, ran.append, 'cancelled'), timeout=0.1)
+                release.set()
+                await asyncio.gather(*running)
+                await af._run(af.thread_pool, ran.append, 'next')
+                self.assertEqual(ran, ['next'])
+
+                # A search still running when the facade is closed finishes before its connection is closed
+                def slow_query():
+                    time.sleep(0.2)
+                    ran.append(af.finder.db_conn.get().execute('SELECT COUNT(*) FROM faces;').fetchone()[0])
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(af._run(af.thread_pool, slow_query), timeout=0.05)
+            self.assertEqual(ran, ['next', 5])
+
+            # The connections of a given Finder are not closed
+            provider = ConnectionProvider(database)
+            conn = provider.get()
+            async with AsyncFinder(Finder(db_conn=provider, data_path=BASE_DIR, engine='exact')) as af:
+                self.assertEqual(await af.findclones(encodings[0], top_k=3), res[0])
+            self.assertEqual(conn.execute('SELECT 1;').fetchone()[0], 1)
+            provider.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_connection_provider(self):
+        import pickle
+        import sqlite3
+        from concurrent.futures import ThreadPoolExecutor
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection, enable_wal, ConnectionProvider, DEFAULT_MMAP_SIZE, DEFAULT_CACHE_SIZE
+
+        encodings = pickle.load(open(os.path.join(PICKLE_PATH, 'np_encodings.pkl'), 'rb'))
+
+        # Opening readers never modifies the DB
+        provider = ConnectionProvider(os.path.join(DB_PATH, 'msceleb.sqlite'))
+        self.assertNotEqual(provider.get().execute('PRAGMA journal_mode;').fetchone()[0], 'wal')
+        provider.close()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = os.path.join(tmp_dir, 'msceleb.sqlite')
+            shutil.copy(os.path.join(DB_PATH, 'msceleb.sqlite'), database)
+            self.assertTrue(enable_wal(database))
+            provider = ConnectionProvider(database)
+
+            # Tuned read-only connections, one per thread
+            conn = provider.get()
+            self.assertEqual(conn.execute('PRAGMA journal_mode;').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute('PRAGMA mmap_size;').fetchone()[0], DEFAULT_MMAP_SIZE)
+            self.assertEqual(conn.execute('PRAGMA cache_size;').fetchone()[0], DEFAULT_CACHE_SIZE)
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute('DELETE FROM faces;')
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                self.assertIsNot(pool.submit(provider.get).result(), conn)
+
+            # One Finder used by several threads at once (DB-backed paths)
+            f = Finder(db_conn=provider, data_path=BASE_DIR, engine='db', chunk_size=2)
+            f2 = Finder(db_conn=create_connection(database), data_path=BASE_DIR, engine='db', chunk_size=2)
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                res = list(pool.map(lambda e: f.findclones(e, top_k=3), list(encodings) * 4))
+            self.assertEqual(res, [f2.findclones(e, top_k=3) for e in encodings] * 4)
+            provider.close()
+
+    def test_profile(self):
+        filename = os.path.join(IMAGES_PATH, 'original/obama.jpg')
+        database = os.path.join(DB_PATH, 'msceleb.sqlite')
+
+        from dolly.findclones import Finder
+        from dolly.db import create_connection
+        from dolly.profiling import Profile, add_hook, remove_hook
+
+        f = Finder(db_conn=create_connection(database), in_memory=True, data_path=BASE_DIR)
+        f_enc = analyze_face(np_image=image_loader(filename))[2]
+
+        # Stages of the detection and the search (and a hook)
+        calls = []
+        hook = lambda name, elapsed, count: calls.append(name)
+        add_hook(hook)
+        with Profile() as profile:
+            f.findclones_many([f_enc, f_enc], top_k=3)
+            analyze_face(np_image=image_loader(filename))
+        remove_hook(hook)
+        report = profile.report()
+        for name in ['image_loader', 'face_locations', 'face_landmarks', 'face_encodings', 'knnQuery', 'search.hnsw',
+                     'enhance_results', 'sql.entities_from_faceids']:
+            self.assertIn(name, report)
+        self.assertEqual(report['search.hnsw']['items'], 2)
+        self.assertEqual(sorted(calls), sorted(name for name, s in report.items() for _ in range(s['calls'])))
+
+        # Nothing is recorded without hooks
+        f.findclones(face_encoding=f_enc, top_k=3)
+        self.assertEqual(profile.report(), report)
+
 
 if __name__ == '__main__':
     # Test all